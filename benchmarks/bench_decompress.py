@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+Compare the decompression backends of celseq2.decompress on the simulated
+CEL-Seq2 reads.
+
+The simulated R2 is repeated --copies times, saved as plain gzip and as
+BGZF, and then read line by line through every available backend.
+
+Usage:
+    python benchmarks/bench_decompress.py --copies 2000 --threads 4
+'''
+import gzip
+import time
+import argparse
+import tempfile
+
+import pysam
+
+from celseq2.dummy_species import dummy_gtf, dummy_fasta
+from celseq2.dummy_CELSeq2_reads import dummy_CELSeq2
+from celseq2.decompress import available_backends
+from celseq2.helper import join_path, filehandle_fastq_gz, print_logger
+
+
+def simulated_fastq(workdir, copies):
+    gtf = join_path(workdir, 'dummy.gtf')
+    fasta = join_path(workdir, 'dummy.fasta')
+    r1 = join_path(workdir, 'r1.fq')
+    r2 = join_path(workdir, 'r2.fq')
+    dummy_gtf(gtf)
+    dummy_fasta(fasta)
+    dummy_CELSeq2(gtf, fasta, r1, r2, len_tx=50, gzip=False)
+    with open(r2, 'rb') as fin:
+        content = fin.read()
+
+    fq_gz = join_path(workdir, 'reads.fq.gz')
+    fq_bgzf = join_path(workdir, 'reads.bgzf.fq.gz')
+    with gzip.open(fq_gz, 'wb', compresslevel=6) as fh:
+        for _ in range(copies):
+            fh.write(content)
+    fh = pysam.BGZFile(fq_bgzf, 'wb')
+    for _ in range(copies):
+        fh.write(content)
+    fh.close()
+    return(fq_gz, fq_bgzf, len(content) * copies)
+
+
+def time_backend(fpath, backend, threads):
+    t0 = time.time()
+    fh = filehandle_fastq_gz(fpath, backend=backend, threads=threads)
+    n = 0
+    for _ in fh:
+        n += 1
+    fh.close()
+    return(time.time() - t0, n)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--copies', type=int, metavar='N', default=1000,
+                        help='Times to repeat the simulated reads.')
+    parser.add_argument('--threads', type=int, metavar='N', default=4,
+                        help='Threads for the bgzf backend.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        fq_gz, fq_bgzf, nbytes = simulated_fastq(workdir, args.copies)
+        print_logger('Inflated size: {:,} bytes'.format(nbytes))
+        print('{:<8}{:<10}{:>10}{:>12}{:>10}'.format(
+            'file', 'backend', 'threads', 'seconds', 'MB/s'))
+        for fname, fpath in [('gzip', fq_gz), ('bgzf', fq_bgzf)]:
+            for backend in available_backends():
+                if backend == 'bgzf' and fpath != fq_bgzf:
+                    continue
+                threads = args.threads if backend in ('auto', 'bgzf') else 1
+                sec, _ = time_backend(fpath, backend, threads)
+                print('{:<8}{:<10}{:>10}{:>12.3f}{:>10.1f}'.format(
+                    fname, backend, threads, sec, nbytes / sec / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''
+Time the assembly of an experiment UMI-count matrix from per-cell molecules
+by celseq2.umi_matrix, against the former loop building one dense Series of
+all genes per cell.
+
+Every cell gets --umis random (gene, UMI) molecules, split into two items
+which are merged as cells of one experiment. The former loop is timed on
+--legacy-cells cells and extrapolated to all cells.
+
+Usage:
+    python benchmarks/bench_umi_matrix.py --cells 10000 --genes 30000
+'''
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from celseq2.molecules import Molecules
+from celseq2.umi_matrix import build_matrices
+from celseq2.helper import print_logger
+
+
+def simulated_molecules(n_cells, genes, n_umis, len_umi, seed=0):
+    rng = np.random.RandomState(seed)
+    # a few genes take most UMIs, as in real data
+    weights = 1.0 / np.arange(1, len(genes) + 1)
+    weights /= weights.sum()
+    for c in range(n_cells):
+        cell = 'cell{}'.format(c)
+        gene_ids = rng.choice(len(genes), size=n_umis, p=weights)
+        umis = rng.randint(0, 4 ** len_umi, size=n_umis)
+        half = n_umis // 2
+        for lo, hi in [(0, half), (half, n_umis)]:
+            yield (cell, Molecules.from_codes(gene_ids[lo:hi], umis[lo:hi],
+                                              genes, len_umi))
+
+
+def legacy_matrix(cells, genes):
+    expr_dict = {}
+    for cell, mols in cells.items():
+        cnt = Molecules.merge(mols).counts()
+        expr_dict[cell] = pd.Series([cnt[x] for x in genes], index=genes)
+    expr_df = pd.DataFrame(expr_dict, index=genes, columns=list(cells))
+    return(expr_df.fillna(0))
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--cells', type=int, metavar='N', default=10000,
+                        help='Number of cells.')
+    parser.add_argument('--genes', type=int, metavar='N', default=30000,
+                        help='Number of genes.')
+    parser.add_argument('--umis', type=int, metavar='N', default=2000,
+                        help='Molecules per cell.')
+    parser.add_argument('--legacy-cells', type=int, metavar='N', default=100,
+                        help='Cells to time the former loop on.')
+    args = parser.parse_args()
+
+    len_umi = 6
+    genes = ['gene{}'.format(i) for i in range(args.genes)]
+    print_logger('Simulating {} cells x {} genes'.format(args.cells,
+                                                         args.genes))
+    records = [('E1', cell, mol) for cell, mol in simulated_molecules(
+        args.cells, genes, args.umis, len_umi)]
+
+    t0 = time.time()
+    mat = build_matrices(records, genes, len_umi=len_umi)['E1']
+    t_new = time.time() - t0
+    dense_bytes = mat.shape[0] * mat.shape[1] * 8
+
+    legacy = {}
+    for _, cell, mol in records:
+        if len(legacy) == args.legacy_cells and cell not in legacy:
+            break
+        legacy.setdefault(cell, []).append(mol)
+    t0 = time.time()
+    expr_df = legacy_matrix(legacy, genes)
+    t_old = (time.time() - t0) * args.cells / len(legacy)
+    sub = mat.select(cells_mask=np.arange(args.cells) < len(legacy))
+    assert np.array_equal(sub.to_dense().values, expr_df.values)
+
+    print('{:<12}{:>12}{:>16}'.format('method', 'seconds', 'matrix MB'))
+    print('{:<12}{:>12.2f}{:>16.1f}'.format(
+        'umi_matrix', t_new,
+        (mat.data.nbytes + mat.indices.nbytes + mat.indptr.nbytes) / 1e6))
+    print('{:<12}{:>12.2f}{:>16.1f}'.format(
+        'legacy*', t_old, dense_bytes / 1e6))
+    print('* extrapolated from {} cells'.format(len(legacy)))
+
+
+if __name__ == '__main__':
+    main()
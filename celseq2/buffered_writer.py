@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Buffered writers for many output files at once, e.g. one per cell barcode.
+
+Data are kept in a byte buffer per file and written in large chunks. The
+total size of the buffers is bounded, and only a limited number of files are
+open at the same time: idle handles are closed least-recently-used first and
+re-opened in append mode when needed again. Named pipes (FIFOs) are opened
+once and kept open until the pool is closed, since closing them would signal
+the end of the stream to the reader.
+
+Chunks can be compressed on worker threads, either as gzip members or as
+BGZF blocks (as in BAM or bgzip output), before being appended to the files.
+'''
+import os
+import stat
+import zlib
+import struct
+import resource
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+COMPRESSIONS = (None, 'gzip', 'bgzf')
+
+# Uncompressed bytes per BGZF block, as htslib does
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000'
+                         '000000')
+
+
+def gzip_member(data, level=6):
+    ''' <data> compressed as one gzip member. '''
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return(c.compress(data) + c.flush())
+
+
+def bgzf_blocks(data, level=6):
+    ''' <data> compressed as a series of BGZF blocks. '''
+    out = []
+    for i in range(0, len(data), BGZF_BLOCK_SIZE):
+        piece = data[i:i + BGZF_BLOCK_SIZE]
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = c.compress(piece) + c.flush()
+        out.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                               66, 67, 2, len(cdata) + 25))
+        out.append(cdata)
+        out.append(struct.pack('<II', zlib.crc32(piece), len(piece)))
+    return(b''.join(out))
+
+
+_COMPRESSORS = {'gzip': gzip_member, 'bgzf': bgzf_blocks}
+
+
+def is_stream(fpath):
+    ''' Whether <fpath> is an existing FIFO or character device. '''
+    try:
+        mode = os.stat(fpath).st_mode
+    except OSError:
+        return(False)
+    return(stat.S_ISFIFO(mode) or stat.S_ISCHR(mode))
+
+
+def max_open_files(reserved=64):
+    '''
+    Number of files a writer pool may keep open under the soft limit of file
+    descriptors of the process, leaving <reserved> descriptors to the rest.
+    '''
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 4096
+    return(max(8, soft - reserved))
+
+
+class BufferedWriterPool(object):
+    '''
+    Pool of buffered binary writers.
+
+    Parameters
+    ----------
+    fpaths : iterable
+        Output file paths. They are created (truncated) at once, so files
+        without any data still exist after closing the pool.
+    memory_budget : int
+        Maximum bytes kept in all buffers.
+    chunk_size : int
+        A buffer is flushed once it holds this many bytes.
+    max_open : int
+        Maximum open handles. Defaults to max_open_files().
+    header : dict
+        Optional dict(fpath -> bytes) written at the top of the files.
+    compress : str
+        One of COMPRESSIONS. 'bgzf' files end with the BGZF EOF marker.
+    compress_level : int
+        zlib compression level.
+    threads : int
+        Threads compressing chunks.
+    '''
+
+    def __init__(self, fpaths, memory_budget=2**26, chunk_size=2**20,
+                 max_open=None, header=None,
+                 compress=None, compress_level=6, threads=1):
+        if compress not in COMPRESSIONS:
+            raise ValueError('Unknown compression: {}'.format(compress))
+        self.memory_budget = memory_budget
+        self.chunk_size = min(chunk_size, memory_budget)
+        self.max_open = max_open if max_open else max_open_files()
+        self.header = header if header else dict()
+        self.compress = compress
+        self.compress_level = compress_level
+        self.threads = max(1, threads)
+        self._executor = None
+        self._pending = deque()
+        if compress:
+            self._executor = ThreadPoolExecutor(self.threads)
+        self._buf = dict()
+        self._buffered = 0
+        self._open = OrderedDict()
+        self._streams = dict()
+        for fpath in fpaths:
+            self.add(fpath)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, fpath, header=None):
+        '''
+        Create (truncate) <fpath> and start buffering for it.
+        '''
+        if fpath in self._buf:
+            return
+        if header is None:
+            header = self.header.get(fpath, None)
+        self._buf[fpath] = bytearray()
+        if is_stream(fpath):
+            self._streams[fpath] = open(fpath, 'wb')
+            if header:
+                self._streams[fpath].write(self._compressed(header))
+            return
+        with open(fpath, 'wb') as fh:
+            if header:
+                fh.write(self._compressed(header))
+
+    def _compressed(self, data):
+        if not self.compress:
+            return(data)
+        return(_COMPRESSORS[self.compress](data, self.compress_level))
+
+    def _drain(self, limit=0):
+        # write compressed chunks in the order they were flushed
+        while len(self._pending) > limit:
+            fpath, future = self._pending.popleft()
+            self._handle(fpath).write(future.result())
+
+    def _handle(self, fpath):
+        if fpath in self._streams:
+            return(self._streams[fpath])
+        fh = self._open.get(fpath, None)
+        if fh is not None:
+            self._open.move_to_end(fpath)
+            return(fh)
+        while len(self._open) >= self.max_open:
+            _, idle = self._open.popitem(last=False)
+            idle.close()
+        fh = open(fpath, 'ab')
+        self._open[fpath] = fh
+        return(fh)
+
+    def flush(self, fpath):
+        buf = self._buf[fpath]
+        if not buf:
+            return
+        if self.compress:
+            self._pending.append((fpath, self._executor.submit(
+                _COMPRESSORS[self.compress], bytes(buf),
+                self.compress_level)))
+            self._drain(2 * self.threads)
+        else:
+            self._handle(fpath).write(buf)
+        self._buffered -= len(buf)
+        self._buf[fpath] = bytearray()
+
+    def write(self, fpath, data):
+        buf = self._buf[fpath]
+        buf += data
+        self._buffered += len(data)
+        if len(buf) >= self.chunk_size:
+            self.flush(fpath)
+        if self._buffered > self.memory_budget:
+            self._shrink()
+
+    def _shrink(self):
+        # flush the largest buffers until half of the budget is free
+        for fpath in sorted(self._buf, key=lambda x: len(self._buf[x]),
+                            reverse=True):
+            if self._buffered <= self.memory_budget // 2:
+                break
+            self.flush(fpath)
+
+    def close(self):
+        for fpath in self._buf:
+            self.flush(fpath)
+        self._drain()
+        if self.compress == 'bgzf':
+            for fpath in self._buf:
+                self._handle(fpath).write(BGZF_EOF)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for _, fh in self._open.items():
+            fh.close()
+        self._open.clear()
+        for _, fh in self._streams.items():
+            fh.close()
+        self._streams.clear()
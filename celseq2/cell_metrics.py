@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Per-cell QC metrics, kept as a compact table of cells x metrics.
+
+The metrics of a cell are taken when it is counted or its matrix assembled:
+
+- num_UMIs, num_detected_genes, num_mt_UMIs: UMIs, genes with UMIs, and UMIs
+  of genes named mt-* or MT-*.
+- ALN_STATS: number of alignments of every category of count_umi().
+
+QC plots and reports then look them up in the table saved by
+save_cell_metrics() instead of reading the UMI-count matrix or the pickles of
+cells again.
+'''
+import numpy as np
+import pandas as pd
+
+
+METRICS = ('num_UMIs', 'num_detected_genes', 'num_mt_UMIs')
+# Alignment categories of count_umi()
+ALN_STATS = ('_unmapped', '_low_map_qual', '_multimapped', '_uniquemapped',
+             '_no_feature', '_ambiguous', '_total', '_umi_collapsed',
+             '_invalid_umi')
+
+
+def mt_genes(genes):
+    ''' Boolean mask of the genes named mt-* or MT-*. '''
+    genes = pd.Index(genes, dtype=object)
+    return(np.asarray(genes.str.match('(?:mt|MT)-'), dtype=bool))
+
+
+def cell_metrics(umi_vec):
+    ''' METRICS of a cell of UMI counts dict(gene -> count). '''
+    genes = [g for g, v in umi_vec.items() if v]
+    counts = np.fromiter((umi_vec[g] for g in genes), dtype=np.int64,
+                         count=len(genes))
+    return(dict(num_UMIs=int(counts.sum()),
+                num_detected_genes=len(genes),
+                num_mt_UMIs=int(counts[mt_genes(genes)].sum())))
+
+
+def matrix_metrics(expr):
+    ''' Table of the METRICS of every cell of SparseCounts <expr>. '''
+    return(pd.DataFrame(
+        dict(num_UMIs=expr.total_per_cell(),
+             num_detected_genes=expr.detected_per_cell(),
+             num_mt_UMIs=expr.total_per_cell(mt_genes(expr.genes))),
+        index=pd.Index(expr.cells, dtype=object, name='cell'),
+        columns=list(METRICS)))
+
+
+def metrics_table(records):
+    '''
+    Table of cells x (METRICS + ALN_STATS) of <records>, a dict of cell ->
+    dict of metric -> count. Missing metrics are 0.
+    '''
+    columns = list(METRICS + ALN_STATS)
+    values = np.array([[x.get(k, 0) for k in columns]
+                       for x in records.values()],
+                      dtype=np.int64).reshape(len(records), len(columns))
+    return(pd.DataFrame(values, columns=columns,
+                        index=pd.Index(list(records), dtype=object,
+                                       name='cell')))
+
+
+def save_cell_metrics(table, fpath):
+    ''' Save a table of cells x metrics as CSV <fpath>. '''
+    table.to_csv(fpath, index_label='cell')
+
+
+def load_cell_metrics(fpath):
+    '''
+    Table of cells x metrics saved by save_cell_metrics(). The former
+    alignment stats CSV of categories x cells is read transposed.
+    '''
+    table = pd.read_csv(fpath, index_col=0)
+    if '_total' in table.index:
+        table = table.T
+    table.index.name = 'cell'
+    return(table)
@@ -126,6 +126,12 @@ def get_argument_parser():
         action="store_true",
         help="Keep the intermediate files after run.")
     parser.set_defaults(keep_temp=False)
+    parser.add_argument(
+        "--compress-intermediate", dest='compress_intermediate',
+        action="store_true",
+        help=("Write the per-cell FASTQs compressed (BGZF) and the per-cell "
+              "alignments as BAM, instead of celseq2-slim afterwards."))
+    parser.set_defaults(compress_intermediate=False)
     parser.add_argument(
         "--version", "-v",
         action="version",
@@ -149,7 +155,8 @@ def main():
                 'experiment_table': args.experiment_table,
                 'stranded': stranded,
                 'run_celseq2_to_st': args.celseq2_to_st,
-                'keep_intermediate': args.keep_temp},
+                'keep_intermediate': args.keep_temp,
+                'compress_intermediate': args.compress_intermediate},
 
         printshellcmds=True,
         printreason=True,
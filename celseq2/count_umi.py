@@ -3,15 +3,28 @@
 
 '''
 SAM file of one cell + GFF => UMI vector of the cell
+
+SAM file of one item (all cells) + GFF => UMI vectors of every cell, where
+the cell barcode is read from the read name.
 '''
 import HTSeq
+import pysam
 import pickle
 import argparse
-from collections import defaultdict, Counter
+import multiprocessing
+import numpy as np
+from collections import defaultdict, Counter, OrderedDict
 import plotly.graph_objs as go
-from plotly.offline import plot
-import pandas as pd
-from celseq2.helper import base_name
+from plotly.colors import DEFAULT_PLOTLY_COLORS
+from celseq2.helper import base_name, join_path, mkfolder, print_logger
+from celseq2.demultiplex import bc_dict_id2seq, str2int
+from celseq2.demultiplex_sam import _cell_seq
+from celseq2.feature_index import FeatureIndex, NO_FEATURE, AMBIGUOUS
+from celseq2.molecules import Molecules, encode_umis, valid_umis
+from celseq2.molecules import UMI_COLLAPSE_METHODS
+from celseq2.molecule_store import MoleculeStore
+from celseq2.plotly_utils import box_traces, save_html
+from celseq2.cell_metrics import load_cell_metrics
 
 
 def invert_strand(iv):
@@ -35,69 +48,510 @@ def _umi_seq(name, length=6):
     return(out)
 
 
-def count_umi(sam_fpath, features, stranded='yes',
-              len_umi=6, accept_aln_qual_min=10,
-              dumpto=None):
+# CIGAR operations: aligned (M) and the others consuming the reference
+_CIGAR_MATCH = 0
+_CIGAR_REF = (0, 2, 3, 7, 8)
+
+
+class _AlignmentBatch(object):
     '''
-    Single SAM + GFF => UMI (saved in Python's Counter)
+    Fields needed for counting of a batch of alignments.
+
+    Alignments are numbered 0..n-1. Their aligned (M) blocks are listed in
+    block_aln/block_start/block_end.
     '''
-    umi_cnt = defaultdict(set)
-    aln_cnt = Counter()
-    fh_aln = HTSeq.SAM_Reader(sam_fpath)
+
+    def __init__(self):
+        self.name = []
+        self.mapped = []
+        self.nh = []
+        self.mapq = []
+        self.chrom = []
+        self.strand = []
+        self.block_aln = []
+        self.block_start = []
+        self.block_end = []
+
+    def __len__(self):
+        return(len(self.name))
+
+
+def read_alignment_batches(sam_fpath, batch_size=10000, threads=1):
+    '''
+    Read a SAM/BAM file through pysam and yield _AlignmentBatch of at most
+    <batch_size> alignments. <threads> inflate BGZF blocks of BAM files.
+    '''
+    samobj = pysam.AlignmentFile(str(sam_fpath), threads=threads,
+                                 check_sq=False)
+    batch = _AlignmentBatch()
+    for aln in samobj:
+        i = len(batch.name)
+        batch.name.append(aln.query_name)
+        if aln.is_unmapped:
+            batch.mapped.append(False)
+            batch.nh.append(0)
+            batch.mapq.append(0)
+            batch.chrom.append(None)
+            batch.strand.append(None)
+        else:
+            batch.mapped.append(True)
+            batch.nh.append(aln.get_tag('NH') if aln.has_tag('NH') else 0)
+            batch.mapq.append(aln.mapping_quality)
+            batch.chrom.append(aln.reference_name)
+            batch.strand.append('-' if aln.is_reverse else '+')
+            pos = aln.reference_start
+            for op, n in aln.cigartuples or ():
+                if op == _CIGAR_MATCH:
+                    batch.block_aln.append(i)
+                    batch.block_start.append(pos)
+                    batch.block_end.append(pos + n)
+                if op in _CIGAR_REF:
+                    pos += n
+        if len(batch.name) == batch_size:
+            yield(batch)
+            batch = _AlignmentBatch()
+    samobj.close()
+    if batch.name:
+        yield(batch)
+
+
+def _load_features(features):
+    # file path to a pickle of features or of (features, exported_genes)
     if type(features) is str:
         with open(features, 'rb') as fh:
             features = pickle.load(fh)
+    if type(features) is tuple:
+        features = features[0]
+    return(features)
 
-    i = 0
-    for aln in fh_aln:
-        aln_cnt["_total"] += 1
-        i += 1
-        if not aln.aligned:
-            aln_cnt["_unmapped"] += 1
-            continue
-
-        try:
-            if aln.optional_field("NH") > 1:
-                aln_cnt['_multimapped'] += 1
-                continue
-        except KeyError:
-            pass
 
-        if aln.aQual < accept_aln_qual_min:
-            aln_cnt["_low_map_qual"] += 1
-            continue
+def _htseq_genes(features, chroms, strands, starts, ends, block_aln, n_aln):
+    # union of the gene sets of every alignment in HTSeq.GenomicArrayOfSets
+    genes = [set() for _ in range(n_aln)]
+    for chrom, strand, start, end, i in zip(chroms, strands, starts, ends,
+                                            block_aln):
+        iv = HTSeq.GenomicInterval(chrom, start, end, strand)
+        for _, gene_id in features[iv].steps():
+            genes[i] |= gene_id
+    return(genes)
 
-        if not (aln.iv.chrom in features.chrom_vectors):
-            aln_cnt["_no_feature"] += 1
-            continue
 
-        gene_ids = set()
+class AssignmentCache(object):
+    '''
+    Bounded cache of the assignment of alignments, keyed by their genomic
+    footprint (chrom, strand looked up, aligned blocks). Many reads of
+    CEL-Seq2 share a footprint, e.g. at the 3' end of transcripts. The least
+    recently used footprints are evicted first.
 
-        for aln_part in aln.cigar:
-            if aln_part.type != 'M':
-                continue
-            aln_ref_iv = invert_strand(
-                aln_part.ref_iv) if stranded == 'reverse' else aln_part.ref_iv
-            for _, gene_id in features[aln_ref_iv].steps():
-                gene_ids |= gene_id
-
-        # union model
-        if len(gene_ids) == 1:
-            gene_id = list(gene_ids)[0]
-            aln_cnt["_uniquemapped"] += 1
-            umi_seq = _umi_seq(aln.read.name, len_umi)
-            umi_cnt[gene_id].add(umi_seq)
-        elif len(gene_ids) == 0:
-            aln_cnt["_no_feature"] += 1
+    Attributes
+    ----------
+    hits, misses : int
+        Alignments whose assignment was found in the cache, and footprints
+        which were looked up in the annotation.
+    '''
+
+    def __init__(self, maxsize=2**16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return(len(self._data))
+
+    def get(self, footprint):
+        value = self._data.get(footprint, None)
+        if value is not None:
+            self._data.move_to_end(footprint)
+        return(value)
+
+    def put(self, footprint, value):
+        if self.maxsize <= 0:
+            return
+        self._data[footprint] = value
+        self._data.move_to_end(footprint)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return(self.hits / total if total else 0.0)
+
+
+def _assign_alignments(batch, features, stranded='yes',
+                       accept_aln_qual_min=10, cache=None):
+    '''
+    Category of every alignment of a batch and the gene it is counted for
+    (union model). The aligned blocks of the whole batch are looked up at once,
+    each footprint only once and only if it is not in <cache>.
+
+    Returns
+    -------
+    list
+        (category, gene_id) per alignment. gene_id is None unless category is
+        "_uniquemapped".
+    '''
+    is_index = isinstance(features, FeatureIndex)
+    out = [None] * len(batch)
+    # alignment -> its aligned blocks
+    pending = dict()
+    for i in range(len(batch)):
+        if not batch.mapped[i]:
+            out[i] = ("_unmapped", None)
+        elif batch.nh[i] > 1:
+            out[i] = ('_multimapped', None)
+        elif batch.mapq[i] < accept_aln_qual_min:
+            out[i] = ("_low_map_qual", None)
+        elif (batch.chrom[i] not in features) if is_index else \
+                (batch.chrom[i] not in features.chrom_vectors):
+            out[i] = ("_no_feature", None)
         else:
-            aln_cnt["_ambiguous"] += 1
-    umi_vec = Counter({x: len(umi_cnt.get(x, set())) for x in umi_cnt})
+            pending[i] = []
+    for i, s, e in zip(batch.block_aln, batch.block_start, batch.block_end):
+        if i in pending:
+            pending[i].append((s, e))
+
+    flip = {'+': '-', '-': '+'} if stranded == 'reverse' else \
+        {'+': '+', '-': '-'}
+    # footprint -> alignments
+    footprints = OrderedDict()
+    for i, blocks in pending.items():
+        key = (batch.chrom[i], flip[batch.strand[i]], tuple(blocks))
+        footprints.setdefault(key, []).append(i)
+    todo = []
+    for key, alns in footprints.items():
+        value = cache.get(key) if cache is not None else None
+        if value is None:
+            todo.append(key)
+        else:
+            for i in alns:
+                out[i] = value
+        if cache is not None:
+            cache.hits += len(alns) - (value is None)
+            cache.misses += value is None
+
+    blocks = [(k, chrom, strand, s, e)
+              for k, (chrom, strand, bl) in enumerate(todo)
+              for s, e in bl]
+    args = ([x[1] for x in blocks], [x[2] for x in blocks],
+            [x[3] for x in blocks], [x[4] for x in blocks],
+            [x[0] for x in blocks], len(todo))
+
+    values = []
+    if is_index:
+        genes = features.assign(*args)
+        for k in range(len(todo)):
+            if genes[k] == NO_FEATURE:
+                values.append(("_no_feature", None))
+            elif genes[k] == AMBIGUOUS:
+                values.append(("_ambiguous", None))
+            else:
+                values.append(("_uniquemapped", features.genes[genes[k]]))
+    else:
+        genes = _htseq_genes(features, *args)
+        for k in range(len(todo)):
+            if len(genes[k]) == 1:
+                values.append(("_uniquemapped", list(genes[k])[0]))
+            elif len(genes[k]) == 0:
+                values.append(("_no_feature", None))
+            else:
+                values.append(("_ambiguous", None))
+
+    for key, value in zip(todo, values):
+        for i in footprints[key]:
+            out[i] = value
+        if cache is not None:
+            cache.put(key, value)
+    return(out)
+
+
+def _count_molecules(sam_fpath, features, stranded='yes', len_umi=6,
+                     accept_aln_qual_min=10, bc_length=None, claimed_bc=None,
+                     threads=1, cache=None):
+    '''
+    Molecules and alignment stats of every cell of a SAM/BAM. Cells are told
+    by the barcode in read names if <bc_length> is given; otherwise all
+    alignments belong to one cell, keyed None.
+
+    Genes are held as integer ids and UMIs as 2-bit packed integers while
+    reading, so that a cell is a pair of arrays rather than sets of strings.
+    Assignments are memoised in <cache>, by default a new AssignmentCache.
+    '''
+    features = _load_features(features)
+    if cache is None:
+        cache = AssignmentCache()
+    gene_id = dict()
+    aln_cnt = defaultdict(Counter)
+    if claimed_bc is not None:
+        claimed_bc = set(bc for bc in claimed_bc if bc)
+        for bc in claimed_bc:
+            aln_cnt[bc] = Counter()
+    cells, genes, umis = [], [], []
+
+    for batch in read_alignment_batches(sam_fpath, threads=threads):
+        assigned = _assign_alignments(batch, features, stranded,
+                                      accept_aln_qual_min, cache)
+        batch_cells, batch_genes, batch_umis = [], [], []
+        for name, (category, gene) in zip(batch.name, assigned):
+            bc = None
+            if bc_length is not None:
+                bc = _cell_seq(name, length=bc_length)
+                if claimed_bc is not None and bc not in claimed_bc:
+                    continue
+            cell_aln_cnt = aln_cnt[bc]
+            cell_aln_cnt["_total"] += 1
+            cell_aln_cnt[category] += 1
+            if gene is not None:
+                batch_cells.append(bc)
+                batch_genes.append(gene_id.setdefault(gene, len(gene_id)))
+                batch_umis.append(_umi_seq(name, len_umi))
+        # reads of UMIs too short or with other bases are not counted
+        valid = valid_umis(batch_umis, len_umi)
+        if not valid.all():
+            for k in np.flatnonzero(~valid).tolist():
+                aln_cnt[batch_cells[k]]['_invalid_umi'] += 1
+            batch_cells = [x for x, ok in zip(batch_cells, valid) if ok]
+            batch_umis = [x for x, ok in zip(batch_umis, valid) if ok]
+        cells += batch_cells
+        genes.append(np.array(batch_genes, dtype=np.int64)[valid])
+        umis.append(encode_umis(batch_umis, len_umi))
+
+    gene_names = sorted(gene_id, key=gene_id.get)
+    genes = np.concatenate(genes) if genes else np.zeros(0, dtype=np.int64)
+    umis = np.concatenate(umis) if umis else np.zeros(0, dtype=np.int64)
+    by_cell = defaultdict(list)
+    for i, bc in enumerate(cells):
+        by_cell[bc].append(i)
+    out = dict()
+    for bc, cell_aln_cnt in aln_cnt.items():
+        sel = np.array(by_cell.get(bc, []), dtype=np.int64)
+        out[bc] = (Molecules.from_codes(genes[sel], umis[sel], gene_names,
+                                        len_umi), cell_aln_cnt)
+    return(out)
+
+
+def _umi_results(mol, aln_cnt, molecules=False, umi_collapse='unique',
+                 umi_distance=1):
+    # (umi_vec, umi_set, aln_cnt) of a cell as count_umi() returns
+    if umi_collapse != 'unique':
+        collapsed = mol.collapse(umi_collapse, umi_distance)
+        aln_cnt['_umi_collapsed'] = len(mol) - len(collapsed)
+        mol = collapsed
+    umi_set = mol if molecules else mol.umi_sets()
+    return((mol.counts(), umi_set, aln_cnt))
+
+
+def count_umi(sam_fpath, features, stranded='yes',
+              len_umi=6, accept_aln_qual_min=10,
+              dumpto=None, threads=1, molecules=False,
+              umi_collapse='unique', umi_distance=1, cache=None):
+    '''
+    Single SAM/BAM + GFF => UMI (saved in Python's Counter)
+
+    The UMI set is a dict(gene -> set(UMI)), or the integer-encoded
+    Molecules of the cell if <molecules> is True.
+
+    UMIs of a gene within <umi_distance> mismatches of each other are
+    collapsed by the <umi_collapse> method of collapse_umis() ('unique'
+    counts every distinct UMI). The number of UMIs collapsed is reported as
+    "_umi_collapsed" in the alignment stats. Reads of a gene whose UMI is
+    shorter than <len_umi> or has bases other than A, C, G, T and N are not
+    counted, and reported as "_invalid_umi".
+
+    Alignments with the same footprint are assigned once through <cache>,
+    an AssignmentCache which may be shared by calls with the same features
+    and strandedness.
+    '''
+    counted = _count_molecules(sam_fpath, features, stranded=stranded,
+                               len_umi=len_umi,
+                               accept_aln_qual_min=accept_aln_qual_min,
+                               threads=threads, cache=cache)
+    mol, aln_cnt = counted.get(
+        None, (Molecules.from_codes([], [], (), len_umi), Counter()))
+    umi_vec, umi_set, aln_cnt = _umi_results(mol, aln_cnt, molecules,
+                                             umi_collapse, umi_distance)
     if dumpto:
         pickle.dump(umi_vec, open(dumpto, 'wb'))
-    return((umi_vec, umi_cnt, aln_cnt))
+    return((umi_vec, umi_set, aln_cnt))
+
+
+def count_umi_by_cell(sam_fpath, features, stranded='yes',
+                      len_umi=6, bc_length=6, accept_aln_qual_min=10,
+                      claimed_bc=None, threads=1, molecules=False,
+                      umi_collapse='unique', umi_distance=1, cache=None):
+    '''
+    Single SAM/BAM of all cells + GFF => UMI of every cell in one pass
+
+    The cell barcode of an alignment is read from its name, e.g.
+    BC-TCTGAG_UMI-CGTTAC. The results per cell are the same as running
+    count_umi() on the SAM of the cell given by sam-demultiplex.
+
+    Parameters
+    ----------
+    claimed_bc : list
+        Only count cells of these barcodes, and report each of them even if it
+        has no alignments (as sam-demultiplex --claim). Default: all barcodes
+        found.
+    molecules : bool
+        Give the UMI sets as Molecules.
+    umi_collapse, umi_distance :
+        UMI collapsing as in count_umi().
+    cache : AssignmentCache
+        Assignments shared by all cells, as in count_umi().
+
+    Returns
+    -------
+    dict
+        cell barcode -> (umi_vec, umi_set, aln_cnt) as count_umi() returns.
+    '''
+    counted = _count_molecules(sam_fpath, features, stranded=stranded,
+                               len_umi=len_umi,
+                               accept_aln_qual_min=accept_aln_qual_min,
+                               bc_length=bc_length, claimed_bc=claimed_bc,
+                               threads=threads, cache=cache)
+    return({bc: _umi_results(mol, aln_cnt, molecules, umi_collapse,
+                             umi_distance)
+            for bc, (mol, aln_cnt) in counted.items()})
+
+
+def dump_umi_by_cell(counts, umicnt_dir, umiset_dir, alncnt_dir):
+    '''
+    Save the results of count_umi_by_cell() as one pickle per cell and kind,
+    named <barcode>.pkl, as the workflow does for count_umi(). UMI sets are
+    saved as they are given, either dicts or Molecules.
+    '''
+    for d in (umicnt_dir, umiset_dir, alncnt_dir):
+        mkfolder(d)
+    for bc, (umi_vec, umi_set, aln_cnt) in counts.items():
+        with open(join_path(umicnt_dir, bc + '.pkl'), 'wb') as fh:
+            pickle.dump(umi_vec, fh)
+        with open(join_path(umiset_dir, bc + '.pkl'), 'wb') as fh:
+            pickle.dump(umi_set, fh)
+        with open(join_path(alncnt_dir, bc + '.pkl'), 'wb') as fh:
+            pickle.dump(aln_cnt, fh)
+
+
+# annotation and assignments shared by the jobs of count_umi_batch()
+_shared_features = None
+_shared_cache = None
+
+
+def _share_features(features, cache_size=2**16):
+    global _shared_features, _shared_cache
+    _shared_features = _load_features(features)
+    _shared_cache = AssignmentCache(cache_size)
+
+
+def _count_umi_job(job):
+    # count one SAM/BAM of count_umi_batch() and save the pickles or append
+    # to the molecule store
+    sam_fpath, umicnt, umiset, alncnt, claimed_bc, by_cell, store, kwargs = job
+    hits, misses = _shared_cache.hits, _shared_cache.misses
+    if by_cell:
+        counts = count_umi_by_cell(sam_fpath, _shared_features,
+                                   claimed_bc=claimed_bc, molecules=True,
+                                   cache=_shared_cache, **kwargs)
+    else:
+        kwargs = {k: v for k, v in kwargs.items() if k != 'bc_length'}
+        counts = {base_name(sam_fpath): count_umi(
+            sam_fpath, _shared_features, molecules=True,
+            cache=_shared_cache, **kwargs)}
+    if store:
+        MoleculeStore(umicnt, kwargs.get('len_umi')).append(counts)
+    elif by_cell:
+        dump_umi_by_cell(counts, umicnt, umiset, alncnt)
+    else:
+        for obj, fpath in zip(list(counts.values())[0],
+                              (umicnt, umiset, alncnt)):
+            with open(fpath, 'wb') as fh:
+                pickle.dump(obj, fh)
+    return((sam_fpath, _shared_cache.hits - hits,
+            _shared_cache.misses - misses))
+
+
+def count_umi_batch(jobs, features, processes=1, by_cell=False,
+                    cache_size=2**16, verbose=False, store=False, **kwargs):
+    '''
+    Count UMIs of many SAM/BAM files with one pool of worker processes.
+
+    The annotation is loaded once and the workers are forked afterwards, so
+    they share it copy-on-write instead of each unpickling it again.
+
+    Parameters
+    ----------
+    jobs : list
+        (sam_fpath, umicnt, umiset, alncnt, claimed_bc). The last three are
+        the pickle files of the cell, or with <by_cell> the directories of
+        the pickles of all cells of an item-level SAM/BAM. claimed_bc is
+        passed to count_umi_by_cell(), and ignored otherwise.
+    features : str or object
+        Annotation, or file path to its pickle.
+    processes : int
+        Worker processes.
+    cache_size : int
+        Size of the AssignmentCache of every worker, shared by its jobs.
+    verbose : bool
+        Log the hit rate of the caches.
+    store : bool
+        Append the cells to the MoleculeStore file given as umicnt of the
+        job instead of saving pickles. umiset and alncnt are then ignored.
+        Jobs of one store append to it in turn.
+    kwargs :
+        Passed to count_umi() or count_umi_by_cell().
+
+    Returns
+    -------
+    list
+        The SAM/BAM files counted, in the order they were finished.
+    '''
+    _share_features(features, cache_size)
+    tasks = [tuple(job) + (by_cell, store, kwargs) for job in jobs]
+    if processes <= 1 or len(tasks) <= 1:
+        done = [_count_umi_job(x) for x in tasks]
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('fork')
+            init, initargs = None, ()
+        else:
+            ctx = multiprocessing.get_context()
+            init, initargs = _share_features, (_shared_features, cache_size)
+        with ctx.Pool(min(processes, len(tasks)), init, initargs) as p:
+            done = list(p.imap_unordered(_count_umi_job, tasks))
+    if verbose:
+        hits, misses = sum(x[1] for x in done), sum(x[2] for x in done)
+        print_logger('Assignment cache: {} hits, {} misses ({:.1%}).'.format(
+            hits, misses, hits / max(1, hits + misses)))
+    return([x[0] for x in done])
+
+
+def read_batch_jobs(fpath, bc_index=None, bc_seq_column=0):
+    '''
+    Jobs of count_umi_batch() from a tab-separated file with one SAM/BAM per
+    line: sam_fpath, umicnt, umiset, alncnt and optionally the index of used
+    barcode IDs (e.g. 1-96) claimed among <bc_index>. Missing columns are
+    empty.
+    '''
+    all_bc_dict = None
+    if bc_index:
+        all_bc_dict = bc_dict_id2seq(bc_index, bc_seq_column)
+    jobs = []
+    with open(fpath) as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0]:
+                continue
+            claimed_bc = None
+            if len(fields) > 4 and fields[4] and all_bc_dict is not None:
+                claimed_bc = [all_bc_dict.get(x, None)
+                              for x in str2int(fields[4])]
+            jobs.append(tuple((fields + [''] * 3)[:4]) + (claimed_bc,))
+    return(jobs)
 
 
 def _flatten_umi_set(umi_set):
+    if isinstance(umi_set, Molecules):
+        return(umi_set.counts())
     umi_vec = Counter({x: len(umi_set.get(x, set())) for x in umi_set})
     return(umi_vec)
 
@@ -106,18 +560,27 @@ def _flatten_umi_set(umi_set):
 #     pass
 
 
-def plotly_alignment_stats(fpaths=[], saveto='', fnames=[]):
+def plotly_alignment_stats(fpaths=[], saveto='', fnames=[], webgl=False,
+                           max_points=None, plotlyjs=None):
     '''
     Save a plotly box graph with a list of alignment stats files
 
     Parameters
     ----------
     fpaths : list
-        A list of file paths
+        A list of file paths of tables of cell metrics (cell_metrics.csv), or
+        of alignment stats CSV with categories as rows
     saveto : str
         File path to save the html file as the plotly box graph
     fnames : list
         A list of strings to label each ``fpaths``
+    webgl : bool
+        Draw the outliers of thinned boxes as WebGL. Default: False
+    max_points : int
+        Number of cells to draw at most per box, keeping the outliers, see
+        plotly_utils.box_traces(). Default: all
+    plotlyjs : str
+        plotly.js to refer to, see plotly_utils.save_html(). Default: inlined
 
     Returns
     -------
@@ -137,27 +600,28 @@ def plotly_alignment_stats(fpaths=[], saveto='', fnames=[]):
         f = fpaths[i]
         fname = fnames[i]
 
-        stats = pd.read_csv(f, index_col=0)
+        stats = load_cell_metrics(f)
 
-        mapped = stats.loc['_multimapped', :] + stats.loc['_uniquemapped', :]
-        rate_mapped = mapped / stats.loc['_total', :]
+        mapped = stats['_multimapped'] + stats['_uniquemapped']
+        rate_mapped = mapped / stats['_total']
 
         overall_mapped = mapped.sum()
-        overall_total = stats.loc['_total', :].sum()
+        overall_total = stats['_total'].sum()
 
         stats.fillna(value=0, inplace=True)
-        trace_data.append(
-            go.Box(
-                y=rate_mapped,
-                name='{} (#Mapped={}/#Total={})'.format(
-                    fname, overall_mapped, overall_total)))
+        trace_data.extend(box_traces(
+            rate_mapped,
+            name='{} (#Mapped={}/#Total={})'.format(
+                fname, overall_mapped, overall_total),
+            max_points=max_points, webgl=webgl,
+            color=DEFAULT_PLOTLY_COLORS[i % len(DEFAULT_PLOTLY_COLORS)]))
 
     layout = go.Layout(
         xaxis=dict(showticklabels=False),
         title='Mapped/Total alignments per BC per item')
     fig = go.Figure(data=trace_data, layout=layout)
     try:
-        plot(fig, filename=saveto, auto_open=False)
+        save_html(fig, saveto, plotlyjs)
         return(True)
     except Exception as e:
         print(e, flush=True)
@@ -167,8 +631,22 @@ def plotly_alignment_stats(fpaths=[], saveto='', fnames=[]):
 def main():
     parser = argparse.ArgumentParser(add_help=True)
     parser.add_argument('--sam_fpath', type=str, metavar='FILENAME',
-                        required=True,
                         help='File path to SAM file')
+    parser.add_argument('--batch', type=str, metavar='FILENAME',
+                        help=('Tab-separated file of SAM/BAM files to count '
+                              'instead of --sam_fpath, one per line: SAM, '
+                              'UMI count, UMI set and alignment stats '
+                              'pickles (directories with --by-cell; or the '
+                              'molecule store and two empty columns with '
+                              '--store), and optionally the used barcode '
+                              'IDs to claim.'))
+    parser.add_argument('--cache-size', type=int, metavar='N',
+                        default=2**16,
+                        help=('Alignment footprints whose assignment is '
+                              'cached (default=65536)'))
+    parser.add_argument('--processes', type=int, metavar='N', default=1,
+                        help=('Worker processes sharing the annotation for '
+                              '--batch (default=1)'))
     parser.add_argument('--features', metavar='FILENAME.pickle|Counter',
                         required=True,
                         help=('Either file path (pickle format only) '
@@ -184,15 +662,121 @@ def main():
     parser.add_argument('--aln-qual-min', type=int, metavar='N',
                         default=10,
                         help='Acceptable min alignment quality (default=10)')
+    parser.add_argument('--umi-collapse', type=str, metavar='METHOD',
+                        choices=UMI_COLLAPSE_METHODS, default='unique',
+                        help=('Collapse UMIs of a gene with sequencing errors: '
+                              'unique (no collapsing), adjacency or '
+                              'directional (default=unique)'))
+    parser.add_argument('--umi-distance', type=int, metavar='N', default=1,
+                        help=('Max mismatches between UMIs collapsed '
+                              '(default=1)'))
     # parser.add_argument('--is-gapped-aligner', dest='is_gapped_aligner', action='store_true')
     # parser.set_defaults(is_gapped_aligner=False)
     parser.add_argument('--dumpto', type=str, metavar='FILENAME', default=None,
                         help='File path to save umi count in pickle')
+    parser.add_argument('--threads', type=int, metavar='N', default=1,
+                        help='Threads decompressing BAM input (default=1)')
+    parser.add_argument('--by-cell', dest='by_cell', action='store_true',
+                        help=('Count all cells of an item-level SAM/BAM at '
+                              'once, by the cell barcode in read names.'))
+    parser.set_defaults(by_cell=False)
+    parser.add_argument('--bc-length', type=int, metavar='N', default=6,
+                        help='Length of cell barcode (default=6)')
+    parser.add_argument('--claim', action='store_true', dest='claim',
+                        help='Only count the used barcodes of --bc-index.')
+    parser.set_defaults(claim=False)
+    parser.add_argument('--bc-index', type=str, metavar='FILENAME',
+                        help='File path to barcode dictionary.')
+    parser.add_argument('--bc-seq-column', type=int, metavar='N',
+                        default=0,
+                        help=('Column of cell barcode dictionary file '
+                              'which tells the actual sequences.'))
+    parser.add_argument('--bc-index-used', type=str, metavar='string',
+                        default='1-96',
+                        help='Index of used barcode IDs (default=1-96)')
+    parser.add_argument('--umicnt-dir', type=str, metavar='DIRNAME',
+                        default='umicnt',
+                        help='Directory to save UMI counts of cells.')
+    parser.add_argument('--umiset-dir', type=str, metavar='DIRNAME',
+                        default='umiset',
+                        help=('Directory to save UMI sets of cells, as '
+                              'integer-encoded molecules.'))
+    parser.add_argument('--alncnt-dir', type=str, metavar='DIRNAME',
+                        default='alncnt',
+                        help='Directory to save alignment stats of cells.')
+    parser.add_argument('--store', dest='store', action='store_true',
+                        help=('Append molecules and alignment stats of the '
+                              'cells to a molecule store (HDF5) instead of '
+                              'saving pickles: the file of --dumpto, or of '
+                              'the 2nd column of --batch.'))
+    parser.set_defaults(store=False)
     args = parser.parse_args()
+    if not (args.sam_fpath or args.batch):
+        parser.error('Either --sam_fpath or --batch is required.')
+    if args.store and not (args.batch or args.dumpto):
+        parser.error('--store needs the file of --dumpto.')
 
-    _ = count_umi(sam_fpath=args.sam_fpath,
-                  features=args.features,
-                  len_umi=args.umi_length,
-                  stranded=args.stranded,
-                  accept_aln_qual_min=args.aln_qual_min,
-                  dumpto=args.dumpto)
+    if args.batch:
+        jobs = read_batch_jobs(args.batch,
+                               args.bc_index if args.claim else None,
+                               args.bc_seq_column)
+        print_logger('Counting UMIs of {} files starts ...'.format(len(jobs)))
+        _ = count_umi_batch(jobs, args.features,
+                            processes=args.processes,
+                            by_cell=args.by_cell,
+                            cache_size=args.cache_size,
+                            verbose=True,
+                            store=args.store,
+                            len_umi=args.umi_length,
+                            bc_length=args.bc_length,
+                            stranded=args.stranded,
+                            accept_aln_qual_min=args.aln_qual_min,
+                            threads=args.threads,
+                            umi_collapse=args.umi_collapse,
+                            umi_distance=args.umi_distance)
+        print_logger('Counting UMIs of {} files ends.'.format(len(jobs)))
+        return
+
+    if not args.by_cell:
+        out = count_umi(sam_fpath=args.sam_fpath,
+                        features=args.features,
+                        len_umi=args.umi_length,
+                        stranded=args.stranded,
+                        accept_aln_qual_min=args.aln_qual_min,
+                        dumpto=None if args.store else args.dumpto,
+                        threads=args.threads,
+                        molecules=args.store,
+                        umi_collapse=args.umi_collapse,
+                        umi_distance=args.umi_distance)
+        if args.store:
+            MoleculeStore(args.dumpto, args.umi_length).append(
+                {base_name(args.sam_fpath): out})
+        return
+
+    claimed_bc = None
+    if args.claim:
+        all_bc_dict = bc_dict_id2seq(args.bc_index, args.bc_seq_column)
+        bc_index_used = str2int(args.bc_index_used)
+        claimed_bc = [all_bc_dict.get(x, None) for x in bc_index_used]
+    print_logger('Counting UMIs of cells starts {} ...'.format(args.sam_fpath))
+    cache = AssignmentCache(args.cache_size)
+    counts = count_umi_by_cell(sam_fpath=args.sam_fpath,
+                               features=args.features,
+                               len_umi=args.umi_length,
+                               bc_length=args.bc_length,
+                               stranded=args.stranded,
+                               accept_aln_qual_min=args.aln_qual_min,
+                               claimed_bc=claimed_bc,
+                               threads=args.threads,
+                               molecules=True,
+                               umi_collapse=args.umi_collapse,
+                               umi_distance=args.umi_distance,
+                               cache=cache)
+    if args.store:
+        MoleculeStore(args.dumpto, args.umi_length).append(counts)
+    else:
+        dump_umi_by_cell(counts, args.umicnt_dir, args.umiset_dir,
+                         args.alncnt_dir)
+    print_logger('Assignment cache: {} hits, {} misses ({:.1%}).'.format(
+        cache.hits, cache.misses, cache.hit_rate))
+    print_logger('Counting UMIs of {} cells ends.'.format(len(counts)))
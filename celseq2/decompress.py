@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Decompression of gzipped FASTQ with selectable backends.
+
+- 'zlib': in-process zlib through the gzip module.
+- 'isal': python-isal (ISA-L), a much faster inflater, if installed.
+- 'zlib-ng': python-zlib-ng, if installed.
+- 'bgzf': multi-threaded inflation of BGZF blocks (bgzip/htslib output).
+- 'gunzip': the former `gunzip -c` subprocess.
+- 'auto': 'bgzf' for BGZF files when threads > 1, otherwise the fastest
+  installed of 'isal', 'zlib-ng' and 'zlib'.
+
+Except for 'gunzip', the inflated stream is read ahead by a background thread
+so that inflating overlaps with parsing.
+'''
+import io
+import gzip
+import zlib
+import queue
+import struct
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+
+
+BACKENDS = ('auto', 'zlib', 'isal', 'zlib-ng', 'bgzf', 'gunzip')
+
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+
+def available_backends():
+    ''' Backends which are usable in this environment. '''
+    out = ['auto', 'zlib', 'bgzf', 'gunzip']
+    if igzip is not None:
+        out.insert(2, 'isal')
+    if gzip_ng is not None:
+        out.insert(-2, 'zlib-ng')
+    return(out)
+
+
+def _bgzf_block_size(header):
+    '''
+    Total size of the BGZF block starting with <header> (the first 12 bytes
+    plus the extra field), or None if it is not a BGZF block.
+    '''
+    if header[:4] != _BGZF_MAGIC:
+        return(None)
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = header[12:12 + xlen]
+    i = 0
+    while i + 4 <= len(extra):
+        si1, si2, slen = extra[i], extra[i + 1], \
+            struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return(struct.unpack('<H', extra[i + 4:i + 6])[0] + 1)
+        i += 4 + slen
+    return(None)
+
+
+def is_bgzf(fpath):
+    ''' Whether <fpath> starts with a BGZF block. '''
+    with open(fpath, 'rb') as fh:
+        header = fh.read(12)
+        if len(header) < 12:
+            return(False)
+        xlen, = struct.unpack('<H', header[10:12])
+        header += fh.read(xlen)
+    return(_bgzf_block_size(header) is not None)
+
+
+def _inflate_bgzf_block(block):
+    xlen, = struct.unpack('<H', block[10:12])
+    cdata = block[12 + xlen:-8]
+    crc, isize = struct.unpack('<II', block[-8:])
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise IOError('Corrupted BGZF block.')
+    return(data)
+
+
+class BgzfReader(io.RawIOBase):
+    '''
+    Inflate the independent blocks of a BGZF file on a pool of threads.
+
+    zlib releases the GIL while inflating, so blocks are inflated in parallel
+    and handed out in file order.
+    '''
+
+    def __init__(self, fpath, threads=2):
+        self._fh = open(fpath, 'rb')
+        self._pool = ThreadPoolExecutor(max(1, threads))
+        self._pending = deque()
+        self._max_pending = 4 * max(1, threads)
+        self._buf = b''
+        self._off = 0
+        self._raw_eof = False
+
+    def readable(self):
+        return(True)
+
+    def _next_raw_block(self):
+        header = self._fh.read(12)
+        if not header:
+            return(None)
+        if len(header) < 12:
+            raise IOError('Truncated BGZF file.')
+        xlen, = struct.unpack('<H', header[10:12])
+        header += self._fh.read(xlen)
+        bsize = _bgzf_block_size(header)
+        if bsize is None:
+            raise IOError('Not a BGZF block. Use another backend.')
+        block = header + self._fh.read(bsize - len(header))
+        if len(block) != bsize:
+            raise IOError('Truncated BGZF file.')
+        return(block)
+
+    def _submit(self):
+        while not self._raw_eof and len(self._pending) < self._max_pending:
+            block = self._next_raw_block()
+            if block is None:
+                self._raw_eof = True
+                break
+            self._pending.append(self._pool.submit(_inflate_bgzf_block,
+                                                   block))
+
+    def readinto(self, b):
+        while self._off >= len(self._buf):
+            self._submit()
+            if not self._pending:
+                return(0)
+            self._buf = self._pending.popleft().result()
+            self._off = 0
+        n = min(len(b), len(self._buf) - self._off)
+        b[:n] = self._buf[self._off:self._off + n]
+        self._off += n
+        return(n)
+
+    def close(self):
+        if not self.closed:
+            # shutdown(cancel_futures=True) needs python 3.9
+            while self._pending:
+                self._pending.popleft().cancel()
+            self._pool.shutdown(wait=True)
+            self._fh.close()
+        super().close()
+
+
+class ReadAheadReader(io.RawIOBase):
+    '''
+    Read <src> in chunks from a background thread into a bounded queue.
+    '''
+
+    def __init__(self, src, chunk_size=2**20, depth=8):
+        self._src = src
+        self._chunk_size = chunk_size
+        self._q = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._buf = b''
+        self._off = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def readable(self):
+        return(True)
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._src.read(self._chunk_size)
+                self._q.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._q.put(e)
+
+    def readinto(self, b):
+        while self._off >= len(self._buf):
+            if self._eof:
+                return(0)
+            chunk = self._q.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self._eof = True
+                return(0)
+            self._buf, self._off = chunk, 0
+        n = min(len(b), len(self._buf) - self._off)
+        b[:n] = self._buf[self._off:self._off + n]
+        self._off += n
+        return(n)
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            while self._thread.is_alive():
+                try:
+                    self._q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._src.close()
+        super().close()
+
+
+def _resolve_backend(fpath, backend, threads):
+    if backend not in BACKENDS:
+        raise ValueError('Unknown decompression backend: {}'.format(backend))
+    if backend == 'auto':
+        if threads > 1 and is_bgzf(fpath):
+            return('bgzf')
+        if igzip is not None:
+            return('isal')
+        if gzip_ng is not None:
+            return('zlib-ng')
+        return('zlib')
+    if backend == 'isal' and igzip is None:
+        raise ImportError('Backend isal requires the python package isal.')
+    if backend == 'zlib-ng' and gzip_ng is None:
+        raise ImportError('Backend zlib-ng requires the python package '
+                          'zlib-ng.')
+    if backend == 'bgzf' and not is_bgzf(fpath):
+        raise ValueError('{} is not BGZF compressed.'.format(fpath))
+    return(backend)
+
+
+def open_gz(fpath, backend='auto', threads=1, readahead=True,
+            buffer_size=2**20):
+    '''
+    Open a gzip/BGZF file as a binary stream of the inflated content.
+
+    Parameters
+    ----------
+    fpath : str
+        File path to the compressed file.
+    backend : str
+        One of BACKENDS.
+    threads : int
+        Threads inflating BGZF blocks.
+    readahead : bool
+        Inflate in a background thread ahead of the reader.
+
+    Returns
+    -------
+    io.BufferedReader
+    '''
+    backend = _resolve_backend(fpath, backend, threads)
+    if backend == 'gunzip':
+        p = subprocess.Popen(['gunzip', '-c', str(fpath)],
+                             stdout=subprocess.PIPE)
+        return(p.stdout)
+    if backend == 'bgzf':
+        raw = BgzfReader(fpath, threads=threads)
+    elif backend == 'isal':
+        raw = igzip.open(fpath, 'rb')
+    elif backend == 'zlib-ng':
+        raw = gzip_ng.open(fpath, 'rb')
+    else:
+        raw = gzip.open(fpath, 'rb')
+    if readahead:
+        raw = ReadAheadReader(raw)
+    return(io.BufferedReader(raw, buffer_size=buffer_size))
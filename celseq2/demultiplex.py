@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 # coding: utf-8
 from collections import Counter
+import itertools
+import multiprocessing
+import queue
 
 import argparse
 
 from celseq2.helper import filehandle_fastq_gz, print_logger
 from celseq2.helper import join_path, mkfolder, base_name
+from celseq2.fastq_batch import paired_batches, fixed_width_matrix
+from celseq2.fastq_batch import slice_columns, min_quality
+from celseq2.decompress import BACKENDS
+from celseq2.buffered_writer import BufferedWriterPool, is_stream
+from celseq2.plotly_utils import box_traces, save_html
 
+import numpy as np
 import plotly.graph_objs as go
-from plotly.offline import plot
+from plotly.colors import DEFAULT_PLOTLY_COLORS
 import pandas as pd
 
 
@@ -75,6 +84,46 @@ def bc_dict_id2seq(bc_index_fpath, col_seq=None):
     return(out)
 
 
+def bc_correction_index(barcodes, max_mismatch=1, alphabet='ACGTN'):
+    """
+    Neighbour index of a whitelist of barcodes for error correction.
+
+    Every sequence within <max_mismatch> substitutions of a whitelisted
+    barcode is mapped to its closest whitelisted barcode. A sequence is
+    ambiguous if two or more barcodes are equally close and no barcode is
+    closer. Whitelisted barcodes map to themselves.
+
+    Returns (index, ambiguous) where index is dict(seq -> barcode) and
+    ambiguous is a set of seq.
+
+    >>> index, ambiguous = bc_correction_index(['AAAA', 'AATT'])
+    >>> index['CAAA'], index['AATT'], 'AAAT' in index, 'AAAT' in ambiguous
+    ('AAAA', 'AATT', False, True)
+    """
+    whitelist = list(dict.fromkeys(barcodes))
+    index = {bc: bc for bc in whitelist}
+    ambiguous = set()
+    for dist in range(1, max_mismatch + 1):
+        candidates = dict()
+        for bc in whitelist:
+            for pos in itertools.combinations(range(len(bc)), dist):
+                subs = [[x for x in alphabet if x != bc[k]] for k in pos]
+                for bases in itertools.product(*subs):
+                    seq = list(bc)
+                    for k, x in zip(pos, bases):
+                        seq[k] = x
+                    seq = ''.join(seq)
+                    if seq in index or seq in ambiguous:
+                        continue
+                    candidates.setdefault(seq, set()).add(bc)
+        for seq, parents in candidates.items():
+            if len(parents) == 1:
+                index[seq] = parents.pop()
+            else:
+                ambiguous.add(seq)
+    return((index, ambiguous))
+
+
 def demultiplexing(read1_fpath, read2_fpath, dict_bc_id2seq,
                    outdir,
                    start_umi=0, start_bc=6,
@@ -86,44 +135,115 @@ def demultiplexing(read1_fpath, read2_fpath, dict_bc_id2seq,
                    tag_to='tagged.fastq',
                    do_bc_rev_complement=False,
                    do_tx_rev_complement=False,
+                   engine='line',
+                   batch_size=100000,
+                   processes=1,
+                   writers=None,
+                   decompress='auto',
+                   decompress_threads=1,
+                   bc_mismatch=0,
+                   write_buffer=2**26,
+                   max_open_files=None,
+                   compress=None,
+                   compress_threads=1,
                    verbose=False):
     """
     Demultiplexing to fastq files based on barcode sequence.
 
+    engine: 'line' parses the reads one by one. 'batch' pulls large blocks
+    from both mates and filters/slices the reads of a whole batch at once. Both
+    give the same FASTQs and the same counter.
 
+    processes: number of worker processes classifying reads. More than 1
+    implies the 'batch' engine, with <writers> processes owning the output
+    files (default: half of <processes>).
+
+    tag_to: output of <tagging_only>, relative to <outdir>. It may be a named
+    pipe (FIFO), which is then kept open until all reads are written.
+
+    decompress, decompress_threads: backend and threads inflating gzipped
+    reads. See celseq2.decompress.
+
+    bc_mismatch: barcodes within this many substitutions of exactly one
+    closest whitelisted barcode are corrected to it (see
+    bc_correction_index()). The counter then also has 'corrected' and
+    'ambiguous' reads. 0 disables the correction.
+
+    write_buffer, max_open_files: bytes buffered for all output files and
+    maximum of simultaneously open files (default: under the fd limit). See
+    celseq2.buffered_writer.
+
+    compress, compress_threads: None, 'gzip' or 'bgzf' to write compressed
+    FASTQs (named with a '.gz' suffix), compressed on <compress_threads>
+    threads.
     """
+    if processes > 1:
+        return(_demultiplexing_sharded(
+            read1_fpath, read2_fpath, dict_bc_id2seq, outdir,
+            start_umi=start_umi, start_bc=start_bc,
+            len_umi=len_umi, len_bc=len_bc, len_tx=len_tx,
+            bc_qual_min=bc_qual_min,
+            is_gzip=is_gzip,
+            save_unknown_bc_fastq=save_unknown_bc_fastq,
+            tagging_only=tagging_only,
+            tag_to=tag_to,
+            batch_size=batch_size,
+            processes=processes,
+            writers=writers,
+            decompress=decompress,
+            decompress_threads=decompress_threads,
+            bc_mismatch=bc_mismatch,
+            write_buffer=write_buffer,
+            max_open_files=max_open_files,
+            compress=compress,
+            compress_threads=compress_threads,
+            verbose=verbose))
+    if engine == 'batch':
+        return(_demultiplexing_batch(
+            read1_fpath, read2_fpath, dict_bc_id2seq, outdir,
+            start_umi=start_umi, start_bc=start_bc,
+            len_umi=len_umi, len_bc=len_bc, len_tx=len_tx,
+            bc_qual_min=bc_qual_min,
+            is_gzip=is_gzip,
+            save_unknown_bc_fastq=save_unknown_bc_fastq,
+            tagging_only=tagging_only,
+            tag_to=tag_to,
+            batch_size=batch_size,
+            decompress=decompress,
+            decompress_threads=decompress_threads,
+            bc_mismatch=bc_mismatch,
+            write_buffer=write_buffer,
+            max_open_files=max_open_files,
+            compress=compress,
+            compress_threads=compress_threads,
+            verbose=verbose))
+    if engine != 'line':
+        raise ValueError('Unknown demultiplexing engine: {}'.format(engine))
+
     if is_gzip:
-        fh_umibc = filehandle_fastq_gz(read1_fpath)
-        fh_tx = filehandle_fastq_gz(read2_fpath)
+        fh_umibc = filehandle_fastq_gz(read1_fpath, backend=decompress,
+                                       threads=decompress_threads)
+        fh_tx = filehandle_fastq_gz(read2_fpath, backend=decompress,
+                                    threads=decompress_threads)
     else:
         fh_umibc = open(read1_fpath, 'rt')
         fh_tx = open(read2_fpath, 'rt')
 
     sample_counter = Counter()
 
-    bc_fhout = dict()
-    for bc_id, bc_seq in dict_bc_id2seq.items():
-        # bc_id = '[{}]'.format('-'.join(map(str, bc_id)))
-        bc_fhout[bc_seq] = join_path(outdir,
-                                     'BC-{}-{}.fastq'.format(bc_id, bc_seq))
-    mkfolder(join_path(outdir, 'UNKNOWN'))
-    bc_fhout['UNKNOWNBC_R1'] = join_path(outdir, 'UNKNOWN',
-                                         'UNKNOWNBC_R1.fq')
-    bc_fhout['UNKNOWNBC_R2'] = join_path(outdir, 'UNKNOWN',
-                                         'UNKNOWNBC_R2.fq')
+    bc_fhout, unknown_fpaths = _batch_layout(dict_bc_id2seq, outdir,
+                                             tagging_only, tag_to, compress)
+    fhout_pool = BufferedWriterPool(
+        _layout_fpaths(bc_fhout, unknown_fpaths),
+        memory_budget=write_buffer, max_open=max_open_files,
+        compress=compress, threads=compress_threads)
+    bc_fhout = {bc_seq.decode(): v for bc_seq, v in bc_fhout.items()}
+    bc_fhout['UNKNOWNBC_R1'], bc_fhout['UNKNOWNBC_R2'] = unknown_fpaths
 
-    if tagging_only:
-        out_fpath_tagged_fq = join_path(outdir, tag_to)
-        out_fh_tagged_fq = open(out_fpath_tagged_fq, 'w')
-
-    for bc_seq, v in bc_fhout.items():
-        if bc_seq.startswith('UNKNOWN'):
-            bc_fhout[bc_seq] = open(v, 'w')
-            continue
-        if tagging_only:
-            bc_fhout[bc_seq] = out_fh_tagged_fq
-        else:
-            bc_fhout[bc_seq] = open(v, 'w')
+    umibc_idx = _umibc_index(start_umi, len_umi, start_bc, len_bc)
+    if bc_mismatch > 0:
+        bc_correct, bc_ambiguous = bc_correction_index(
+            dict_bc_id2seq.values(), bc_mismatch)
 
     i = 0
     while(True):
@@ -152,9 +272,6 @@ def demultiplexing(read1_fpath, read2_fpath, dict_bc_id2seq,
 
         sample_counter['total'] += 1
 
-        umibc_idx = sorted(list(set(range(start_umi, start_umi + len_umi)) |
-                                set(range(start_bc, start_bc + len_bc))))
-
         if len(umibc_seq) < len(umibc_idx):
             continue
 
@@ -167,16 +284,24 @@ def demultiplexing(read1_fpath, read2_fpath, dict_bc_id2seq,
 
         umi = umibc_seq[start_umi:(start_umi + len_umi)]
         cell_bc = umibc_seq[start_bc:(start_bc + len_bc)]
+        if bc_mismatch > 0:
+            bc_parent = bc_correct.get(cell_bc, None)
+            if bc_parent is None:
+                if cell_bc in bc_ambiguous:
+                    sample_counter['ambiguous'] += 1
+            elif bc_parent != cell_bc:
+                sample_counter['corrected'] += 1
+                cell_bc = bc_parent
         try:
             fhout = bc_fhout[cell_bc]
         except KeyError:
             if save_unknown_bc_fastq:
                 fhout = bc_fhout['UNKNOWNBC_R1']
-                fhout.write('{}\n{}\n{}\n{}\n'.format(umibc_name, umibc_seq,
-                                                      "+", umibc_qualstr))
+                fhout_pool.write(fhout, '{}\n{}\n{}\n{}\n'.format(
+                    umibc_name, umibc_seq, "+", umibc_qualstr).encode())
                 fhout = bc_fhout['UNKNOWNBC_R2']
-                fhout.write('{}\n{}\n{}\n{}\n'.format(tx_name, tx_seq,
-                                                      "+", tx_qualstr))
+                fhout_pool.write(fhout, '{}\n{}\n{}\n{}\n'.format(
+                    tx_name, tx_seq, "+", tx_qualstr).encode())
             sample_counter['unknown'] += 1
             continue
 
@@ -185,22 +310,448 @@ def demultiplexing(read1_fpath, read2_fpath, dict_bc_id2seq,
         if len(tx_seq) > len_tx:
             tx_seq, tx_qualstr = tx_seq[:len_tx], tx_qualstr[:len_tx]
         read_name = '@BC-{}_UMI-{}'.format(cell_bc, umi)
-        fhout.write('{}\n{}\n{}\n{}\n'.format(read_name, tx_seq,
-                                              "+", tx_qualstr))
+        fhout_pool.write(fhout, '{}\n{}\n{}\n{}\n'.format(
+            read_name, tx_seq, "+", tx_qualstr).encode())
         sample_counter[cell_bc] += 1
         sample_counter['saved'] += 1
 
     sample_counter['unqualified'] = sample_counter['total'] - \
         sample_counter['qualified']
-    for _, v in bc_fhout.items():
-        v.close()
+    fhout_pool.close()
+    fh_umibc.close()
+    fh_tx.close()
+
+    return(sample_counter)
+
+
+def _umibc_index(start_umi, len_umi, start_bc, len_bc):
+    """ Positions on R1 covered by UMI and cell barcode, sorted. """
+    return(sorted(list(set(range(start_umi, start_umi + len_umi)) |
+                       set(range(start_bc, start_bc + len_bc)))))
+
+
+def _qualified_mask(umibc_seqs, umibc_quals, umibc_idx, bc_qual_min):
+    """
+    Quality check of one batch of R1 reads.
+
+    Fixed-width R1 reads are checked at once with NumPy. Otherwise each read
+    goes through the same test as the line-by-line engine.
+    """
+    widths = set(map(len, umibc_quals))
+    if len(widths) == 1 and set(map(len, umibc_seqs)) == widths:
+        width = widths.pop()
+        if width < len(umibc_idx):
+            return(np.zeros(len(umibc_seqs), dtype=bool), None)
+        if width > umibc_idx[-1]:
+            qual_mat = fixed_width_matrix(umibc_quals, width)
+            mask = min_quality(qual_mat, umibc_idx) >= bc_qual_min
+            return(mask, width)
+
+    mask = np.zeros(len(umibc_seqs), dtype=bool)
+    for j, (seq, qual) in enumerate(zip(umibc_seqs, umibc_quals)):
+        if len(seq) < len(umibc_idx):
+            continue
+        mask[j] = min((qual[k] - 33 for k in umibc_idx)) >= bc_qual_min
+    return(mask, None)
+
+
+def _open_read_pair(read1_fpath, read2_fpath, is_gzip,
+                    decompress='auto', decompress_threads=1):
+    """ Binary file handles of R1 and R2. """
+    if is_gzip:
+        return((filehandle_fastq_gz(read1_fpath, binary=True,
+                                    backend=decompress,
+                                    threads=decompress_threads),
+                filehandle_fastq_gz(read2_fpath, binary=True,
+                                    backend=decompress,
+                                    threads=decompress_threads)))
+    return((open(read1_fpath, 'rb'), open(read2_fpath, 'rb')))
+
+
+def _batch_layout(dict_bc_id2seq, outdir, tagging_only, tag_to,
+                  compress=None):
+    """
+    Output file path of every barcode (bytes) and of the unknown R1/R2.
+    Compressed outputs are named with a '.gz' suffix.
+    """
+    ext = '.gz' if compress else ''
+    mkfolder(join_path(outdir, 'UNKNOWN'))
+    unknown_fpaths = (join_path(outdir, 'UNKNOWN', 'UNKNOWNBC_R1.fq' + ext),
+                      join_path(outdir, 'UNKNOWN', 'UNKNOWNBC_R2.fq' + ext))
+    bc_fpath = dict()
+    for bc_id, bc_seq in dict_bc_id2seq.items():
+        bc_fpath[bc_seq.encode()] = join_path(
+            outdir, 'BC-{}-{}.fastq{}'.format(bc_id, bc_seq, ext))
+    if tagging_only:
+        out_fpath_tagged_fq = join_path(outdir, tag_to)
+        if compress and not tag_to.endswith('.gz') and \
+                not is_stream(out_fpath_tagged_fq):
+            out_fpath_tagged_fq += '.gz'
+        bc_fpath = {k: out_fpath_tagged_fq for k in bc_fpath}
+    return((bc_fpath, unknown_fpaths))
+
+
+def _layout_fpaths(bc_fpath, unknown_fpaths):
+    """ Unique output file paths in a stable order. """
+    return(list(dict.fromkeys(list(bc_fpath.values()) +
+                              list(unknown_fpaths))))
+
+
+def _classify_batch(r1, r2, bc_fpath, unknown_fpaths, opts):
+    """
+    Quality-filter one batch of read pairs and assign them to output files.
+
+    Returns (chunks, counter). chunks is dict(fpath -> bytes) keeping the
+    order of reads. counter holds the keys of demultiplexing() except
+    'unqualified'.
+    """
+    umibc_names, umibc_seqs, umibc_quals = r1
+    tx_names, tx_seqs, tx_quals = r2
+    start_umi, len_umi = opts['start_umi'], opts['len_umi']
+    start_bc, len_bc = opts['start_bc'], opts['len_bc']
+    len_tx = opts['len_tx']
+
+    counter = Counter()
+    counter['total'] = len(umibc_seqs)
+    mask, width = _qualified_mask(umibc_seqs, umibc_quals,
+                                  opts['umibc_idx'], opts['bc_qual_min'])
+    kept = np.flatnonzero(mask).tolist()
+    counter['qualified'] = len(kept)
+    if not kept:
+        return((dict(), +counter))
+
+    if width is not None:
+        seq_mat = fixed_width_matrix(umibc_seqs, width)[mask]
+        umis = slice_columns(seq_mat, start_umi, len_umi)
+        cell_bcs = slice_columns(seq_mat, start_bc, len_bc)
+    else:
+        umis = [umibc_seqs[j][start_umi:(start_umi + len_umi)]
+                for j in kept]
+        cell_bcs = [umibc_seqs[j][start_bc:(start_bc + len_bc)]
+                    for j in kept]
+
+    read_fmt = b'@BC-%s_UMI-%s\n%s\n+\n%s\n'
+    unknown_fmt = b'%s\n%s\n+\n%s\n'
+    bc_correct = opts['bc_correct']
+    bc_ambiguous = opts['bc_ambiguous']
+    chunks = dict()
+    saved_bcs = []
+    unknown_r1, unknown_r2 = [], []
+    for j, umi, cell_bc in zip(kept, umis, cell_bcs):
+        if bc_correct is not None:
+            bc_parent = bc_correct.get(cell_bc, None)
+            if bc_parent is None:
+                if cell_bc in bc_ambiguous:
+                    counter['ambiguous'] += 1
+            elif bc_parent != cell_bc:
+                counter['corrected'] += 1
+                cell_bc = bc_parent
+        fpath = bc_fpath.get(cell_bc, None)
+        if fpath is None:
+            if opts['save_unknown_bc_fastq']:
+                unknown_r1.append(unknown_fmt % (
+                    umibc_names[j], umibc_seqs[j], umibc_quals[j]))
+                unknown_r2.append(unknown_fmt % (
+                    tx_names[j], tx_seqs[j], tx_quals[j]))
+            continue
+        chunk = chunks.get(fpath, None)
+        if chunk is None:
+            chunk = chunks[fpath] = []
+        chunk.append(read_fmt % (cell_bc, umi,
+                                 tx_seqs[j][:len_tx], tx_quals[j][:len_tx]))
+        saved_bcs.append(cell_bc)
+
+    chunks = {fpath: b''.join(chunk) for fpath, chunk in chunks.items()}
+    if unknown_r1:
+        chunks[unknown_fpaths[0]] = b''.join(unknown_r1)
+        chunks[unknown_fpaths[1]] = b''.join(unknown_r2)
+
+    counter['unknown'] = len(kept) - len(saved_bcs)
+    counter['saved'] = len(saved_bcs)
+    for cell_bc, n in Counter(saved_bcs).items():
+        counter[cell_bc.decode()] = n
+    return((chunks, +counter))
+
+
+def _batch_options(start_umi, start_bc, len_umi, len_bc, len_tx,
+                   bc_qual_min, save_unknown_bc_fastq,
+                   dict_bc_id2seq=None, bc_mismatch=0):
+    bc_correct, bc_ambiguous = None, None
+    if bc_mismatch > 0:
+        index, ambiguous = bc_correction_index(dict_bc_id2seq.values(),
+                                               bc_mismatch)
+        bc_correct = {k.encode(): v.encode() for k, v in index.items()}
+        bc_ambiguous = {k.encode() for k in ambiguous}
+    return(dict(umibc_idx=_umibc_index(start_umi, len_umi, start_bc, len_bc),
+                start_umi=start_umi, len_umi=len_umi,
+                start_bc=start_bc, len_bc=len_bc,
+                len_tx=len_tx,
+                bc_qual_min=bc_qual_min,
+                save_unknown_bc_fastq=save_unknown_bc_fastq,
+                bc_correct=bc_correct,
+                bc_ambiguous=bc_ambiguous))
+
+
+def _demultiplexing_batch(read1_fpath, read2_fpath, dict_bc_id2seq, outdir,
+                          start_umi=0, start_bc=6,
+                          len_umi=6, len_bc=6, len_tx=35,
+                          bc_qual_min=10,
+                          is_gzip=True,
+                          save_unknown_bc_fastq=False,
+                          tagging_only=False,
+                          tag_to='tagged.fastq',
+                          batch_size=100000,
+                          decompress='auto',
+                          decompress_threads=1,
+                          bc_mismatch=0,
+                          write_buffer=2**26,
+                          max_open_files=None,
+                          compress=None,
+                          compress_threads=1,
+                          verbose=False):
+    """
+    Batched engine of demultiplexing(). See demultiplexing().
+    """
+    fh_umibc, fh_tx = _open_read_pair(read1_fpath, read2_fpath, is_gzip,
+                                       decompress, decompress_threads)
+    bc_fpath, unknown_fpaths = _batch_layout(dict_bc_id2seq, outdir,
+                                             tagging_only, tag_to, compress)
+    fhout = BufferedWriterPool(_layout_fpaths(bc_fpath, unknown_fpaths),
+                               memory_budget=write_buffer,
+                               max_open=max_open_files,
+                               compress=compress,
+                               threads=compress_threads)
+    opts = _batch_options(start_umi, start_bc, len_umi, len_bc, len_tx,
+                          bc_qual_min, save_unknown_bc_fastq,
+                          dict_bc_id2seq, bc_mismatch)
+
+    sample_counter = Counter()
+    i = 0
+    for r1, r2 in paired_batches(fh_umibc, fh_tx, batch_size=batch_size):
+        if verbose and (i + len(r1[0])) // 1000000 > i // 1000000:
+            print_logger('Processing {:,} reads...'.format(i))
+        i += len(r1[0])
+
+        chunks, counter = _classify_batch(r1, r2, bc_fpath, unknown_fpaths,
+                                          opts)
+        for fpath, chunk in chunks.items():
+            fhout.write(fpath, chunk)
+        sample_counter += counter
+
+    sample_counter['unqualified'] = sample_counter['total'] - \
+        sample_counter['qualified']
+
+    fhout.close()
+    fh_umibc.close()
+    fh_tx.close()
+
+    return(sample_counter)
+
+
+def _check_alive(procs):
+    for p in procs:
+        if p.exitcode not in (None, 0):
+            for q in procs:
+                q.terminate()
+            raise RuntimeError(
+                'Demultiplexing process {} exited with code {}'.format(
+                    p.name, p.exitcode))
+
+
+def _put_alive(q, item, procs):
+    while True:
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            _check_alive(procs)
+
+
+def _get_alive(q, procs):
+    while True:
+        try:
+            return(q.get(timeout=1))
+        except queue.Empty:
+            _check_alive(procs)
+
+
+def _acquire_alive(sem, procs):
+    while not sem.acquire(timeout=1):
+        _check_alive(procs)
+
+
+def _demultiplex_worker(task_q, writer_qs, result_q,
+                        bc_fpath, unknown_fpaths, owner, opts):
+    """
+    Classify batches by barcode and hand the chunks to the owning writers.
+    """
+    counter = Counter()
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        batch_no, r1, r2 = task
+        chunks, batch_counter = _classify_batch(r1, r2, bc_fpath,
+                                                unknown_fpaths, opts)
+        counter += batch_counter
+        shards = [dict() for _ in writer_qs]
+        for fpath, chunk in chunks.items():
+            shards[owner[fpath]][fpath] = chunk
+        for q, shard in zip(writer_qs, shards):
+            q.put((batch_no, shard))
+    for q in writer_qs:
+        q.put(None)
+    result_q.put(counter)
+
+
+def _demultiplex_writer(writer_q, window, fpaths, num_workers,
+                        write_buffer=2**26, max_open_files=None,
+                        compress=None, compress_threads=1):
+    """
+    Own a set of output files and write their chunks in batch order.
+
+    A slot of the semaphore <window> is released for every batch written, so
+    the batches held back to restore the order are as many as its slots.
+    """
+    fhout = BufferedWriterPool(fpaths, memory_budget=write_buffer,
+                               max_open=max_open_files,
+                               compress=compress, threads=compress_threads)
+    pending = dict()
+    next_batch = 0
+    done = 0
+    while done < num_workers:
+        msg = writer_q.get()
+        if msg is None:
+            done += 1
+            continue
+        batch_no, shard = msg
+        pending[batch_no] = shard
+        while next_batch in pending:
+            for fpath, chunk in pending.pop(next_batch).items():
+                fhout.write(fpath, chunk)
+            next_batch += 1
+            window.release()
+    fhout.close()
+
+
+def _demultiplexing_sharded(read1_fpath, read2_fpath, dict_bc_id2seq, outdir,
+                            start_umi=0, start_bc=6,
+                            len_umi=6, len_bc=6, len_tx=35,
+                            bc_qual_min=10,
+                            is_gzip=True,
+                            save_unknown_bc_fastq=False,
+                            tagging_only=False,
+                            tag_to='tagged.fastq',
+                            batch_size=100000,
+                            processes=2,
+                            writers=None,
+                            decompress='auto',
+                            decompress_threads=1,
+                            bc_mismatch=0,
+                            write_buffer=2**26,
+                            max_open_files=None,
+                            compress=None,
+                            compress_threads=1,
+                            verbose=False):
+    """
+    Batched engine of demultiplexing() fanned out to worker processes.
+
+    The calling process reads batches of read pairs. <processes> workers
+    classify them by barcode, and <writers> writer processes own disjoint
+    sets of output files. Writers put the chunks back in batch order, so the
+    output is the same as the serial engines. Batches are read at most
+    4 * <processes> ahead of the last one every writer has written, which
+    bounds the queues and the batches writers hold back.
+    """
+    bc_fpath, unknown_fpaths = _batch_layout(dict_bc_id2seq, outdir,
+                                             tagging_only, tag_to, compress)
+    fpaths = _layout_fpaths(bc_fpath, unknown_fpaths)
+    opts = _batch_options(start_umi, start_bc, len_umi, len_bc, len_tx,
+                          bc_qual_min, save_unknown_bc_fastq,
+                          dict_bc_id2seq, bc_mismatch)
+
+    if not writers:
+        writers = max(1, processes // 2)
+    writers = min(writers, len(fpaths))
+    owner = {fpath: k % writers for k, fpath in enumerate(fpaths)}
+
+    task_q = multiprocessing.Queue(maxsize=2 * processes)
+    writer_qs = [multiprocessing.Queue(maxsize=2 * processes)
+                 for _ in range(writers)]
+    windows = [multiprocessing.Semaphore(4 * processes)
+               for _ in range(writers)]
+    result_q = multiprocessing.Queue()
+
+    procs = []
+    for k in range(writers):
+        procs.append(multiprocessing.Process(
+            target=_demultiplex_writer,
+            name='demultiplex-writer-{}'.format(k),
+            args=(writer_qs[k],
+                  windows[k],
+                  [f for f in fpaths if owner[f] == k],
+                  processes,
+                  write_buffer // writers,
+                  max_open_files,
+                  compress,
+                  compress_threads)))
+    for k in range(processes):
+        procs.append(multiprocessing.Process(
+            target=_demultiplex_worker,
+            name='demultiplex-worker-{}'.format(k),
+            args=(task_q, writer_qs, result_q,
+                  bc_fpath, unknown_fpaths, owner, opts)))
+    for p in procs:
+        p.start()
+
+    # The inputs are opened once all processes are forked: the threads
+    # inflating them must not be running at fork time.
+    try:
+        fh_umibc, fh_tx = _open_read_pair(read1_fpath, read2_fpath, is_gzip,
+                                           decompress, decompress_threads)
+    except BaseException:
+        for p in procs:
+            p.terminate()
+            p.join()
+        raise
+
+    i = 0
+    batches = paired_batches(fh_umibc, fh_tx, batch_size=batch_size)
+    for batch_no, (r1, r2) in enumerate(batches):
+        if verbose and (i + len(r1[0])) // 1000000 > i // 1000000:
+            print_logger('Processing {:,} reads...'.format(i))
+        i += len(r1[0])
+        for window in windows:
+            _acquire_alive(window, procs)
+        _put_alive(task_q, (batch_no, r1, r2), procs)
+    for _ in range(processes):
+        _put_alive(task_q, None, procs)
     fh_umibc.close()
     fh_tx.close()
 
+    sample_counter = Counter()
+    for _ in range(processes):
+        sample_counter += _get_alive(result_q, procs)
+    for p in procs:
+        p.join()
+    _check_alive(procs)
+
+    sample_counter['unqualified'] = sample_counter['total'] - \
+        sample_counter['qualified']
+
     return(sample_counter)
 
 
-def write_demultiplexing(stats, dict_bc_id2seq, stats_fpath):
+DEMULTIPLEXING_OVERALL_STATS = ('saved', 'unknown', 'corrected', 'ambiguous',
+                                'qualified', 'unqualified', 'total')
+
+
+def write_demultiplexing(stats, dict_bc_id2seq, stats_fpath,
+                         bc_correction=False):
+    '''
+    Save the stats of demultiplexing() as csv. Reads of barcodes corrected
+    or left ambiguous are reported when <bc_correction> is True.
+    '''
     if stats_fpath is None:
         stats_fpath = 'demultiplexing.csv'
     try:
@@ -220,6 +771,13 @@ def write_demultiplexing(stats, dict_bc_id2seq, stats_fpath):
                                     stats['saved'] / stats['total'] * 100))
     fh_stats.write(formatter.format('unknown', stats['unknown'],
                                     stats['unknown'] / stats['total'] * 100))
+    if bc_correction:
+        fh_stats.write(formatter.format(
+            'corrected', stats['corrected'],
+            stats['corrected'] / stats['total'] * 100))
+        fh_stats.write(formatter.format(
+            'ambiguous', stats['ambiguous'],
+            stats['ambiguous'] / stats['total'] * 100))
     fh_stats.write(formatter.format('qualified', stats['qualified'],
                                     stats['qualified'] / stats['total'] * 100))
     fh_stats.write(formatter.format('unqualified', stats['unqualified'],
@@ -228,7 +786,9 @@ def write_demultiplexing(stats, dict_bc_id2seq, stats_fpath):
                                     stats['total'] / stats['total'] * 100))
 
 
-def plotly_demultiplexing_stats(fpaths=[], saveto='', fnames=[]):
+def plotly_demultiplexing_stats(fpaths=[], saveto='', fnames=[],
+                                webgl=False, max_points=None,
+                                plotlyjs=None):
     '''
     Save a plotly box graph with a list of demultiplexing stats files
 
@@ -240,6 +800,13 @@ def plotly_demultiplexing_stats(fpaths=[], saveto='', fnames=[]):
         File path to save the html file as the plotly box graph
     fnames : list
         A list of strings to label each ``fpaths``
+    webgl : bool
+        Draw the outliers of thinned boxes as WebGL. Default: False
+    max_points : int
+        Number of cells to draw at most per box, keeping the outliers, see
+        plotly_utils.box_traces(). Default: all
+    plotlyjs : str
+        plotly.js to refer to, see plotly_utils.save_html(). Default: inlined
 
     Returns
     -------
@@ -258,16 +825,18 @@ def plotly_demultiplexing_stats(fpaths=[], saveto='', fnames=[]):
         fname = fnames[i]
 
         stats = pd.read_csv(f, index_col=0)
-        cell_stats = stats.iloc[:-5, :]
-        # tail 5 lines are fixed as the overall stats
-        overall_stats = stats.iloc[-5:, :]
-        num_reads_data.append(
-            go.Box(
-                y=cell_stats['Reads(#)'],
-                name='{} (#Saved={}/#Total={})'.format(
-                    fname,
-                    overall_stats.loc['saved', 'Reads(#)'],
-                    overall_stats.loc['total', 'Reads(#)'])))
+        # tail lines are the overall stats
+        is_overall = stats.index.isin(DEMULTIPLEXING_OVERALL_STATS)
+        cell_stats = stats.loc[~is_overall, :]
+        overall_stats = stats.loc[is_overall, :]
+        num_reads_data.extend(box_traces(
+            cell_stats['Reads(#)'],
+            name='{} (#Saved={}/#Total={})'.format(
+                fname,
+                overall_stats.loc['saved', 'Reads(#)'],
+                overall_stats.loc['total', 'Reads(#)']),
+            max_points=max_points, webgl=webgl,
+            color=DEFAULT_PLOTLY_COLORS[i % len(DEFAULT_PLOTLY_COLORS)]))
 
     layout = go.Layout(
         # legend=dict(x=-.1, y=-.2),
@@ -275,7 +844,7 @@ def plotly_demultiplexing_stats(fpaths=[], saveto='', fnames=[]):
         title='Number of reads saved per BC per item')
     fig = go.Figure(data=num_reads_data, layout=layout)
     try:
-        plot(fig, filename=saveto, auto_open=False)
+        save_html(fig, saveto, plotlyjs)
         return(True)
     except Exception as e:
         print(e, flush=True)
@@ -331,12 +900,68 @@ def main():
         '--tag-to',
         dest='tag_to', default='tagged.fastq',
         help=('File base name to save the tagged fastq file. '
-              'Only used when tagging_only.'))
+              'Only used when tagging_only. An absolute path to a named '
+              'pipe (FIFO) streams the reads to its reader, e.g. an '
+              'aligner.'))
+    parser.add_argument('--engine', type=str, default='line',
+                        choices=['line', 'batch'],
+                        help=('Engine parsing reads: line-by-line or in '
+                              'batches of records (default: line)'))
+    parser.add_argument('--batch-size', metavar='N', type=int, default=100000,
+                        help=('Number of read pairs per batch. '
+                              'Only used by --engine batch. (default=100000)'))
+    parser.add_argument('--processes', metavar='N', type=int, default=1,
+                        help=('Number of worker processes classifying reads. '
+                              'More than 1 implies --engine batch. '
+                              '(default=1)'))
+    parser.add_argument('--writers', metavar='N', type=int, default=None,
+                        help=('Number of processes writing the output files '
+                              'when --processes > 1. '
+                              '(default: half of --processes)'))
+    parser.add_argument('--decompress', type=str, default='auto',
+                        choices=BACKENDS,
+                        help=('Backend inflating gzipped reads '
+                              '(default: auto)'))
+    parser.add_argument('--decompress-threads', metavar='N', type=int,
+                        default=1,
+                        help=('Threads inflating BGZF-compressed reads '
+                              '(default=1)'))
+    parser.add_argument('--bc-mismatch', metavar='N', type=int, default=0,
+                        choices=[0, 1, 2],
+                        help=('Correct cell barcodes within N mismatches of '
+                              'exactly one closest barcode (default=0)'))
+    parser.add_argument('--write-buffer-mb', metavar='N', type=int, default=64,
+                        help=('Memory (MB) buffering reads for all output '
+                              'files (default=64)'))
+    parser.add_argument('--max-open-files', metavar='N', type=int,
+                        default=None,
+                        help=('Maximum of simultaneously open output files '
+                              '(default: under the file descriptor limit)'))
+    parser.add_argument('--compress', type=str, default='none',
+                        choices=['none', 'gzip', 'bgzf'],
+                        help=('Write gzip or BGZF compressed FASTQs, named '
+                              'with a .gz suffix (default: none)'))
+    parser.add_argument('--compress-threads', metavar='N', type=int,
+                        default=1,
+                        help=('Threads compressing the output FASTQs '
+                              '(default=1)'))
     parser.add_argument('--verbose', dest='verbose', action='store_true')
     parser.set_defaults(verbose=False)
 
     args = parser.parse_args()
 
+    # A FIFO --tag-to is opened before any other I/O and closed on every
+    # exit, so its reader (e.g. an aligner) never waits for a writer that
+    # failed early, but gets EOF.
+    tag_to_fpath = join_path(args.out_dir, args.tag_to)
+    if args.tagging_only and is_stream(tag_to_fpath):
+        with open(tag_to_fpath, 'wb'):
+            _main(args)
+    else:
+        _main(args)
+
+
+def _main(args):
     bc_dict = bc_dict_id2seq(args.bc_index, args.bc_seq_column)
 
     bc_index_used = str2int(args.bc_index_used)
@@ -359,10 +984,23 @@ def main():
                          tag_to=args.tag_to,
                          do_bc_rev_complement=False,
                          do_tx_rev_complement=False,
+                         engine=args.engine,
+                         batch_size=args.batch_size,
+                         processes=args.processes,
+                         writers=args.writers,
+                         decompress=args.decompress,
+                         decompress_threads=args.decompress_threads,
+                         bc_mismatch=args.bc_mismatch,
+                         write_buffer=args.write_buffer_mb * 2**20,
+                         max_open_files=args.max_open_files,
+                         compress=(None if args.compress == 'none'
+                                   else args.compress),
+                         compress_threads=args.compress_threads,
                          verbose=args.verbose)
     print_logger('Demultiplexing ends {}--{}.'.format(args.read1_fpath,
                                                       args.read2_fpath))
-    write_demultiplexing(out, bc_dict, args.stats_file)
+    write_demultiplexing(out, bc_dict, args.stats_file,
+                         bc_correction=args.bc_mismatch > 0)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,17 @@
 
 import pysam
 
+import os
+import queue
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from celseq2.helper import print_logger
 from celseq2.helper import join_path
 from celseq2.demultiplex import bc_dict_id2seq, str2int
+from celseq2.buffered_writer import BufferedWriterPool
+from celseq2.buffered_writer import max_open_files as open_files_limit
 
 
 def _cell_seq (name, length=6):
@@ -18,28 +24,154 @@ def _cell_seq (name, length=6):
     return(out)
 
 
-def demultiplex_sam (samfile, outdir, bc_length):
+class SamWriterPool(object):
+    '''
+    One SAM (or BAM) file of alignments per cell, with the header of the
+    input AlignmentFile <samobj>.
+
+    SAM text is written through a BufferedWriterPool. BAM files are written
+    by pysam writers without thread pools of their own: the first half of
+    the <max_open_files> cells each get such a writer, and the alignments of
+    further cells are kept as SAM text in a BufferedWriterPool of the other
+    half, then written to BAM by pysam one cell at a time when the pool is
+    closed. With <threads> > 1, the cells are spread over that many threads
+    which write (and compress) their alignments, so a pool never runs more
+    than <threads> compressing threads.
+    '''
+
+    # alignments handed to a writing thread at a time
+    batch_size = 1024
+
+    def __init__(self, samobj, fpaths, write_buffer=2**26,
+                 max_open_files=None, output_format='sam', threads=1):
+        if output_format not in ('sam', 'bam'):
+            raise ValueError('Unknown output format: {}'.format(
+                output_format))
+        limit = max_open_files if max_open_files else open_files_limit()
+        self.samobj = samobj
+        self.output_format = output_format
+        self.threads = max(1, threads)
+        self.header = str(samobj.header).encode()
+        self._max_bam = max(1, limit // 2) if output_format == 'bam' else 0
+        # fpath -> (pysam writer, index of its writing thread)
+        self._bam = dict()
+        self._spilled = dict()
+        self._pool = BufferedWriterPool(
+            [], memory_budget=write_buffer,
+            max_open=max(1, limit - self._max_bam))
+        self._error = None
+        self._workers = []
+        self._batches = []
+        if output_format == 'bam' and self.threads > 1:
+            for _ in range(self.threads):
+                q = queue.Queue(maxsize=4)
+                t = threading.Thread(target=self._write_batches, args=(q,),
+                                     daemon=True)
+                t.start()
+                self._workers.append((q, t))
+                self._batches.append([])
+        for fpath in fpaths:
+            self.add(fpath)
+
+    def _write_batches(self, q):
+        # pysam writes without the GIL, so threads compress in parallel
+        while True:
+            batch = q.get()
+            if batch is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                for fh, aln in batch:
+                    fh.write(aln)
+            except Exception as e:
+                self._error = e
+
+    def _hand_over(self, k):
+        q, _ = self._workers[k]
+        q.put(self._batches[k])
+        self._batches[k] = []
+
+    def add(self, fpath):
+        ''' Create the output file <fpath> of a cell. '''
+        if self.output_format == 'sam':
+            self._pool.add(fpath, header=self.header)
+        elif len(self._bam) < self._max_bam:
+            self._bam[fpath] = (
+                pysam.AlignmentFile(fpath, 'wb', template=self.samobj),
+                len(self._bam) % self.threads)
+        else:
+            self._spilled[fpath] = fpath + '.sam.tmp'
+            self._pool.add(self._spilled[fpath], header=self.header)
+
+    def write(self, fpath, aln):
+        ''' Write AlignedSegment <aln> to the output file <fpath>. '''
+        if fpath in self._bam:
+            fh, k = self._bam[fpath]
+            if not self._workers:
+                fh.write(aln)
+                return
+            self._batches[k].append((fh, aln))
+            if len(self._batches[k]) >= self.batch_size:
+                self._hand_over(k)
+        else:
+            self._pool.write(self._spilled.get(fpath, fpath),
+                             aln.to_string().encode() + b'\n')
+
+    def _spilled_to_bam(self, fpath):
+        spilled = self._spilled[fpath]
+        with pysam.AlignmentFile(spilled, 'r') as fin, \
+                pysam.AlignmentFile(fpath, 'wb', template=fin) as fout:
+            for aln in fin:
+                fout.write(aln)
+        os.remove(spilled)
+
+    def close(self):
+        for k, (q, _) in enumerate(self._workers):
+            self._hand_over(k)
+            q.put(None)
+        for _, t in self._workers:
+            t.join()
+        for fh, _ in self._bam.values():
+            fh.close()
+        self._pool.close()
+        if self._error is not None:
+            raise self._error
+        with ThreadPoolExecutor(self.threads) as executor:
+            list(executor.map(self._spilled_to_bam, list(self._spilled)))
+
+
+def demultiplex_sam (samfile, outdir, bc_length,
+                     write_buffer=2**26, max_open_files=None,
+                     output_format='sam', threads=1):
+    '''
+    Split alignments to one SAM (or BAM with <output_format> 'bam') file per
+    cell barcode found in the read names.
+    '''
     if not samfile:
         return
     samobj = pysam.AlignmentFile(samfile, 'rb')
 
     dict_samout = {}
+    pool = SamWriterPool(samobj, [], write_buffer, max_open_files,
+                         output_format, threads)
 
     for aln in samobj:
         bc = _cell_seq(aln.query_name, length=bc_length)
-        fh = dict_samout.get(bc, None)
-        if not fh:
-            outsam = join_path(outdir, bc + '.sam')
-            fh = pysam.AlignmentFile(outsam, 'w', template=samobj)
-            dict_samout[bc] = fh
+        outsam = dict_samout.get(bc, None)
+        if not outsam:
+            outsam = join_path(outdir, bc + '.' + output_format)
+            pool.add(outsam)
+            dict_samout[bc] = outsam
 
-        fh.write(aln)
+        pool.write(outsam, aln)
 
-    for _, fh in dict_samout.items():
-        fh.close()
+    pool.close()
 
 
-def demultiplex_sam_with_claim (samfile, outdir, bc_length, claimed_bc):
+def demultiplex_sam_with_claim (samfile, outdir, bc_length, claimed_bc,
+                                write_buffer=2**26, max_open_files=None,
+                                output_format='sam', threads=1):
     if not samfile:
         return
     if not claimed_bc:
@@ -49,20 +181,18 @@ def demultiplex_sam_with_claim (samfile, outdir, bc_length, claimed_bc):
 
     dict_samout = {}
     for bc in claimed_bc:
-        fh = pysam.AlignmentFile(
-            join_path(outdir, bc + '.sam'),
-            'w', template=samobj)
-        dict_samout[bc] = fh
+        dict_samout[bc] = join_path(outdir, bc + '.' + output_format)
+    pool = SamWriterPool(samobj, list(dict_samout.values()),
+                         write_buffer, max_open_files, output_format, threads)
 
     for aln in samobj:
         bc = _cell_seq(aln.query_name, length=bc_length)
-        fh = dict_samout.get(bc, None)
-        if not fh:
+        outsam = dict_samout.get(bc, None)
+        if not outsam:
             continue
-        fh.write(aln)
+        pool.write(outsam, aln)
 
-    for _, fh in dict_samout.items():
-        fh.close()
+    pool.close()
 
 
 def main():
@@ -85,6 +215,21 @@ def main():
     parser.add_argument('--bc-index-used', type=str, metavar='string',
                         default='1-96',
                         help='Index of used barcode IDs (default=1-96)')
+    parser.add_argument('--write-buffer-mb', type=int, metavar='N',
+                        default=64,
+                        help=('Memory (MB) buffering alignments for all '
+                              'output files (default=64)'))
+    parser.add_argument('--max-open-files', type=int, metavar='N',
+                        default=None,
+                        help=('Maximum of simultaneously open output files '
+                              '(default: under the file descriptor limit)'))
+    parser.add_argument('--output-format', type=str, default='sam',
+                        choices=['sam', 'bam'],
+                        help=('Save the demultiplexed alignments as SAM or '
+                              'BAM (default: sam)'))
+    parser.add_argument('--threads', type=int, metavar='N', default=1,
+                        help=('Threads writing and compressing the BAM '
+                              'outputs (default=1)'))
 
     args = parser.parse_args()
 
@@ -97,12 +242,20 @@ def main():
             samfile=args.sbam,
             outdir=args.savetodir,
             bc_length=args.bc_length,
-            claimed_bc=bc_seq_used)
+            claimed_bc=bc_seq_used,
+            write_buffer=args.write_buffer_mb * 2**20,
+            max_open_files=args.max_open_files,
+            output_format=args.output_format,
+            threads=args.threads)
     else:
         demultiplex_sam(
             samfile=args.sbam,
             outdir=args.savetodir,
-            bc_length=args.bc_length)
+            bc_length=args.bc_length,
+            write_buffer=args.write_buffer_mb * 2**20,
+            max_open_files=args.max_open_files,
+            output_format=args.output_format,
+            threads=args.threads)
 
     print_logger('Demultiplexing SAM/BAM ends. See: {}'.format(args.savetodir))
 
@@ -2,10 +2,13 @@
 import argparse
 from .helper import print_logger
 from .helper import filehandle_fastq_gz
+from .decompress import BACKENDS
+from .demultiplex import bc_correction_index
 from collections import Counter
 
 
-def get_dict_bc_has_reads(r1, bc_index, bc_seq_col):
+def get_dict_bc_has_reads(r1, bc_index, bc_seq_col, decompress='auto',
+                          bc_mismatch=0):
     print(r1)
     with open(bc_index, 'rt') as fin:
         # next(fin)
@@ -17,7 +20,14 @@ def get_dict_bc_has_reads(r1, bc_index, bc_seq_col):
     res = Counter({bc: 0 for bc in known_bc})
 
     bc_len = len(next(iter(res)))
-    fh_r1 = filehandle_fastq_gz(r1) if r1.endswith('.gz') else open(r1, 'r')
+    if bc_mismatch > 0:
+        bc_correct, bc_ambiguous = bc_correction_index(known_bc, bc_mismatch)
+        res['corrected'] = 0
+        res['ambiguous'] = 0
+    if r1.endswith('.gz'):
+        fh_r1 = filehandle_fastq_gz(r1, backend=decompress)
+    else:
+        fh_r1 = open(r1, 'r')
     i = 0
     while True:
         if i % 1000000 == 0:
@@ -33,8 +43,13 @@ def get_dict_bc_has_reads(r1, bc_index, bc_seq_col):
                 continue
             if r1_bc in known_bc:
                 res[r1_bc] += 1
+            elif bc_mismatch > 0 and r1_bc in bc_correct:
+                res[bc_correct[r1_bc]] += 1
+                res['corrected'] += 1
             else:
                 res['unknown'] += 1
+                if bc_mismatch > 0 and r1_bc in bc_ambiguous:
+                    res['ambiguous'] += 1
 
         except StopIteration:
             break
@@ -56,6 +71,13 @@ def main():
     parser.add_argument(
         '--r1', metavar='FILENAME', type=str,
         help=('File path to R1.'))
+    parser.add_argument(
+        '--decompress', type=str, default='auto', choices=BACKENDS,
+        help=('Backend inflating gzipped R1. Default: auto.'))
+    parser.add_argument(
+        '--bc-mismatch', metavar='N', default=0, type=int, choices=[0, 1, 2],
+        help=('Correct cell barcodes within N mismatches of exactly one '
+              'closest barcode. Default: 0.'))
     parser.add_argument(
         '-o', '--output',
         metavar='FILENAME', type=str,
@@ -67,22 +89,27 @@ def main():
     if args.r1 and args.bc_index:
         counter_bc_size = get_dict_bc_has_reads(args.r1,
                                                 args.bc_index,
-                                                args.bc_seq_col)
+                                                args.bc_seq_col,
+                                                decompress=args.decompress,
+                                                bc_mismatch=args.bc_mismatch)
         fhout = open(args.output, 'w')
-        tot = sum([counter_bc_size[x] for x in counter_bc_size])
+        # corrected and ambiguous reads are already counted as bc or unknown
+        not_bc = ('unknown', 'corrected', 'ambiguous')
+        tot = sum([counter_bc_size[x] for x in counter_bc_size
+                   if x not in not_bc[1:]])
         bc_size_max, bc_size_min = float('-inf'), float('inf')
 
         for bc in counter_bc_size:
-            if bc != 'unknown' and counter_bc_size[bc] > bc_size_max:
+            if bc not in not_bc and counter_bc_size[bc] > bc_size_max:
                 bc_size_max = counter_bc_size[bc]
-            if bc != 'unknown' and counter_bc_size[bc] < bc_size_min:
+            if bc not in not_bc and counter_bc_size[bc] < bc_size_min:
                 bc_size_min = counter_bc_size[bc]
             fhout.write('{:>{}}\t{:,}\t{:06.2f}\n'.format(
                 bc, 20,
                 counter_bc_size[bc], counter_bc_size[bc] * 100 / tot))
 
         valid_bc_size_val = [counter_bc_size[x]
-                             for x in counter_bc_size if x != 'unknown']
+                             for x in counter_bc_size if x not in not_bc]
         bc_size_avg = sum([x / len(valid_bc_size_val)
                            for x in valid_bc_size_val])
         fhout.write('{:>{}}\t{:,}\t{:06.2f}\n'.format(
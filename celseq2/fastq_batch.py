@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Block-batched reading of 4-line FASTQ files.
+
+Records are pulled out of large byte blocks and split in bulk, so the
+per-read Python work of the demultiplexing loop is reduced to the parts that
+really depend on the read.
+'''
+import numpy as np
+
+
+# Whitespace at the end of a line, which is stripped like str.rstrip()
+_TRAILING_SPACES = (b'\r\n', b' \n', b'\t\n', b'\x0b\n', b'\x0c\n')
+
+
+class FastqBatchReader(object):
+    '''
+    Read a binary file handle of 4-line FASTQ in batches of records.
+
+    Parameters
+    ----------
+    fh : file object
+        Opened in binary mode.
+    block_size : int
+        Number of bytes requested from ``fh`` at once.
+    '''
+
+    def __init__(self, fh, block_size=2**22):
+        self.fh = fh
+        self.block_size = block_size
+        self._lines = []
+        self._pos = 0
+        self._tail = b''
+        self._eof = False
+
+    def _fill(self, num_lines):
+        while len(self._lines) - self._pos < num_lines and not self._eof:
+            block = self.fh.read(self.block_size)
+            if not block:
+                self._eof = True
+                if self._tail:
+                    self._lines.append(self._tail.rstrip())
+                    self._tail = b''
+                break
+            block = self._tail + block
+            lines = block.split(b'\n')
+            self._tail = lines.pop()
+            if any(x in block for x in _TRAILING_SPACES):
+                lines = [x.rstrip() for x in lines]
+            self._lines = self._lines[self._pos:] + lines
+            self._pos = 0
+
+    def read(self, num_records):
+        '''
+        Return (names, seqs, quals) of at most ``num_records`` records.
+
+        An incomplete record at the end of the file is dropped. Empty lists
+        mean the end of file.
+        '''
+        self._fill(4 * num_records)
+        end = self._pos + 4 * num_records
+        chunk = self._lines[self._pos:end]
+        self._pos += len(chunk)
+        complete = len(chunk) - len(chunk) % 4
+        if complete != len(chunk):
+            chunk = chunk[:complete]
+        return((chunk[0::4], chunk[1::4], chunk[3::4]))
+
+
+def paired_batches(fh_r1, fh_r2, batch_size=100000, block_size=2**22):
+    '''
+    Yield batches of mate pairs as ((names, seqs, quals), (names, seqs, quals)).
+
+    Reading stops at the end of the shorter mate, like the line-by-line loop.
+    '''
+    r1 = FastqBatchReader(fh_r1, block_size=block_size)
+    r2 = FastqBatchReader(fh_r2, block_size=block_size)
+    while True:
+        b1 = r1.read(batch_size)
+        if not b1[0]:
+            break
+        b2 = r2.read(len(b1[0]))
+        n = len(b2[0])
+        if n == 0:
+            break
+        if n < len(b1[0]):
+            b1 = tuple(x[:n] for x in b1)
+        yield((b1, b2))
+        if n < batch_size:
+            break
+
+
+def fixed_width_matrix(strs, width):
+    '''
+    Stack byte strings of identical ``width`` into an (n, width) uint8 array.
+    '''
+    return(np.frombuffer(b''.join(strs), dtype=np.uint8).reshape(-1, width))
+
+
+def slice_columns(mat, start, length):
+    '''
+    Cut columns [start, start + length) out of a uint8 matrix as bytes.
+    '''
+    if length == 0:
+        return([b''] * mat.shape[0])
+    sub = np.ascontiguousarray(mat[:, start:start + length])
+    return(sub.view('S{}'.format(length)).ravel().tolist())
+
+
+def min_quality(qual_mat, idx, offset=33):
+    '''
+    Minimal Phred score of every read at positions ``idx``.
+    '''
+    return(qual_mat[:, idx].min(axis=1).astype(np.int16) - offset)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Compact index of annotated features for counting.
+
+For every chromosome and strand, the genome is cut into steps at the
+boundaries of the features. Step k covers [breakpoints[k], breakpoints[k+1])
+and carries the integer id of the set of genes overlapping it, so that looking
+up the genes of many aligned blocks is a couple of ``searchsorted`` calls.
+
+It replaces the HTSeq.GenomicArrayOfSets lookup and gives the same union-model
+assignment: an alignment is counted for a gene only if the union of the gene
+sets of all steps overlapped by its blocks has exactly one gene.
+
+An index can be saved as a directory of flat .npy arrays and a JSON table of
+genes and chromosomes, which is loaded memory-mapped. A loaded index pickles
+as a reference to its directory.
+'''
+import os
+import json
+import multiprocessing
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+NO_FEATURE = -1
+AMBIGUOUS = -2
+
+_INT_MIN = np.iinfo(np.int64).min
+
+# Version of the layout written by FeatureIndex.save()
+FORMAT_VERSION = 1
+_META = 'meta.json'
+_ARRAYS = ('breakpoints', 'ids', 'offsets', 'set_genes', 'set_offsets',
+           'single_gene')
+
+
+def _build_steps(task):
+    '''
+    Steps of the features of one chromosome and strand, given as arrays of
+    (starts, ends, gene ids).
+
+    Returns
+    -------
+    tuple
+        (breakpoints, ids, gene_sets) where ids index the tuples of gene ids
+        in gene_sets, set 0 being the empty set.
+    '''
+    starts, ends, genes = task
+    events = defaultdict(list)
+    for start, end, gene in zip(starts.tolist(), ends.tolist(),
+                                genes.tolist()):
+        events[start].append((gene, 1))
+        events[end].append((gene, -1))
+    set_id = {(): 0}
+    gene_sets = [()]
+    active = Counter()
+    breakpoints = [_INT_MIN]
+    ids = [0]
+    for pos in sorted(events):
+        for g, delta in events[pos]:
+            active[g] += delta
+            if not active[g]:
+                del active[g]
+        gset = tuple(sorted(active))
+        if gset not in set_id:
+            set_id[gset] = len(gene_sets)
+            gene_sets.append(gset)
+        if set_id[gset] == ids[-1]:
+            continue
+        breakpoints.append(pos)
+        ids.append(set_id[gset])
+    return((np.array(breakpoints, dtype=np.int64),
+            np.array(ids, dtype=np.int32), gene_sets))
+
+
+class FeatureIndex(object):
+    '''
+    Per-chromosome, per-strand sorted breakpoints with gene-set ids.
+
+    Parameters
+    ----------
+    intervals : iterable
+        (chrom, start, end, strand, gene) with 0-based half-open coordinates.
+    stranded : bool
+        Whether features of the two strands are told apart. Strands are
+        ignored otherwise.
+    processes : int
+        Processes building the steps of chromosomes (and strands) in
+        parallel. The index is the same for any number of processes.
+
+    Attributes
+    ----------
+    genes : tuple
+        Sorted gene names. Genes are referred to by their index in it.
+    gene_sets : list
+        Tuple of gene ids of every gene-set id. Set 0 is the empty set.
+    path : str
+        Directory the index was loaded from, or None.
+    '''
+
+    def __init__(self, intervals, stranded=True, processes=1):
+        self.path = None
+        self.stranded = stranded
+        by_key = defaultdict(list)
+        for chrom, start, end, strand, gene in intervals:
+            by_key[(chrom, self._strand(strand))].append((start, end, gene))
+
+        self.genes = tuple(sorted(set(
+            x[2] for v in by_key.values() for x in v)))
+        gene_id = {g: i for i, g in enumerate(self.genes)}
+
+        tasks = [(np.array([x[0] for x in ivs], dtype=np.int64),
+                  np.array([x[1] for x in ivs], dtype=np.int64),
+                  np.array([gene_id[x[2]] for x in ivs], dtype=np.int64))
+                 for ivs in by_key.values()]
+        if processes > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(processes, len(tasks))) as p:
+                steps = p.map(_build_steps, tasks, chunksize=1)
+        else:
+            steps = [_build_steps(x) for x in tasks]
+
+        # gene sets of the chromosomes are numbered in the order of the keys
+        set_id = {(): 0}
+        self._gene_sets = [()]
+        self.chroms = set()
+        self._steps = dict()
+        for key, (breakpoints, ids, gene_sets) in zip(by_key, steps):
+            self.chroms.add(key[0])
+            remap = np.zeros(len(gene_sets), dtype=np.int32)
+            for k, gset in enumerate(gene_sets):
+                if gset not in set_id:
+                    set_id[gset] = len(self._gene_sets)
+                    self._gene_sets.append(gset)
+                remap[k] = set_id[gset]
+            self._steps[key] = (breakpoints, remap[ids])
+
+        # gene of every gene set of size 1, AMBIGUOUS for larger sets
+        self.single_gene = np.array(
+            [NO_FEATURE if not x else (x[0] if len(x) == 1 else AMBIGUOUS)
+             for x in self.gene_sets], dtype=np.int64)
+
+    def __reduce__(self):
+        if self.path is None:
+            return(super().__reduce__())
+        return(FeatureIndex.load, (self.path,))
+
+    def __setstate__(self, state):
+        # indexes pickled before they could be saved
+        if 'gene_sets' in state:
+            state['_gene_sets'] = state.pop('gene_sets')
+        state.setdefault('path', None)
+        self.__dict__.update(state)
+
+    def save(self, fpath):
+        '''
+        Save the index as flat arrays in directory <fpath>, which is created.
+        '''
+        os.makedirs(fpath, exist_ok=True)
+        keys = sorted(self._steps)
+        arrays = dict(
+            breakpoints=np.concatenate(
+                [self._steps[k][0] for k in keys] or
+                [np.zeros(0, dtype=np.int64)]),
+            ids=np.concatenate([self._steps[k][1] for k in keys] or
+                               [np.zeros(0, dtype=np.int32)]),
+            offsets=np.cumsum([0] + [len(self._steps[k][0]) for k in keys],
+                              dtype=np.int64),
+            set_genes=np.array([g for x in self.gene_sets for g in x],
+                               dtype=np.int64),
+            set_offsets=np.cumsum([0] + [len(x) for x in self.gene_sets],
+                                  dtype=np.int64),
+            single_gene=self.single_gene)
+        for name in _ARRAYS:
+            np.save(os.path.join(fpath, name + '.npy'), arrays[name])
+        meta = dict(version=FORMAT_VERSION, stranded=self.stranded,
+                    genes=list(self.genes), keys=keys)
+        with open(os.path.join(fpath, _META), 'w') as fh:
+            json.dump(meta, fh)
+
+    @classmethod
+    def load(cls, fpath, mmap=True):
+        '''
+        Index saved by save() in directory <fpath>, memory-mapped unless
+        <mmap> is False.
+        '''
+        with open(os.path.join(fpath, _META)) as fh:
+            meta = json.load(fh)
+        if meta.get('version', None) != FORMAT_VERSION:
+            raise ValueError('Unsupported feature index format: '
+                             '{}'.format(fpath))
+        arrays = {name: np.load(os.path.join(fpath, name + '.npy'),
+                                mmap_mode='r' if mmap else None)
+                  for name in _ARRAYS}
+        self = cls.__new__(cls)
+        self.path = os.path.abspath(fpath)
+        self.stranded = meta['stranded']
+        self.genes = tuple(meta['genes'])
+        self._set_genes = arrays['set_genes']
+        self._set_offsets = arrays['set_offsets']
+        self._gene_sets = None
+        self.single_gene = arrays['single_gene']
+        self._steps = dict()
+        offsets = arrays['offsets'].tolist()
+        for k, (chrom, strand) in enumerate(meta['keys']):
+            lo, hi = offsets[k], offsets[k + 1]
+            self._steps[(chrom, strand)] = (arrays['breakpoints'][lo:hi],
+                                            arrays['ids'][lo:hi])
+        self.chroms = set(k[0] for k in self._steps)
+        return(self)
+
+    @property
+    def gene_sets(self):
+        if self._gene_sets is None:
+            genes = self._set_genes.tolist()
+            offsets = self._set_offsets.tolist()
+            self._gene_sets = [tuple(genes[offsets[k]:offsets[k + 1]])
+                               for k in range(len(offsets) - 1)]
+        return(self._gene_sets)
+
+    def _strand(self, strand):
+        if not self.stranded:
+            return('.')
+        if strand not in ('+', '-'):
+            raise ValueError('Illegal strand of stranded feature: '
+                             '{}'.format(strand))
+        return(strand)
+
+    def __contains__(self, chrom):
+        return(chrom in self.chroms)
+
+    def steps(self, chrom, strand, start, end):
+        '''
+        (start, end, genes) of the steps overlapping [start, end), like
+        GenomicArrayOfSets[iv].steps(). Steps outside any feature are listed
+        with an empty gene set.
+        '''
+        breakpoints, ids = self._steps.get((chrom, self._strand(strand)),
+                                           (np.array([_INT_MIN]),
+                                            np.array([0])))
+        lo = np.searchsorted(breakpoints, start, side='right') - 1
+        hi = np.searchsorted(breakpoints, end, side='left')
+        out = []
+        for k in range(lo, hi):
+            s = max(start, breakpoints[k])
+            e = end if k + 1 >= len(breakpoints) else \
+                min(end, breakpoints[k + 1])
+            out.append((int(s), int(e),
+                        set(self.genes[g] for g in self.gene_sets[ids[k]])))
+        return(out)
+
+    def assign(self, chroms, strands, starts, ends, aln, n_aln):
+        '''
+        Union-model gene of alignments from their aligned blocks.
+
+        Parameters
+        ----------
+        chroms, strands : sequence
+            Chromosome and strand of every block.
+        starts, ends : array-like
+            0-based half-open coordinates of every block.
+        aln : array-like
+            Index (0 to n_aln - 1) of the alignment of every block.
+        n_aln : int
+            Number of alignments.
+
+        Returns
+        -------
+        numpy.ndarray
+            Gene id of every alignment, NO_FEATURE or AMBIGUOUS.
+        '''
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        aln = np.asarray(aln, dtype=np.int64)
+
+        keys = dict()
+        codes = np.array([keys.setdefault((c, self._strand(s)), len(keys))
+                          for c, s in zip(chroms, strands)], dtype=np.int64)
+        step_aln = []
+        step_gene = []
+        for key, code in keys.items():
+            if key not in self._steps:
+                continue
+            breakpoints, ids = self._steps[key]
+            sel = np.flatnonzero(codes == code)
+            lo = np.searchsorted(breakpoints, starts[sel], side='right') - 1
+            hi = np.searchsorted(breakpoints, ends[sel], side='left')
+            nstep = np.maximum(hi - lo, 0)
+            # index of every step overlapped by the blocks
+            first = np.repeat(lo - np.cumsum(nstep) + nstep, nstep)
+            k = first + np.arange(nstep.sum())
+            step_aln.append(np.repeat(aln[sel], nstep))
+            step_gene.append(self.single_gene[ids[k]])
+
+        out = np.full(n_aln, NO_FEATURE, dtype=np.int64)
+        if not step_aln:
+            return(out)
+        step_aln = np.concatenate(step_aln)
+        step_gene = np.concatenate(step_gene)
+        hit = step_gene != NO_FEATURE
+        step_aln, step_gene = step_aln[hit], step_gene[hit]
+
+        # one gene if the smallest and largest gene of the union agree
+        lowest = np.full(n_aln, np.iinfo(np.int64).max, dtype=np.int64)
+        highest = np.full(n_aln, np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(lowest, step_aln, step_gene)
+        np.maximum.at(highest, step_aln, step_gene)
+        found = np.bincount(step_aln, minlength=n_aln) > 0
+        out[found] = np.where(lowest[found] == highest[found],
+                              lowest[found], AMBIGUOUS)
+        return(out)
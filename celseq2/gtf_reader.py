@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Chunked, vectorised reader of GTF/GFF annotations.
+
+The file is read by pandas in chunks of lines. Records of other feature types
+are dropped before any attribute is parsed, and the wanted attributes are
+pulled out of the remaining records with vectorised regular expressions, in
+GTF (key "value";) as well as GFF3 (key=value;) syntax.
+'''
+import re
+import csv
+
+import numpy as np
+import pandas as pd
+
+from celseq2.decompress import open_gz
+
+
+GTF_COLUMNS = ('chrom', 'source', 'type', 'start', 'end', 'score', 'strand',
+               'frame', 'attributes')
+# Attributes telling the type of genes, in Ensembl and GENCODE annotations
+BIOTYPE_ATTRS = ('gene_biotype', 'gene_type')
+
+
+def _attr_pattern(key):
+    return(r'(?:^|;)\s*{}[ =]"?([^";]*)"?'.format(re.escape(key)))
+
+
+def read_gtf(fpath, feature_type='exon',
+             attributes=('gene_id', 'gene_name', 'gene_biotype'),
+             chunksize=2**18):
+    '''
+    Records of <feature_type> in a GTF/GFF file, which may be gzipped.
+
+    Parameters
+    ----------
+    fpath : str
+        File path to GTF/GFF(.gz).
+    feature_type : str
+        Type of records (3rd column) to keep, e.g. exon.
+    attributes : iterable
+        Attributes to pull out of the 9th column.
+    chunksize : int
+        Lines read at once.
+
+    Returns
+    -------
+    pandas.DataFrame
+        chrom, start (0-based), end, strand and one column per attribute,
+        which is missing (NaN) for records without it.
+    '''
+    attributes = list(attributes)
+    fh = open_gz(fpath) if fpath.endswith('.gz') else open(fpath, 'rb')
+    chunks = []
+    try:
+        reader = pd.read_csv(fh, sep='\t', header=None, comment='#',
+                             names=GTF_COLUMNS, usecols=[0, 2, 3, 4, 6, 8],
+                             dtype={'chrom': str, 'type': str,
+                                    'start': np.int64, 'end': np.int64,
+                                    'strand': str, 'attributes': str},
+                             quoting=csv.QUOTE_NONE, chunksize=chunksize)
+        for chunk in reader:
+            chunk = chunk[chunk['type'] == feature_type]
+            if chunk.empty:
+                continue
+            out = pd.DataFrame({'chrom': chunk['chrom'],
+                                'start': chunk['start'] - 1,
+                                'end': chunk['end'],
+                                'strand': chunk['strand']})
+            for key in attributes:
+                out[key] = chunk['attributes'].str.extract(
+                    _attr_pattern(key), expand=False).str.strip()
+            chunks.append(out)
+    finally:
+        fh.close()
+    if not chunks:
+        return(pd.DataFrame(columns=['chrom', 'start', 'end', 'strand'] +
+                            attributes))
+    return(pd.concat(chunks, ignore_index=True))
+
+
+def biotypes(records):
+    '''
+    Type of gene of every record of read_gtf(), from the first of
+    BIOTYPE_ATTRS it has.
+    '''
+    out = pd.Series(np.nan, index=records.index, dtype=object)
+    for key in BIOTYPE_ATTRS:
+        if key in records:
+            out = out.fillna(records[key])
+    return(out)
+
+
+def gene_table(records, feature_atrr='gene_name'):
+    '''
+    One row per value of <feature_atrr> of the records of read_gtf(), with
+    the span of its records and its type.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by gene, sorted, with chromosome, start, end, strand and
+        biotype (of the first record), and gene_id/gene_name if available.
+    '''
+    records = records[records[feature_atrr].notna()].assign(
+        biotype=biotypes(records))
+    agg = dict(chromosome=('chrom', 'first'), start=('start', 'min'),
+               end=('end', 'max'), strand=('strand', 'first'),
+               biotype=('biotype', 'first'))
+    for key in ('gene_id', 'gene_name'):
+        if key in records and key != feature_atrr:
+            agg[key] = (key, 'first')
+    out = records.groupby(feature_atrr, sort=True).agg(**agg)
+    out.index.name = feature_atrr
+    return(out)
@@ -13,6 +13,8 @@ import pandas as pd
 # import yaml
 import hashlib
 
+from celseq2.decompress import open_gz
+
 
 def join_path(*args):
     x = map(str, args)
@@ -115,12 +117,18 @@ def popen_communicate(cmd):
     return(pout)
 
 
-def filehandle_fastq_gz(fpath):
+def filehandle_fastq_gz(fpath, binary=False, backend='auto', threads=1):
+    '''
+    File handle of the inflated content of a gzipped fastq.
+
+    See celseq2.decompress for the backends. Text mode by default.
+    '''
     # pout = popen_communicate('zcat {}'.format(fpath))
     # fh = io.BytesIO(pout)
-    p = subprocess.Popen('gunzip -c {}'.format(fpath),
-                         shell=True, stdout=subprocess.PIPE)
-    fh = io.TextIOWrapper(p.stdout, encoding='ascii')
+    fh = open_gz(fpath, backend=backend, threads=threads)
+    if binary:
+        return(fh)
+    fh = io.TextIOWrapper(fh, encoding='ascii')
     return(fh)
 
 
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Per-item molecule store: one HDF5 file holding the counted molecules and
+alignment stats of all cells of an item, instead of three pickles per cell.
+
+Layout:
+
+- /genes, /cells: names, in the order they were first appended.
+- /molecules/{cell,gene,umi,reads}: one row per (cell, gene, UMI)
+  molecule, as columns of ids into /cells and /genes, the UMI code of
+  encode_umis() and the number of reads.
+- /aln_stats/cell, /aln_stats/counts, /aln_stats/metrics: one row per cell
+  appended, with its counts of ALN_STATS and its METRICS, taken when it is
+  appended.
+
+Columns are extendable and compressed, so cells are appended in batches, and
+read back by one sequential scan. Writers of several processes append to one
+store in turn, under an exclusive lock of <store>.lock.
+'''
+import os
+import fcntl
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+from celseq2.molecules import Molecules, molecule_keys
+from celseq2.cell_metrics import ALN_STATS, METRICS
+from celseq2.cell_metrics import cell_metrics, metrics_table
+
+
+_COLUMNS = (('cell', np.int32), ('gene', np.int32), ('umi', np.int64),
+            ('reads', np.int64))
+
+
+@contextmanager
+def _locked(fpath):
+    # exclusive lock of fpath shared by processes through a lock file
+    with open(fpath + '.lock', 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _names(h5, key):
+    return([x.decode('utf-8') for x in h5.get_node('/', key)])
+
+
+class MoleculeStore(object):
+    '''
+    Molecules and alignment stats of the cells of an item, saved in the HDF5
+    file <fpath>.
+
+    Parameters
+    ----------
+    fpath : str
+        File path of the store. It is created by the first append().
+    len_umi : int
+        Length of UMIs. Read from the store if not given.
+    '''
+
+    def __init__(self, fpath, len_umi=None):
+        self.fpath = fpath
+        self.len_umi = len_umi
+
+    def _create(self, h5, len_umi):
+        import tables
+
+        filters = tables.Filters(complevel=4, complib='zlib')
+        h5.root._v_attrs.len_umi = len_umi
+        for key in ('genes', 'cells'):
+            h5.create_vlarray('/', key, tables.VLStringAtom(),
+                              filters=filters)
+        grp = h5.create_group('/', 'molecules')
+        for key, dtype in _COLUMNS:
+            h5.create_earray(grp, key, tables.Atom.from_dtype(
+                np.dtype(dtype)), shape=(0,), filters=filters,
+                expectedrows=2**20)
+        grp = h5.create_group('/', 'aln_stats')
+        h5.create_earray(grp, 'cell', tables.Int32Atom(), shape=(0,),
+                         filters=filters)
+        h5.create_earray(grp, 'counts', tables.Int64Atom(),
+                         shape=(0, len(ALN_STATS)), filters=filters)
+        h5.create_earray(grp, 'metrics', tables.Int64Atom(),
+                         shape=(0, len(METRICS)), filters=filters)
+
+    def append(self, counts):
+        '''
+        Append cells to the store.
+
+        Parameters
+        ----------
+        counts : dict
+            Cell -> (umi_vec, Molecules, aln_cnt) as count_umi_by_cell()
+            gives with molecules=True.
+        '''
+        import tables
+
+        with _locked(self.fpath):
+            with tables.open_file(self.fpath, 'a') as h5:
+                if '/molecules' not in h5:
+                    len_umi = self.len_umi
+                    if len_umi is None:
+                        len_umi = next((x[1].len_umi for x in counts.values()
+                                        if len(x[1])), 0)
+                    self._create(h5, len_umi)
+                len_umi = int(h5.root._v_attrs.len_umi)
+                ids = {}
+                for key in ('genes', 'cells'):
+                    vocab = _names(h5, key)
+                    ids[key] = {x: i for i, x in enumerate(vocab)}
+
+                def lookup(key, names):
+                    table = ids[key]
+                    for x in names:
+                        if x not in table:
+                            table[x] = len(table)
+                            h5.get_node('/', key).append(x.encode('utf-8'))
+                    return(np.array([table[x] for x in names],
+                                    dtype=np.int64))
+
+                cols = {key: [] for key, _ in _COLUMNS}
+                cell_ids = lookup('cells', list(counts))
+                stats = np.zeros((len(counts), len(ALN_STATS)),
+                                 dtype=np.int64)
+                metrics = np.zeros((len(counts), len(METRICS)),
+                                   dtype=np.int64)
+                for j, (_, mol, aln_cnt) in enumerate(counts.values()):
+                    if len(mol) and mol.len_umi != len_umi:
+                        raise ValueError('Molecules of different UMI '
+                                         'lengths.')
+                    stats[j] = [aln_cnt.get(x, 0) for x in ALN_STATS]
+                    cell_cnt = cell_metrics(mol.counts())
+                    metrics[j] = [cell_cnt[x] for x in METRICS]
+                    genes = lookup('genes', list(mol.genes))
+                    cols['cell'].append(np.full(len(mol), cell_ids[j]))
+                    cols['gene'].append(genes[mol.gene_ids])
+                    cols['umi'].append(mol.umi_codes)
+                    cols['reads'].append(mol.reads)
+                for key, dtype in _COLUMNS:
+                    if cols[key]:
+                        h5.get_node('/molecules', key).append(
+                            np.concatenate(cols[key]).astype(dtype))
+                h5.root.aln_stats.cell.append(cell_ids.astype(np.int32))
+                h5.root.aln_stats.counts.append(stats)
+                h5.root.aln_stats.metrics.append(metrics)
+
+    def cells(self):
+        ''' Cells of the store, in the order they were first appended. '''
+        import tables
+
+        with tables.open_file(self.fpath, 'r') as h5:
+            return(_names(h5, 'cells'))
+
+    def molecules(self):
+        '''
+        Dict of cell -> Molecules of every cell in the store, read by one
+        scan. Molecules of a cell appended more than once are merged.
+        '''
+        import tables
+
+        with tables.open_file(self.fpath, 'r') as h5:
+            cells = _names(h5, 'cells')
+            genes = _names(h5, 'genes')
+            len_umi = int(h5.root._v_attrs.len_umi)
+            cols = {key: h5.get_node('/molecules', key)[:]
+                    for key, _ in _COLUMNS}
+        order = np.argsort(cols['cell'], kind='stable')
+        cell, gene = cols['cell'][order], cols['gene'][order]
+        umi, reads = cols['umi'][order], cols['reads'][order]
+        bounds = np.searchsorted(cell, np.arange(len(cells) + 1))
+        # rank of every gene among the genes sorted by name
+        rank = np.empty(len(genes), dtype=np.int64)
+        rank[np.argsort(genes, kind='stable')] = np.arange(len(genes))
+        by_rank = sorted(genes)
+        out = {}
+        for j, name in enumerate(cells):
+            lo, hi = bounds[j], bounds[j + 1]
+            used, local = np.unique(rank[gene[lo:hi]], return_inverse=True)
+            keys = molecule_keys(local.ravel(), umi[lo:hi], len_umi)
+            keys, inverse = np.unique(keys, return_inverse=True)
+            n = np.bincount(inverse.ravel(), weights=reads[lo:hi],
+                            minlength=len(keys))
+            out[name] = Molecules(keys, tuple(by_rank[x] for x in used),
+                                  len_umi, n.astype(np.int64))
+        return(out)
+
+    def aln_stats(self):
+        '''
+        Dict of cell -> Counter of ALN_STATS. Stats of a cell appended more
+        than once are summed.
+        '''
+        import tables
+
+        with tables.open_file(self.fpath, 'r') as h5:
+            cells = _names(h5, 'cells')
+            cell = h5.root.aln_stats.cell[:]
+            counts = h5.root.aln_stats.counts[:]
+        out = {x: Counter() for x in cells}
+        for j, row in zip(cell.tolist(), counts.tolist()):
+            out[cells[j]].update({k: v for k, v in zip(ALN_STATS, row)
+                                  if v})
+        return(out)
+
+    def cell_metrics(self):
+        '''
+        Table of cells x (METRICS + ALN_STATS) of the cells in the store, see
+        celseq2.cell_metrics. Metrics of a cell appended more than once are
+        summed.
+        '''
+        import tables
+
+        with tables.open_file(self.fpath, 'r') as h5:
+            cells = _names(h5, 'cells')
+            cell = h5.root.aln_stats.cell[:]
+            counts = np.hstack([h5.root.aln_stats.metrics[:],
+                                h5.root.aln_stats.counts[:]])
+        columns = METRICS + ALN_STATS
+        records = {x: Counter() for x in cells}
+        for j, row in zip(cell.tolist(), counts.tolist()):
+            records[cells[j]].update(dict(zip(columns, row)))
+        return(metrics_table(records))
+
+    def signature(self):
+        '''
+        Signature of the sources of the store set by set_signature(), or None
+        if the store does not exist or has none.
+        '''
+        import tables
+
+        if not os.path.isfile(self.fpath):
+            return(None)
+        with tables.open_file(self.fpath, 'r') as h5:
+            return(getattr(h5.root._v_attrs, 'signature', None))
+
+    def set_signature(self, signature):
+        ''' Record the signature of the sources of the store. '''
+        import tables
+
+        with _locked(self.fpath):
+            with tables.open_file(self.fpath, 'a') as h5:
+                h5.root._v_attrs.signature = signature
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Integer-encoded molecules: (gene, UMI) pairs of a cell in one sorted array.
+
+A UMI is packed 2 bits per base (A=0, C=1, G=2, T=3). Bases N are flagged in
+a mask above the packed bases, so that UMIs with N stay distinct and can be
+decoded. A molecule is then the integer (gene << 3 * len_umi) | umi, and the
+molecules of a cell are deduplicated and merged with sort/unique instead of
+sets of strings. Such int64 keys hold genes indexed below
+2 ** (63 - 3 * len_umi), see molecule_keys().
+
+UMIs of a gene which differ by sequencing or PCR errors can be collapsed
+into one molecule by the network methods of UMI-tools (Smith et al., 2017):
+'adjacency' and 'directional'. Candidate pairs of UMIs within the edit
+(Hamming) distance are only sought among UMIs which share one of
+<distance> + 1 segments of bases, since two UMIs that differ at no more than
+<distance> positions must agree on at least one segment.
+'''
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+_BASES = 'ACGT'
+_N = 4
+_CODE = np.full(256, 255, dtype=np.uint8)
+for _i, _b in enumerate(_BASES):
+    _CODE[ord(_b)] = _i
+_CODE[ord('N')] = _N
+
+
+def encode_umis(umis, length):
+    '''
+    Pack UMI strings of identical <length> (at most 21) into int64 codes.
+    '''
+    if length > 21:
+        raise ValueError('UMIs longer than 21 bases cannot be encoded.')
+    umis = list(umis)
+    if not umis:
+        return(np.zeros(0, dtype=np.int64))
+    raw = ''.join(umis).encode('ascii')
+    if len(raw) != length * len(umis):
+        raise ValueError('UMIs are not all of length {}.'.format(length))
+    code = _CODE[np.frombuffer(raw, dtype=np.uint8).reshape(-1, length)]
+    if (code == 255).any():
+        raise ValueError('UMIs have bases other than A, C, G, T and N.')
+    code = code.astype(np.int64)
+    is_n = code == _N
+    code[is_n] = 0
+    shift = np.arange(length - 1, -1, -1, dtype=np.int64)
+    packed = (code << (2 * shift)).sum(axis=1)
+    mask = (is_n.astype(np.int64) << shift).sum(axis=1)
+    return(packed | (mask << (2 * length)))
+
+
+def valid_umis(umis, length):
+    '''
+    Boolean mask of the UMI strings <umis> which encode_umis() can encode:
+    of <length> and made of bases A, C, G, T and N only.
+    '''
+    umis = list(umis)
+    out = np.fromiter((len(u) == length for u in umis), dtype=bool,
+                      count=len(umis))
+    if out.any():
+        raw = ''.join(u for u, ok in zip(umis, out) if ok).encode(
+            'ascii', 'replace')
+        code = _CODE[np.frombuffer(raw, dtype=np.uint8).reshape(-1, length)]
+        out[out] = (code != 255).all(axis=1)
+    return(out)
+
+
+def molecule_keys(gene_ids, umi_codes, len_umi):
+    '''
+    int64 keys (gene << 3 * len_umi) | umi of molecules. Raises ValueError
+    if a gene index does not fit in the bits left by the UMIs.
+    '''
+    gene_ids = np.asarray(gene_ids, dtype=np.int64)
+    bits = 3 * len_umi
+    if len(gene_ids) and gene_ids.max() >= 1 << max(63 - bits, 0):
+        raise ValueError(
+            'Genes indexed up to {} do not fit in molecules of UMIs of '
+            'length {}.'.format(int(gene_ids.max()), len_umi))
+    return((gene_ids << bits) | umi_codes)
+
+
+def decode_umis(codes, length):
+    ''' UMI strings of codes given by encode_umis(). '''
+    codes = np.asarray(codes, dtype=np.int64)
+    shift = np.arange(length - 1, -1, -1, dtype=np.int64)
+    base = (codes[:, None] >> (2 * shift)) & 3
+    is_n = (codes[:, None] >> (2 * length + shift)) & 1
+    chars = np.frombuffer(b'ACGTN', dtype=np.uint8)[
+        np.where(is_n == 1, _N, base)]
+    return([x.decode('ascii') for x in
+            np.ascontiguousarray(chars).view('S{}'.format(length)).ravel()])
+
+
+UMI_COLLAPSE_METHODS = ('unique', 'adjacency', 'directional')
+
+# UMIs of a gene up to which all pairs are compared without segment buckets
+_PAIRWISE_MAX = 64
+
+
+def _symbols(codes, length):
+    # base of every position (0-3 for A/C/G/T, 4 for N), one row per UMI
+    shift = np.arange(length - 1, -1, -1, dtype=np.int64)
+    base = (codes[:, None] >> (2 * shift)) & 3
+    is_n = (codes[:, None] >> (2 * length + shift)) & 1
+    return(np.where(is_n == 1, _N, base))
+
+
+def umi_pairs(codes, length, distance=1):
+    '''
+    Pairs (i, j), i < j, of distinct UMI codes which differ at no more than
+    <distance> positions.
+
+    Pairs are only compared within buckets of UMIs sharing one of
+    <distance> + 1 segments, unless there are few UMIs.
+    '''
+    codes = np.asarray(codes, dtype=np.int64)
+    n = len(codes)
+    sym = _symbols(codes, length)
+    if n <= _PAIRWISE_MAX or distance + 1 > length:
+        i, j = np.triu_indices(n, 1)
+    else:
+        cand = [np.zeros((2, 0), dtype=np.int64)]
+        bounds = np.linspace(0, length, distance + 2).astype(int)
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            seg = (sym[:, lo:hi] * 5 ** np.arange(hi - lo)).sum(axis=1)
+            order = np.argsort(seg, kind='stable')
+            seg = seg[order]
+            # members of a bucket are adjacent once sorted by segment
+            for k in range(1, n):
+                same = seg[k:] == seg[:-k]
+                if not same.any():
+                    break
+                cand.append(np.stack([order[:-k][same], order[k:][same]]))
+        cand = np.concatenate(cand, axis=1)
+        pair = np.unique(np.minimum(cand[0], cand[1]) * n +
+                         np.maximum(cand[0], cand[1]))
+        i, j = pair // n, pair % n
+    close = (sym[i] != sym[j]).sum(axis=1) <= distance
+    return(i[close], j[close])
+
+
+def collapse_umis(codes, reads, length, method='directional', distance=1):
+    '''
+    Index of the UMI representing the molecule of every UMI of one gene.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        Distinct UMI codes given by encode_umis().
+    reads : numpy.ndarray
+        Number of reads of every UMI.
+    length : int
+        Length of UMIs.
+    method : str
+        One of UMI_COLLAPSE_METHODS, as in UMI-tools. 'unique' keeps every
+        UMI. 'adjacency' takes UMIs by decreasing reads until they and their
+        neighbours cover their connected component. 'directional' merges a
+        UMI b into a neighbour a if reads[a] >= 2 * reads[b] - 1.
+    distance : int
+        Maximum number of differing positions of neighbouring UMIs.
+
+    Returns
+    -------
+    numpy.ndarray
+        Representative of every UMI, itself if it is kept.
+    '''
+    if method not in UMI_COLLAPSE_METHODS:
+        raise ValueError('Unknown UMI collapsing method: {}'.format(method))
+    n = len(codes)
+    if method == 'unique' or n < 2:
+        return(np.arange(n))
+    reads = np.asarray(reads, dtype=np.int64)
+    i, j = umi_pairs(codes, length, distance)
+    src, dst = np.concatenate([i, j]), np.concatenate([j, i])
+    if method == 'directional':
+        keep = reads[src] >= 2 * reads[dst] - 1
+        src, dst = src[keep], dst[keep]
+    order = np.argsort(src, kind='stable')
+    dst = dst[order].tolist()
+    start = np.searchsorted(src[order], np.arange(n + 1)).tolist()
+    # most reads first, ties by UMI
+    nodes = np.lexsort((codes, -reads)).tolist()
+
+    rep = [-1] * n
+    if method == 'directional':
+        for root in nodes:
+            if rep[root] >= 0:
+                continue
+            rep[root] = root
+            queue = [root]
+            while queue:
+                x = queue.pop()
+                for y in dst[start[x]:start[x + 1]]:
+                    if rep[y] < 0:
+                        rep[y] = root
+                        queue.append(y)
+        return(np.array(rep, dtype=np.int64))
+
+    component = [-1] * n
+    members = []
+    for root in nodes:
+        if component[root] >= 0:
+            continue
+        component[root] = len(members)
+        queue = [root]
+        while queue:
+            x = queue.pop()
+            for y in dst[start[x]:start[x + 1]]:
+                if component[y] < 0:
+                    component[y] = len(members)
+                    queue.append(y)
+        members.append([])
+    for x in nodes:
+        members[component[x]].append(x)
+    for group in members:
+        covered = set()
+        picked = []
+        for x in group:
+            picked.append(x)
+            covered.add(x)
+            covered.update(dst[start[x]:start[x + 1]])
+            if len(covered) == len(group):
+                break
+        for x in picked:
+            rep[x] = x
+        for x in picked:
+            for y in dst[start[x]:start[x + 1]]:
+                if rep[y] < 0:
+                    rep[y] = x
+    return(np.array(rep, dtype=np.int64))
+
+
+class Molecules(object):
+    '''
+    Distinct (gene, UMI) molecules of a cell.
+
+    Parameters
+    ----------
+    keys : numpy.ndarray
+        Sorted unique int64 of (gene << 3 * len_umi) | umi, where gene indexes
+        <genes>.
+    genes : tuple
+        Sorted names of the genes with molecules.
+    len_umi : int
+        Length of UMIs.
+    reads : numpy.ndarray
+        Number of reads of every molecule. Defaults to 1 each.
+    '''
+
+    def __init__(self, keys, genes, len_umi, reads=None):
+        self.keys = keys
+        self.genes = genes
+        self.len_umi = len_umi
+        if reads is None:
+            reads = np.ones(len(keys), dtype=np.int64)
+        self.reads = reads
+
+    @property
+    def _bits(self):
+        return(3 * self.len_umi)
+
+    @classmethod
+    def from_codes(cls, gene_ids, umi_codes, genes, len_umi):
+        '''
+        Molecules of reads counted for gene_ids (indexing <genes>) with UMIs
+        encoded by encode_umis(). Duplicates are counted as reads of one
+        molecule.
+        '''
+        gene_ids = np.asarray(gene_ids, dtype=np.int64)
+        umi_codes = np.asarray(umi_codes, dtype=np.int64)
+        used, local = np.unique(gene_ids, return_inverse=True)
+        names = [genes[i] for i in used]
+        order = np.argsort(names, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        keys = molecule_keys(rank[local], umi_codes, len_umi)
+        keys, reads = np.unique(keys, return_counts=True)
+        return(cls(keys, tuple(names[i] for i in order), len_umi,
+                   reads.astype(np.int64)))
+
+    @classmethod
+    def from_umi_set(cls, umi_set, len_umi):
+        ''' Molecules of a dict(gene -> set(UMI)) as count_umi() gives. '''
+        genes = tuple(g for g in umi_set if umi_set[g])
+        gene_ids = np.repeat(np.arange(len(genes), dtype=np.int64),
+                             [len(umi_set[g]) for g in genes])
+        umis = [u for g in genes for u in umi_set[g]]
+        return(cls.from_codes(gene_ids, encode_umis(umis, len_umi), genes,
+                              len_umi))
+
+    @classmethod
+    def merge(cls, items):
+        ''' Union of the molecules of several Molecules of one cell. '''
+        items = list(items)
+        if not items:
+            raise ValueError('Nothing to merge.')
+        len_umi = items[0].len_umi
+        genes = tuple(sorted(set(g for x in items for g in x.genes)))
+        keys = []
+        for x in items:
+            if x.len_umi != len_umi:
+                raise ValueError('Molecules of different UMI lengths.')
+            remap = np.searchsorted(genes, x.genes).astype(np.int64)
+            keys.append(molecule_keys(remap[x.gene_ids], x.umi_codes,
+                                      len_umi))
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        reads = np.bincount(inverse.ravel(),
+                            weights=np.concatenate([x.reads for x in items]),
+                            minlength=len(keys))
+        return(cls(keys, genes, len_umi, reads.astype(np.int64)))
+
+    def collapse(self, method='directional', distance=1):
+        '''
+        Molecules after collapsing the UMIs of every gene by
+        collapse_umis(). Reads of collapsed UMIs go to their representative.
+        '''
+        if method == 'unique':
+            return(self)
+        gene_ids, umis = self.gene_ids, self.umi_codes
+        bounds = np.searchsorted(gene_ids, np.arange(len(self.genes) + 1))
+        rep = np.arange(len(self.keys))
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if hi - lo > 1:
+                rep[lo:hi] = lo + collapse_umis(umis[lo:hi],
+                                                self.reads[lo:hi],
+                                                self.len_umi, method,
+                                                distance)
+        kept = rep == np.arange(len(rep))
+        reads = np.bincount(rep, weights=self.reads, minlength=len(rep))
+        return(Molecules(self.keys[kept], self.genes, self.len_umi,
+                         reads[kept].astype(np.int64)))
+
+    @property
+    def gene_ids(self):
+        return(self.keys >> self._bits)
+
+    @property
+    def umi_codes(self):
+        return(self.keys & ((1 << self._bits) - 1))
+
+    def __len__(self):
+        return(len(self.keys))
+
+    def __eq__(self, other):
+        return(isinstance(other, Molecules) and
+               self.len_umi == other.len_umi and
+               self.genes == other.genes and
+               np.array_equal(self.keys, other.keys) and
+               np.array_equal(self.reads, other.reads))
+
+    def counts(self):
+        ''' Counter(gene -> number of UMIs), as count_umi() gives. '''
+        n = np.bincount(self.gene_ids, minlength=len(self.genes))
+        return(Counter({g: int(c) for g, c in zip(self.genes, n) if c}))
+
+    def umi_sets(self):
+        ''' defaultdict(gene -> set(UMI)), as count_umi() gives. '''
+        out = defaultdict(set)
+        umis = decode_umis(self.umi_codes, self.len_umi)
+        for g, u in zip(self.gene_ids.tolist(), umis):
+            out[self.genes[g]].add(u)
+        return(out)
+
+
+def as_molecules(umi_set, len_umi=None):
+    '''
+    Molecules of a per-cell UMI pickle, either Molecules or the former
+    dict(gene -> set(UMI)).
+    '''
+    if isinstance(umi_set, Molecules):
+        return(umi_set)
+    if len_umi is None:
+        len_umi = next((len(u) for v in umi_set.values() for u in v), 0)
+    return(Molecules.from_umi_set(umi_set, len_umi))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Helpers of the plotly QC and stats plots of many cells.
+
+- scatter_trace(): WebGL (Scattergl) instead of SVG scatter traces, which
+  browsers draw smoothly with tens of thousands of points.
+- thin_points(): subset of a large set of points to draw, which keeps the
+  points of sparse regions, i.e. the outliers.
+- box_traces(): box plot of many values drawn from a subset of them, with
+  every outlier.
+- save_html(): html files referring to one plotly.js bundle shared by all
+  plots of a project, instead of each inlining its own copy.
+'''
+import os
+
+import numpy as np
+import plotly.graph_objs as go
+from plotly.offline import plot, get_plotlyjs
+
+
+def scatter_trace(webgl=False, **kwargs):
+    ''' go.Scattergl of <kwargs> if <webgl>, otherwise go.Scatter. '''
+    if webgl:
+        return(go.Scattergl(**kwargs))
+    return(go.Scatter(**kwargs))
+
+
+def _bin_of(vals, bins):
+    # equal-width bin of every value, NaN/inf in a bin of their own
+    vals = np.asarray(vals, dtype=float)
+    finite = np.isfinite(vals)
+    out = np.full(len(vals), bins, dtype=np.int64)
+    if finite.any():
+        lo, hi = vals[finite].min(), vals[finite].max()
+        width = (hi - lo) / bins if hi > lo else 1.0
+        out[finite] = np.minimum(((vals[finite] - lo) / width).astype(
+            np.int64), bins - 1)
+    return(out)
+
+
+def thin_points(x, y, max_points=None, bins=64, seed=0):
+    '''
+    Indices of at most about <max_points> of the points (x, y) to draw.
+
+    Points are binned on a <bins> x <bins> grid and every bin keeps at most
+    the same number of random points, chosen as large as <max_points>
+    allows. Points of sparse bins, the outliers, are all kept, while dense
+    bins are thinned; at least one point of every bin is kept.
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted indices of the points kept, all of them if <max_points> is
+        None or not less than the number of points.
+    '''
+    n = len(x)
+    if max_points is None or n <= max_points:
+        return(np.arange(n))
+    cell = _bin_of(x, bins) * (bins + 1) + _bin_of(y, bins)
+    _, cell, counts = np.unique(cell, return_inverse=True,
+                                return_counts=True)
+    cell = cell.ravel()
+    # largest cap of points per bin keeping at most max_points in total
+    caps = np.unique(counts)
+    kept = np.array([np.minimum(counts, c).sum() for c in caps])
+    cap = caps[max(np.searchsorted(kept, max_points, side='right') - 1, 0)]
+    # rank of every point among the points of its bin, in a random order
+    order = np.random.RandomState(seed).permutation(n)
+    order = order[np.argsort(cell[order], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(n) - starts[cell[order]]
+    return(np.sort(order[rank < cap]))
+
+
+def box_traces(vals, name, max_points=None, color=None, webgl=False):
+    '''
+    Traces of a box plot of the values <vals> named <name>.
+
+    If there are more than <max_points> values, the box is drawn from that
+    many evenly spaced ranks of the sorted values, which keep its quartiles
+    and whiskers, and every outlier beyond 1.5 IQR of the quartiles is drawn
+    as a marker of a scatter trace next to it, in the same <color>.
+
+    Returns
+    -------
+    list
+        go.Box, and the scatter trace of the outliers if thinned.
+    '''
+    vals = np.asarray(vals, dtype=float)
+    vals = vals[~np.isnan(vals)]
+    marker = dict() if color is None else dict(color=color)
+    if max_points is None or len(vals) <= max_points:
+        return([go.Box(y=vals, name=name, marker=marker)])
+    vals = np.sort(vals)
+    ranks = np.unique(np.linspace(0, len(vals) - 1,
+                                  max_points).round().astype(np.int64))
+    q1, q3 = np.percentile(vals, [25, 75])
+    iqr = q3 - q1
+    outliers = vals[(vals < q1 - 1.5 * iqr) | (vals > q3 + 1.5 * iqr)]
+    return([go.Box(y=vals[ranks], name=name, marker=marker,
+                   boxpoints=False, legendgroup=name),
+            scatter_trace(webgl, x=[name] * len(outliers), y=outliers,
+                          mode='markers', name=name, marker=marker,
+                          legendgroup=name, showlegend=False)])
+
+
+def save_html(fig, saveto, plotlyjs=None):
+    '''
+    Save plotly figure <fig> to html file <saveto>.
+
+    Parameters
+    ----------
+    plotlyjs : str
+        None to inline plotly.js in the html file, 'cdn' to load it from the
+        plotly CDN, or the file path (*.js) of a plotly.js bundle shared by
+        html files. The bundle is written if it does not exist yet, and is
+        referred to by its path relative to <saveto>.
+    '''
+    include_plotlyjs = True
+    if plotlyjs == 'cdn':
+        include_plotlyjs = 'cdn'
+    elif plotlyjs:
+        if not plotlyjs.endswith('.js'):
+            raise ValueError('Expect a .js file but got {}'.format(plotlyjs))
+        if not os.path.isfile(plotlyjs):
+            os.makedirs(os.path.dirname(os.path.abspath(plotlyjs)),
+                        exist_ok=True)
+            tmp = '{}.{}.tmp'.format(plotlyjs, os.getpid())
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                fh.write(get_plotlyjs())
+            os.replace(tmp, plotlyjs)
+        include_plotlyjs = os.path.relpath(
+            os.path.abspath(plotlyjs),
+            os.path.dirname(os.path.abspath(saveto)))
+    plot(fig, filename=saveto, auto_open=False,
+         include_plotlyjs=include_plotlyjs)
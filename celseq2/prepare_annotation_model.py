@@ -1,29 +1,102 @@
 #!/usr/bin/env python3
 # coding: utf-8
+import os
+import json
 import HTSeq
+import hashlib
 import argparse
 import pickle
+import shutil
+import tempfile
 
 from celseq2.helper import print_logger
-# from genometools.ensembl.annotations import get_genes
+from celseq2.feature_index import FeatureIndex, FORMAT_VERSION
+from celseq2.gtf_reader import read_gtf, gene_table, BIOTYPE_ATTRS
 
 
-def cook_anno_model(gff_fpath, feature_atrr='gene_id', feature_type='exon',
-                    gene_types = (),
-                    stranded=True, dumpto=None, verbose=False):
+# Version of the layout of entries of the annotation cache
+_CACHE_VERSION = 2
+
+
+def _file_checksum(fpath, block_size=2**20):
+    sha = hashlib.sha1()
+    with open(fpath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(block_size), b''):
+            sha.update(chunk)
+    return(sha.hexdigest())
+
+
+def annotation_cache_key(gff_fpath, feature_atrr='gene_id',
+                         feature_type='exon', gene_types=(), stranded=True):
     '''
-    Prepare a feature model.
+    Key of the compiled annotation of <gff_fpath> in a cache directory: a
+    checksum of the content of the GTF/GFF and of the parameters of
+    cook_anno_model().
+    '''
+    params = json.dumps([FORMAT_VERSION, _CACHE_VERSION,
+                         _file_checksum(gff_fpath),
+                         feature_atrr, feature_type,
+                         sorted(gene_types), bool(stranded)])
+    return(hashlib.sha1(params.encode('utf-8')).hexdigest())
 
-    Output: (features, exported_genes) where:
-        - features: HTSeq.GenomicArrayOfSets()
-        - exported_genes: a sorted list
 
-    For example, feature_atrr = 'gene_name', feature_type = 'exon',
-    gene_types = ('protein_coding', 'lincRNA'):
-        - features: all exons ~ all gnames mapping and ready for counting
-        - exported_genes: only protein_coding and lincRNA gnames are visible
-    Quantification used the full genes but only the selected genes are reported.
+def cook_anno_model_cached(gff_fpath, cache_dir, feature_atrr='gene_id',
+                           feature_type='exon', gene_types=(),
+                           stranded=True, dumpto=None, verbose=False,
+                           gene_csv=None, processes=1):
+    '''
+    cook_anno_model() through a shared cache of compiled annotations.
+
+    The FeatureIndex is saved in <cache_dir>/<annotation_cache_key()> with
+    the exported genes and their table, and loaded memory-mapped by any later
+    call with the same GTF/GFF content and parameters. Concurrent calls may
+    build the same annotation; the first one to finish is kept.
+
+    Returns
+    -------
+    tuple
+        (features, exported_genes) as cook_anno_model() returns. The
+        features pickle as a reference to the cache.
     '''
+    os.makedirs(cache_dir, exist_ok=True)
+    key = annotation_cache_key(gff_fpath, feature_atrr=feature_atrr,
+                               feature_type=feature_type,
+                               gene_types=gene_types, stranded=stranded)
+    fpath = os.path.join(cache_dir, key)
+    if not os.path.isdir(fpath):
+        if verbose:
+            print_logger('Compiling annotation to {}'.format(fpath))
+        tmp = tempfile.mkdtemp(prefix='.' + key, dir=cache_dir)
+        features, exported_genes = cook_anno_model(
+            gff_fpath, feature_atrr=feature_atrr, feature_type=feature_type,
+            gene_types=gene_types, stranded=stranded, verbose=verbose,
+            gene_csv=os.path.join(tmp, 'genes.csv'), processes=processes)
+        features.save(tmp)
+        with open(os.path.join(tmp, 'exported_genes.json'), 'w') as fh:
+            json.dump(list(exported_genes), fh)
+        try:
+            os.rename(tmp, fpath)
+        except OSError:
+            # built by another process meanwhile
+            shutil.rmtree(tmp, ignore_errors=True)
+    elif verbose:
+        print_logger('Loading compiled annotation {}'.format(fpath))
+
+    features = FeatureIndex.load(fpath)
+    with open(os.path.join(fpath, 'exported_genes.json')) as fh:
+        exported_genes = tuple(json.load(fh))
+    if gene_csv:
+        shutil.copyfile(os.path.join(fpath, 'genes.csv'), gene_csv)
+    if dumpto:
+        with open(dumpto, 'wb') as fh:
+            pickle.dump((features, exported_genes), fh)
+    return((features, exported_genes))
+
+
+def _cook_htseq_model(gff_fpath, feature_atrr='gene_id', feature_type='exon',
+                      gene_types=(), stranded=True, verbose=False,
+                      processes=1):
+    # features in HTSeq.GenomicArrayOfSets, read by HTSeq.GFF_Reader
     features = HTSeq.GenomicArrayOfSets("auto", stranded=stranded)
     fh_gff = HTSeq.GFF_Reader(gff_fpath)
     exported_genes = set()
@@ -50,11 +123,65 @@ def cook_anno_model(gff_fpath, feature_atrr='gene_id', feature_type='exon',
             exported_genes.add(gff.attr[feature_atrr].strip())
 
     print_logger('Processed {:,} lines of GFF...'.format(i))
+    return((features, exported_genes, None))
+
+
+def _cook_index_model(gff_fpath, feature_atrr='gene_id', feature_type='exon',
+                      gene_types=(), stranded=True, verbose=False,
+                      processes=1):
+    # FeatureIndex and gene table from one pass of the vectorised reader
+    attributes = [feature_atrr] + [x for x in ('gene_id', 'gene_name') +
+                                   BIOTYPE_ATTRS if x != feature_atrr]
+    records = read_gtf(gff_fpath, feature_type=feature_type,
+                       attributes=attributes)
+    records = records[records[feature_atrr].notna()]
+    print_logger('Processed {:,} {} records of GFF...'.format(
+        len(records), feature_type))
+    features = FeatureIndex(zip(records['chrom'], records['start'].tolist(),
+                                records['end'].tolist(), records['strand'],
+                                records[feature_atrr]),
+                            stranded=stranded, processes=processes)
+
+    genes = gene_table(records, feature_atrr)
+    if feature_atrr.startswith('gene') and gene_types:
+        genes = genes[genes['biotype'].isin(list(gene_types))]
+    return((features, set(genes.index), genes))
+
+
+def cook_anno_model(gff_fpath, feature_atrr='gene_id', feature_type='exon',
+                    gene_types = (),
+                    stranded=True, dumpto=None, verbose=False,
+                    model='index', gene_csv=None, processes=1):
+    '''
+    Prepare a feature model.
 
-    # Use genometools to select exported_genes
-    # if gene_types:
-    #     exported_genes = get_genes(gff_fpath, valid_biotypes=set(gene_types))
-    #     exported_genes = list(exported_genes['name'].values)
+    Output: (features, exported_genes) where:
+        - features: celseq2.feature_index.FeatureIndex, or
+          HTSeq.GenomicArrayOfSets() if model is 'htseq'
+        - exported_genes: a sorted list
+
+    For example, feature_atrr = 'gene_name', feature_type = 'exon',
+    gene_types = ('protein_coding', 'lincRNA'):
+        - features: all exons ~ all gnames mapping and ready for counting
+        - exported_genes: only protein_coding and lincRNA gnames are visible
+    Quantification used the full genes but only the selected genes are reported.
+
+    The 'index' model is built from one pass of celseq2.gtf_reader, which
+    also gives the table of exported genes saved to <gene_csv>. The type of
+    genes is read from "gene_biotype", or else "gene_type". Its chromosomes
+    are indexed by a pool of <processes>.
+    '''
+    if model not in ('index', 'htseq'):
+        raise ValueError('Unknown feature model: {}'.format(model))
+    cook = _cook_index_model if model == 'index' else _cook_htseq_model
+    features, exported_genes, genes = cook(
+        gff_fpath, feature_atrr=feature_atrr, feature_type=feature_type,
+        gene_types=gene_types, stranded=stranded, verbose=verbose,
+        processes=processes)
+    if gene_csv:
+        if genes is None:
+            raise ValueError('Gene table requires the index model.')
+        genes.to_csv(gene_csv)
 
     if exported_genes:
         exported_genes = tuple(sorted(exported_genes))
@@ -87,17 +214,44 @@ def main():
     parser.add_argument('--dumpto', type=str, metavar='FILENAME',
                         default='annotation.pickle',
                         help='File path to save cooked annotation model')
+    parser.add_argument('--gene-csv', type=str, metavar='FILENAME',
+                        default=None,
+                        help='File path to save the table of exported genes')
+    parser.add_argument('--processes', type=int, metavar='N', default=1,
+                        help=('Processes indexing chromosomes in parallel '
+                              '(default=1)'))
+    parser.add_argument('--cache-dir', type=str, metavar='DIRNAME',
+                        default=None,
+                        help=('Directory of compiled annotations shared by '
+                              'runs. The annotation is only compiled if not '
+                              'found there, and the saved model refers to '
+                              'it.'))
     parser.add_argument('--verbose', dest='verbose', action='store_true')
     parser.set_defaults(verbose=False)
     args = parser.parse_args()
 
+    if args.cache_dir:
+        _ = cook_anno_model_cached(gff_fpath=args.gff_file,
+                                   cache_dir=args.cache_dir,
+                                   feature_atrr=args.feature_atrr,
+                                   feature_type=args.feature_type,
+                                   gene_types=args.gene_types,
+                                   stranded=args.stranded,
+                                   dumpto=args.dumpto,
+                                   verbose=args.verbose,
+                                   gene_csv=args.gene_csv,
+                                   processes=args.processes)
+        return
+
     _ = cook_anno_model(gff_fpath=args.gff_file,
                         feature_atrr=args.feature_atrr,
                         feature_type=args.feature_type,
                         gene_types=args.gene_types,
                         stranded=args.stranded,
                         dumpto=args.dumpto,
-                        verbose=args.verbose)
+                        verbose=args.verbose,
+                        gene_csv=args.gene_csv,
+                        processes=args.processes)
 
 
 if __name__ == "__main__":
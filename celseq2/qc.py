@@ -4,23 +4,26 @@ import numpy as np
 import pandas as pd
 from plotly import tools
 import plotly.graph_objs as go
-from plotly.offline import plot
 
 from celseq2.helper import print_logger, base_name, is_nonempty_file
+from celseq2.sparse_matrix import read_matrix, iter_matrix
+from celseq2.plotly_utils import scatter_trace, thin_points, save_html
+from celseq2.cell_metrics import mt_genes, matrix_metrics, load_cell_metrics
 
 
 def plotly_scatter(x, y, mask_by=None, hover_text=None,
                    xlab='', ylab='', main='',
-                   colorscale='Viridis', mask_title=''):
-    data = go.Scatter(
+                   colorscale='Viridis', mask_title='', webgl=False):
+    data = scatter_trace(
+        webgl,
         x=x,
         y=y,
         mode='markers')
     if hover_text is not None:
         data['text'] = hover_text
     if mask_by is not None:
-        data.marker = go.Marker(
-            colorbar=go.ColorBar(
+        data.marker = dict(
+            colorbar=dict(
                 title=mask_title,
                 titleside='right'),
             color=mask_by,
@@ -53,7 +56,61 @@ def plotly_hist(vals, xlab='', ylab='Freq', main=''):
     return fig
 
 
-def plotly_qc(fpath, saveto, sep=',', name=''):
+def _qc_fractions(metrics, has_mt):
+    # QC metrics of a table of cell metrics
+    if not has_mt:
+        percent_mt = 0
+    else:
+        percent_mt = metrics.num_mt_UMIs / metrics.num_UMIs
+        percent_mt = percent_mt.replace(np.inf, 0)
+    return(pd.DataFrame(dict(total_num_UMIs=metrics.num_UMIs,
+                             num_detected_genes=metrics.num_detected_genes,
+                             percent_mt=percent_mt)))
+
+
+def qc_metrics(expr):
+    '''
+    QC metrics of every cell of a SparseCounts UMI-count matrix: total_num_UMIs,
+    num_detected_genes and percent_mt, the fraction of UMIs of genes named
+    mt-* or MT-* (0 if there is none).
+    '''
+    return(_qc_fractions(matrix_metrics(expr), mt_genes(expr.genes).any()))
+
+
+def qc_metrics_of_file(fpath, sep=',', chunksize=1000):
+    '''
+    qc_metrics() of the UMI-count matrix saved at <fpath>, computed in one
+    pass over its chunks of cells (sparse HDF5) or genes (dense CSV/TSV), so
+    that memory scales with <chunksize> instead of the size of the matrix.
+    '''
+    qc, has_mt = None, False
+    for chunk in iter_matrix(fpath, sep=sep, chunksize=chunksize):
+        part = matrix_metrics(chunk)
+        has_mt = has_mt or mt_genes(chunk.genes).any()
+        if qc is None:
+            qc = part
+        elif qc.index.equals(part.index):
+            # next genes of the same cells
+            qc = qc + part
+        else:
+            qc = pd.concat([qc, part]).groupby(level=0, sort=False).sum()
+    if qc is None:
+        qc = matrix_metrics(read_matrix(fpath, sep=sep))
+    return(_qc_fractions(qc, has_mt))
+
+
+def qc_metrics_of_table(fpath):
+    '''
+    qc_metrics() looked up in the table of cell metrics <fpath> saved by
+    celseq2.cell_metrics.save_cell_metrics(), without reading the matrix.
+    percent_mt is 0 if no cell has UMIs of MT genes.
+    '''
+    metrics = load_cell_metrics(fpath)
+    return(_qc_fractions(metrics, metrics.num_mt_UMIs.any()))
+
+
+def plotly_qc(fpath, saveto, sep=',', name='', chunksize=1000,
+              webgl=False, max_points=None, plotlyjs=None, metrics=False):
     '''
     Generate a plotly html plot for QC of a scRNA-seq data.
 
@@ -63,12 +120,28 @@ def plotly_qc(fpath, saveto, sep=',', name=''):
     - percent of MT expression
 
     Input:
-    fpath: file path (CSV/TSV) to the expression file with genes/features as rows
-    and cells/samples on columns. First column saves gene names.
+    fpath: file path to the expression file with genes/features as rows
+    and cells/samples on columns: sparse HDF5 or Matrix Market (.mtx) saved by
+    celseq2, or dense HDF5 or CSV/TSV whose first column saves gene names.
 
     saveto: a html file to save the plots using Plot.ly
 
-    sep: file sep. Default: ","
+    sep: file sep of CSV/TSV. Default: ","
+
+    chunksize: number of cells (sparse HDF5) or genes (CSV/TSV) read at a
+    time. Default: 1000
+
+    webgl: draw the scatter plots as WebGL. Default: False
+
+    max_points: number of cells to draw at most in each scatter plot, see
+    plotly_utils.thin_points(). Histograms count all cells. Default: all
+
+    plotlyjs: plotly.js to refer to, see plotly_utils.save_html(). Default:
+    inlined
+
+    metrics: <fpath> is instead the table of cell metrics (cell_metrics.csv)
+    saved next to the matrix, in which the QC metrics are looked up. Default:
+    False
     '''
 
     bool_success = False
@@ -78,44 +151,37 @@ def plotly_qc(fpath, saveto, sep=',', name=''):
     if not name:
         name = base_name(fpath)
 
-    expr = pd.read_csv(fpath, index_col=0, sep=sep)
-    print_logger(('UMI count matrix: '
-                  '{} genes x {} cells').format(expr.shape[0], expr.shape[1]))
-
-    total_num_UMIs = expr.sum(axis=0)
-    num_detected_genes = (expr > 0).sum(axis=0)
-    mt_index = [x for x in expr.index if x.startswith(
-        'mt-') or x.startswith('MT-')]
-    if not mt_index:
-        percent_mt = 0
+    if metrics:
+        qc = qc_metrics_of_table(fpath)
     else:
-        mt_umis = expr.loc[pd.Series(mt_index), :].sum(axis=0)
-        percent_mt = mt_umis / total_num_UMIs
-        percent_mt = percent_mt.replace(np.inf, 0)
-
-    qc = pd.DataFrame(dict(total_num_UMIs=total_num_UMIs,
-                           num_detected_genes=num_detected_genes,
-                           percent_mt=percent_mt))
+        qc = qc_metrics_of_file(fpath, sep=sep, chunksize=chunksize)
+    print_logger('UMI count matrix: {} cells'.format(qc.shape[0]))
 
     # 1/5
+    shown = qc.iloc[thin_points(qc.total_num_UMIs, qc.num_detected_genes,
+                                max_points)]
     plotly_g_vs_umi = plotly_scatter(
-        x=qc.total_num_UMIs,
-        y=qc.num_detected_genes,
+        x=shown.total_num_UMIs,
+        y=shown.num_detected_genes,
         xlab='#Total UMIs (median={})'.format(qc.total_num_UMIs.median()),
         ylab='#Detected Genes (median={})'.format(
             qc.num_detected_genes.median()),
         main=name,
-        hover_text=qc.index.values)
+        hover_text=shown.index.values,
+        webgl=webgl)
     plotly_g_vs_umi.layout.yaxis.scaleanchor = None
 
     # 2/5
+    shown = qc.iloc[thin_points(qc.total_num_UMIs, qc.percent_mt,
+                                max_points)]
     plotly_mt_vs_umi = plotly_scatter(
-        x=qc.total_num_UMIs,
-        y=qc.percent_mt,
+        x=shown.total_num_UMIs,
+        y=shown.percent_mt,
         xlab='#Total UMIs (median={})'.format(qc.total_num_UMIs.median()),
         ylab='MT Fraction (median={:6.4f})'.format(qc.percent_mt.median()),
         main=name,
-        hover_text=qc.index.values)
+        hover_text=shown.index.values,
+        webgl=webgl)
     plotly_mt_vs_umi.layout.yaxis.scaleanchor = None
 
     # 3/5
@@ -143,41 +209,37 @@ def plotly_qc(fpath, saveto, sep=',', name=''):
     qc_fig.append_trace(plotly_hist_g.data[0], 2, 2)
     qc_fig.append_trace(plotly_hist_percent_mt.data[0], 2, 3)
 
-    qc_fig.layout.xaxis1 = {**qc_fig.layout.xaxis1,
-                            **plotly_g_vs_umi.layout.xaxis}
-    qc_fig.layout.yaxis1 = {**qc_fig.layout.yaxis1,
-                            **plotly_g_vs_umi.layout.yaxis}
+    qc_fig.layout.xaxis1.update(plotly_g_vs_umi.layout.xaxis)
+    qc_fig.layout.yaxis1.update(plotly_g_vs_umi.layout.yaxis)
 
-    qc_fig.layout.xaxis2 = {**qc_fig.layout.xaxis2,
-                            **plotly_mt_vs_umi.layout.xaxis}
-    qc_fig.layout.yaxis2 = {**qc_fig.layout.yaxis2,
-                            **plotly_mt_vs_umi.layout.yaxis}
+    qc_fig.layout.xaxis2.update(plotly_mt_vs_umi.layout.xaxis)
+    qc_fig.layout.yaxis2.update(plotly_mt_vs_umi.layout.yaxis)
 
-    qc_fig.layout.xaxis3 = {**qc_fig.layout.xaxis3,
-                            **plotly_hist_umis.layout.xaxis}
-    qc_fig.layout.yaxis3 = {**qc_fig.layout.yaxis3,
-                            **plotly_hist_umis.layout.yaxis}
+    qc_fig.layout.xaxis3.update(plotly_hist_umis.layout.xaxis)
+    qc_fig.layout.yaxis3.update(plotly_hist_umis.layout.yaxis)
 
-    qc_fig.layout.xaxis4 = {**qc_fig.layout.xaxis4,
-                            **plotly_hist_g.layout.xaxis}
-    qc_fig.layout.yaxis4 = {**qc_fig.layout.yaxis4,
-                            **plotly_hist_g.layout.yaxis}
+    qc_fig.layout.xaxis4.update(plotly_hist_g.layout.xaxis)
+    qc_fig.layout.yaxis4.update(plotly_hist_g.layout.yaxis)
 
-    qc_fig.layout.xaxis5 = {**qc_fig.layout.xaxis5,
-                            **plotly_hist_percent_mt.layout.xaxis}
-    qc_fig.layout.yaxis5 = {**qc_fig.layout.yaxis5,
-                            **plotly_hist_percent_mt.layout.yaxis}
+    qc_fig.layout.xaxis5.update(plotly_hist_percent_mt.layout.xaxis)
+    qc_fig.layout.yaxis5.update(plotly_hist_percent_mt.layout.yaxis)
 
     qc_fig['layout'].update(height=800, width=1000, title=name,
                             showlegend=False)
 
-    plot(qc_fig, filename=saveto, auto_open=False)
+    save_html(qc_fig, saveto, plotlyjs)
 
     bool_success = True
     return bool_success
 
 
-def plotly_qc_st(fpath, saveto, sep='\t', name=''):
+def plotly_qc_st(fpath, saveto, sep='\t', name='', webgl=False,
+                 plotlyjs=None):
+    '''
+    Generate a plotly html plot for QC of the spots of a ST UMI-count matrix
+    saved by celseq2-to-st. Every spot is drawn, as WebGL if <webgl>, see
+    plotly_qc() for <plotlyjs>.
+    '''
     bool_success = False
     if not is_nonempty_file(fpath):
         return bool_success
@@ -209,7 +271,7 @@ def plotly_qc_st(fpath, saveto, sep='\t', name=''):
         x=ST_qc.Row, y=ST_qc.Col,
         mask_by=ST_qc.num_detected_genes,
         hover_text=ST_qc.num_detected_genes.astype('str'),
-        colorscale='Viridis',
+        colorscale='Viridis', webgl=webgl,
         mask_title=('#Detected Genes '
                     '(median={})').format(ST_qc.num_detected_genes.median()))
     # 2/3
@@ -217,7 +279,7 @@ def plotly_qc_st(fpath, saveto, sep='\t', name=''):
         x=ST_qc.Row, y=ST_qc.Col,
         mask_by=ST_qc.total_num_UMIs,
         hover_text=ST_qc.total_num_UMIs.astype('str'),
-        colorscale='Viridis',
+        colorscale='Viridis', webgl=webgl,
         mask_title=('#Total UMIs '
                     '(median={})').format(ST_qc.total_num_UMIs.median()))
     # 3/3
@@ -225,7 +287,7 @@ def plotly_qc_st(fpath, saveto, sep='\t', name=''):
         x=ST_qc.Row, y=ST_qc.Col,
         mask_by=ST_qc.percent_mt,
         hover_text=ST_qc.percent_mt.astype('str'),
-        colorscale='Viridis',
+        colorscale='Viridis', webgl=webgl,
         mask_title=('MT Fraction '
                     '(median={:6.4f})').format(ST_qc.percent_mt.median()))
     # Merge the 3 figures together
@@ -244,7 +306,7 @@ def plotly_qc_st(fpath, saveto, sep='\t', name=''):
     fig.data[0].marker.colorbar.x = 0.28
     fig.data[1].marker.colorbar.x = 0.64
 
-    plot(fig, filename=saveto, auto_open=False)
+    save_html(fig, saveto, plotlyjs)
 
     bool_success = True
     return bool_success
@@ -254,22 +316,42 @@ def main():
     parser = argparse.ArgumentParser(add_help=True)
     parser.add_argument(
         'fpath', type=str, metavar='FILENAME',
-        help=('file path (CSV/TSV) to the expression file with genes/features '
-              'as rows and cells/samples on columns. '
-              'First column saves gene names.'))
+        help=('file path to the expression file with genes/features '
+              'as rows and cells/samples on columns: sparse HDF5 or Matrix '
+              'Market (.mtx) saved by celseq2, dense HDF5, or CSV/TSV whose '
+              'first column saves gene names.'))
     parser.add_argument('saveto', type=str, metavar='FILENAME',
                         help='File path (html) to save the QC plots.')
     parser.add_argument('--name', type=str, metavar='STR', default='')
     parser.add_argument('--sep', type=str, default='\t',
                         help='File sep (default: \'\t\')')
+    parser.add_argument('--chunksize', type=int, metavar='N', default=1000,
+                        help=('Number of cells (sparse HDF5) or genes '
+                              '(CSV/TSV) read at a time (default: 1000).'))
+    parser.add_argument('--webgl', dest='webgl', action='store_true',
+                        help='Draw scatter plots as WebGL.')
+    parser.add_argument('--max-points', type=int, metavar='N', default=None,
+                        help=('Draw at most about N cells per scatter plot, '
+                              'keeping the outliers (default: all).'))
+    parser.add_argument('--plotlyjs', type=str, metavar='FILENAME|cdn',
+                        default=None,
+                        help=('plotly.js bundle (*.js) shared by html files, '
+                              'written if missing, or \'cdn\' '
+                              '(default: inlined).'))
+    parser.add_argument('--metrics', dest='metrics', action='store_true',
+                        help=('FILENAME is the table of cell metrics '
+                              '(cell_metrics.csv) saved with the matrix.'))
     parser.add_argument('--st', dest='is_st', action='store_true')
-    parser.set_defaults(is_st=False)
+    parser.set_defaults(is_st=False, webgl=False, metrics=False)
     args = parser.parse_args()
 
     if args.is_st:
-        plotly_qc_st(args.fpath, args.saveto, args.sep, args.name)
+        plotly_qc_st(args.fpath, args.saveto, args.sep, args.name,
+                     args.webgl, args.plotlyjs)
     else:
-        plotly_qc(args.fpath, args.saveto, args.sep, args.name)
+        plotly_qc(args.fpath, args.saveto, args.sep, args.name,
+                  args.chunksize, args.webgl, args.max_points, args.plotlyjs,
+                  args.metrics)
     print_logger('Generate QC for {}'.format(args.fpath))
     print_logger('See {}'.format(args.saveto))
 
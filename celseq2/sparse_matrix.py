@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Sparse UMI-count matrix of genes x cells.
+
+The matrix is kept in compressed sparse column (CSC) layout, one column per
+cell, so that it is assembled straight from the per-cell UMI counts without a
+dense frame in between. It is saved as
+
+- HDF5: group /matrix with the arrays data, indices and indptr, the shape,
+  and the names of genes and barcodes.
+- Matrix Market: a coordinate .mtx file with 1-based (gene, cell, count)
+  lines, together with genes.tsv and barcodes.tsv.
+
+read_matrix() also reads the dense CSV/HDF5 matrices, so that the tools
+downstream accept any of them. iter_matrix() reads them in chunks of cells or
+genes, for per-cell summaries of matrices too large to hold at once.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+
+_H5_GROUP = 'matrix'
+_MTX_HEADER = '%%MatrixMarket matrix coordinate integer general'
+MTX_GENES = 'genes.tsv'
+MTX_BARCODES = 'barcodes.tsv'
+
+
+class SparseCounts(object):
+    '''
+    UMI counts of genes (rows) x cells (columns) in CSC layout: the non-zero
+    counts of cell j are data[indptr[j]:indptr[j+1]] at the rows
+    indices[indptr[j]:indptr[j+1]].
+    '''
+
+    def __init__(self, data, indices, indptr, genes, cells):
+        self.data = np.asarray(data, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.genes = list(genes)
+        self.cells = list(cells)
+        if len(self.indptr) != len(self.cells) + 1:
+            raise ValueError('Expect {} column pointers but got {}'.format(
+                len(self.cells) + 1, len(self.indptr)))
+
+    @classmethod
+    def from_counters(cls, counters, genes, cells=None):
+        '''
+        Matrix of the UMI counts of cells.
+
+        Parameters
+        ----------
+        counters : dict
+            Cell -> Counter(gene -> UMI count).
+        genes : list
+            Genes (rows) in order. Counts of other genes are dropped.
+        cells : list
+            Cells (columns) in order. Default: the order of <counters>.
+        '''
+        genes = list(genes)
+        if cells is None:
+            cells = list(counters)
+        row = {g: i for i, g in enumerate(genes)}
+        data = [np.zeros(0, dtype=np.int64)]
+        indices = [np.zeros(0, dtype=np.int64)]
+        indptr = np.zeros(len(cells) + 1, dtype=np.int64)
+        for j, cell in enumerate(cells):
+            cnt = counters.get(cell, {})
+            rows = np.fromiter((row.get(g, -1) for g in cnt), dtype=np.int64,
+                               count=len(cnt))
+            vals = np.fromiter(cnt.values(), dtype=np.int64, count=len(cnt))
+            keep = (rows >= 0) & (vals != 0)
+            rows, vals = rows[keep], vals[keep]
+            order = np.argsort(rows, kind='stable')
+            indices.append(rows[order])
+            data.append(vals[order])
+            indptr[j + 1] = indptr[j] + len(rows)
+        return(cls(np.concatenate(data), np.concatenate(indices), indptr,
+                   genes, cells))
+
+    @classmethod
+    def from_dense(cls, expr):
+        '''
+        Matrix of a dense DataFrame of genes x cells.
+        '''
+        values = np.asarray(expr.values)
+        cells, genes = np.nonzero(values.T)
+        indptr = np.zeros(values.shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=values.shape[1]),
+                  out=indptr[1:])
+        return(cls(values.T[cells, genes], genes, indptr,
+                   expr.index, expr.columns))
+
+    @property
+    def shape(self):
+        return((len(self.genes), len(self.cells)))
+
+    @property
+    def nnz(self):
+        return(len(self.data))
+
+    def _columns(self):
+        # Column (cell) of every stored count
+        return(np.repeat(np.arange(len(self.cells)), np.diff(self.indptr)))
+
+    def column(self, j):
+        ''' Dense vector of the counts of genes in cell <j>. '''
+        out = np.zeros(len(self.genes), dtype=np.int64)
+        lo, hi = self.indptr[j], self.indptr[j + 1]
+        out[self.indices[lo:hi]] = self.data[lo:hi]
+        return(out)
+
+    def column_range(self, lo, hi):
+        ''' Sub-matrix of the cells (columns) lo to hi-1. '''
+        hi = min(hi, len(self.cells))
+        a, b = self.indptr[lo], self.indptr[hi]
+        return(SparseCounts(self.data[a:b], self.indices[a:b],
+                            self.indptr[lo:hi + 1] - a, self.genes,
+                            self.cells[lo:hi]))
+
+    def total_per_cell(self, genes_mask=None):
+        '''
+        Total UMIs of every cell, counting only the genes set in the boolean
+        <genes_mask> if given.
+        '''
+        weights = self.data
+        if genes_mask is not None:
+            weights = weights * np.asarray(genes_mask)[self.indices]
+        return(np.bincount(self._columns(), weights=weights,
+                           minlength=len(self.cells)).astype(np.int64))
+
+    def detected_per_cell(self):
+        ''' Number of genes with UMIs in every cell. '''
+        return(np.diff(self.indptr))
+
+    def total_per_gene(self):
+        ''' Total UMIs of every gene. '''
+        return(np.bincount(self.indices, weights=self.data,
+                           minlength=len(self.genes)).astype(np.int64))
+
+    def select(self, genes_mask=None, cells_mask=None):
+        '''
+        Sub-matrix of the genes and cells set in the boolean masks.
+        '''
+        genes_mask = np.ones(len(self.genes), dtype=bool) \
+            if genes_mask is None else np.asarray(genes_mask, dtype=bool)
+        cells_mask = np.ones(len(self.cells), dtype=bool) \
+            if cells_mask is None else np.asarray(cells_mask, dtype=bool)
+        new_row = np.cumsum(genes_mask) - 1
+        columns = self._columns()
+        keep = genes_mask[self.indices] & cells_mask[columns]
+        counts = np.bincount(columns[keep],
+                             minlength=len(self.cells))[cells_mask]
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return(SparseCounts(
+            self.data[keep], new_row[self.indices[keep]], indptr,
+            np.asarray(self.genes, dtype=object)[genes_mask],
+            np.asarray(self.cells, dtype=object)[cells_mask]))
+
+    def to_dense(self):
+        ''' DataFrame of genes x cells. '''
+        values = np.zeros(self.shape, dtype=np.int64)
+        values[self.indices, self._columns()] = self.data
+        return(pd.DataFrame(values, index=self.genes, columns=self.cells))
+
+    def to_scipy(self):
+        ''' scipy.sparse.csc_matrix of the counts. Requires scipy. '''
+        if sp is None:
+            raise ImportError('scipy is required to export scipy matrices')
+        return(sp.csc_matrix((self.data, self.indices, self.indptr),
+                             shape=self.shape))
+
+    def __eq__(self, other):
+        return(isinstance(other, SparseCounts) and
+               self.genes == other.genes and self.cells == other.cells and
+               np.array_equal(self.indptr, other.indptr) and
+               np.array_equal(self.indices, other.indices) and
+               np.array_equal(self.data, other.data))
+
+    def save_h5(self, fpath):
+        '''
+        Save to HDF5 as group /matrix with data, indices, indptr, shape,
+        genes and barcodes.
+        '''
+        import tables
+
+        filters = tables.Filters(complevel=4, complib='zlib')
+        with tables.open_file(fpath, 'w') as h5:
+            grp = h5.create_group('/', _H5_GROUP)
+            grp._v_attrs.layout = 'csc'
+            for key, arr in [('data', self.data), ('indices', self.indices),
+                             ('indptr', self.indptr),
+                             ('shape', np.array(self.shape, dtype=np.int64)),
+                             ('genes', _to_bytes(self.genes)),
+                             ('barcodes', _to_bytes(self.cells))]:
+                if len(arr):
+                    h5.create_carray(grp, key, obj=arr, filters=filters)
+                else:
+                    h5.create_array(grp, key, obj=arr)
+
+    @classmethod
+    def load_h5(cls, fpath):
+        ''' Load from the HDF5 file written by save_h5(). '''
+        import tables
+
+        with tables.open_file(fpath, 'r') as h5:
+            grp = h5.get_node('/', _H5_GROUP)
+            return(cls(grp.data[:], grp.indices[:], grp.indptr[:],
+                       _from_bytes(grp.genes[:]),
+                       _from_bytes(grp.barcodes[:])))
+
+    @classmethod
+    def iter_h5(cls, fpath, chunksize=1000):
+        '''
+        Read the HDF5 file written by save_h5() as consecutive matrices of
+        all genes x <chunksize> cells, holding only one chunk in memory.
+        '''
+        import tables
+
+        with tables.open_file(fpath, 'r') as h5:
+            grp = h5.get_node('/', _H5_GROUP)
+            genes = _from_bytes(grp.genes[:])
+            cells = _from_bytes(grp.barcodes[:])
+            indptr = grp.indptr[:]
+            for lo in range(0, len(cells), chunksize):
+                hi = min(lo + chunksize, len(cells))
+                a, b = indptr[lo], indptr[hi]
+                yield cls(grp.data[a:b], grp.indices[a:b],
+                          indptr[lo:hi + 1] - a, genes, cells[lo:hi])
+
+    def save_mtx(self, fpath, genes_fpath=None, barcodes_fpath=None):
+        '''
+        Save to Matrix Market coordinate file <fpath>, and the genes and cells
+        one per line to <genes_fpath> and <barcodes_fpath> which are by
+        default genes.tsv and barcodes.tsv next to <fpath>.
+        '''
+        genes_fpath, barcodes_fpath = _mtx_tables(
+            fpath, genes_fpath, barcodes_fpath)
+        coo = np.column_stack([self.indices + 1, self._columns() + 1,
+                               self.data])
+        header = '{}\n{} {} {}'.format(_MTX_HEADER, len(self.genes),
+                                       len(self.cells), self.nnz)
+        np.savetxt(fpath, coo, fmt='%d', header=header, comments='')
+        for names, out in [(self.genes, genes_fpath),
+                           (self.cells, barcodes_fpath)]:
+            with open(out, 'w') as fh:
+                fh.writelines('{}\n'.format(x) for x in names)
+
+    @classmethod
+    def load_mtx(cls, fpath, genes_fpath=None, barcodes_fpath=None):
+        ''' Load from the files written by save_mtx(). '''
+        genes_fpath, barcodes_fpath = _mtx_tables(
+            fpath, genes_fpath, barcodes_fpath)
+        with open(fpath) as fh:
+            line = fh.readline()
+            while line.startswith('%'):
+                line = fh.readline()
+            n_genes, n_cells, nnz = map(int, line.split())
+            coo = np.loadtxt(fh, dtype=np.int64, ndmin=2).reshape(nnz, 3)
+        names = []
+        for fin in (genes_fpath, barcodes_fpath):
+            with open(fin) as fh:
+                names.append([x.rstrip('\n') for x in fh])
+        genes, cells = names
+        if (len(genes), len(cells)) != (n_genes, n_cells):
+            raise ValueError('{} is {} x {} but has {} genes and {} '
+                             'barcodes'.format(fpath, n_genes, n_cells,
+                                               len(genes), len(cells)))
+        order = np.lexsort((coo[:, 0], coo[:, 1]))
+        coo = coo[order]
+        indptr = np.zeros(n_cells + 1, dtype=np.int64)
+        np.cumsum(np.bincount(coo[:, 1] - 1, minlength=n_cells),
+                  out=indptr[1:])
+        return(cls(coo[:, 2], coo[:, 0] - 1, indptr, genes, cells))
+
+
+def _to_bytes(names):
+    return(np.array([str(x).encode('utf-8') for x in names], dtype='S'))
+
+
+def _from_bytes(arr):
+    return([x.decode('utf-8') for x in arr])
+
+
+def _mtx_tables(fpath, genes_fpath, barcodes_fpath):
+    dirname = os.path.dirname(fpath)
+    return((genes_fpath or os.path.join(dirname, MTX_GENES),
+            barcodes_fpath or os.path.join(dirname, MTX_BARCODES)))
+
+
+def is_sparse_h5(fpath):
+    ''' Whether <fpath> is an HDF5 file written by SparseCounts.save_h5(). '''
+    import tables
+
+    try:
+        with tables.open_file(fpath, 'r') as h5:
+            return('/' + _H5_GROUP in h5)
+    except (OSError, tables.HDF5ExtError):
+        return(False)
+
+
+def read_matrix(fpath, sep=','):
+    '''
+    UMI-count matrix saved by celseq2 in any format.
+
+    Parameters
+    ----------
+    fpath : str
+        Sparse HDF5 (group /matrix), Matrix Market (.mtx) with genes.tsv and
+        barcodes.tsv next to it, dense HDF5 (key 'table') or dense CSV/TSV
+        with genes as rows and the gene names in the first column.
+    sep : str
+        Field separator of dense CSV/TSV.
+
+    Returns
+    -------
+    SparseCounts
+    '''
+    if fpath.endswith('.mtx'):
+        return(SparseCounts.load_mtx(fpath))
+    if fpath.endswith('h5') or fpath.endswith('hdf5'):
+        if is_sparse_h5(fpath):
+            return(SparseCounts.load_h5(fpath))
+        return(SparseCounts.from_dense(pd.read_hdf(fpath, 'table')))
+    return(SparseCounts.from_dense(pd.read_csv(fpath, index_col=0, sep=sep)))
+
+
+def iter_matrix(fpath, sep=',', chunksize=1000):
+    '''
+    UMI-count matrix of read_matrix() read in chunks, so that only one chunk
+    is held in memory: chunks of <chunksize> cells of sparse HDF5, chunks of
+    <chunksize> genes of dense CSV/TSV. Matrix Market and dense HDF5 files
+    are read as one chunk.
+
+    Yields
+    ------
+    SparseCounts
+        Chunk of all genes x some cells, or some genes x all cells.
+    '''
+    if fpath.endswith('h5') or fpath.endswith('hdf5'):
+        if is_sparse_h5(fpath):
+            yield from SparseCounts.iter_h5(fpath, chunksize)
+            return
+    elif not fpath.endswith('.mtx'):
+        for chunk in pd.read_csv(fpath, index_col=0, sep=sep,
+                                 chunksize=chunksize):
+            yield SparseCounts.from_dense(chunk)
+        return
+    yield read_matrix(fpath, sep=sep)
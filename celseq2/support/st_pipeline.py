@@ -6,57 +6,85 @@ Support Spatial Transcriptome Pipeline output
 https://github.com/SpatialTranscriptomicsResearch/st_pipeline
 '''
 import argparse
+
+import numpy as np
 import pandas as pd
 
+from celseq2.sparse_matrix import SparseCounts, read_matrix
+
+
+def read_spatial_map(spatial_map):
+    '''
+    Spatial positions of spots: DataFrame of X and Y (as given) indexed by
+    the barcode sequence of the spot, read from the whitespace-separated
+    columns sequence, X and Y. Lines starting with '#' are skipped.
+    '''
+    spatial = pd.read_csv(spatial_map, sep=r'\s+', header=None,
+                          comment='#', usecols=[0, 1, 2], dtype=str,
+                          names=['seq', 'X', 'Y'])
+    spatial = spatial.drop_duplicates('seq', keep='last')
+    return(spatial.set_index('seq'))
+
 
 def celseq2stpipeline(celseq2_fpath, spatial_map, out,
-                      exclude_empty_spots, exclude_nondetected_genes):
-    fhout = open(out, 'w')
-
-    dict_spatial_seq2xy = {}
-    with open(spatial_map, 'r') as fin:
-        for row in fin:
-            if row.startswith('#'):
-                continue
-            row = row.strip().split()
-            dict_spatial_seq2xy[row[0]] = (row[1], row[2])
-
-    if celseq2_fpath.endswith('h5') or celseq2_fpath.endswith('hdf5'):
-        expr = pd.read_hdf(celseq2_fpath, 'table')  # genes x cells
-    if celseq2_fpath.endswith('csv'):
-        expr = pd.read_csv(celseq2_fpath, index_col=0)
-    # df.loc[(df.sum(axis=1) != 0), (df.sum(axis=0) != 0)]
-    if (exclude_empty_spots) and (exclude_nondetected_genes):
-        expr_valid = expr.loc[(expr.sum(axis=1) != 0), (expr.sum(axis=0) != 0)]
-    elif (not exclude_empty_spots) and (exclude_nondetected_genes):
-        expr_valid = expr.loc[(expr.sum(axis=1) != 0), (expr.sum(axis=0) >= 0)]
-    elif (exclude_empty_spots) and (not exclude_nondetected_genes):
-        expr_valid = expr.loc[(expr.sum(axis=1) >= 0), (expr.sum(axis=0) != 0)]
-    else:
-        expr_valid = expr
-
-    genes = map(lambda x: x.replace(' ', '_'), expr_valid.index.values)
-    colnames = expr_valid.columns.values
-    # fhout.write('{}\t{}\n'.format('', '\t'.join(genes)))  # header
-    fhout.write('{}\t{}\t{}\n'.format('X', 'Y', '\t'.join(genes)))  # header
-
-    for colname in colnames:
-        tmp = colname.replace('.', '-') # BC-1-ATGC or ATGC
-        spot_seq = tmp.split('-')[-1] # ATGC or ATGC
-        spot_expr = expr_valid[colname].values
-        spot_xy = dict_spatial_seq2xy.get(spot_seq, None)
-        if not spot_xy:
-            continue
-        # spot_xy = 'x'.join(map(str, spot_xy))
-        # fhout.write('{}\t{}\n'.format(
-        #     spot_xy,
-        #     '\t'.join(map(str, spot_expr))))
-        spot_r, spot_c = spot_xy
-        fhout.write('{}\t{}\t{}\n'.format(
-            spot_r, spot_c,
-            '\t'.join(map(str, spot_expr))))
-
-    fhout.close()
+                      exclude_empty_spots, exclude_nondetected_genes,
+                      sparse_out=None, chunksize=500):
+    '''
+    Save the UMI-count matrix of celseq2 as the spots x genes table of
+    st_pipeline: columns X, Y and the genes, one row per cell of the matrix
+    whose barcode is a spot of the spatial map.
+
+    The spots are joined to the cells at once, and the table is written in
+    chunks of <chunksize> spots with the counts looked up as text at once.
+    If <sparse_out> is given, the spots x genes counts are saved there as
+    well as a sparse matrix (.mtx or .h5, see SparseCounts) of genes x spots
+    named XxY.
+    '''
+    spatial = read_spatial_map(spatial_map)
+
+    expr = read_matrix(celseq2_fpath)  # genes x cells
+    genes_mask = expr.total_per_gene() != 0 \
+        if exclude_nondetected_genes else None
+    cells_mask = expr.total_per_cell() != 0 \
+        if exclude_empty_spots else np.ones(len(expr.cells), dtype=bool)
+    # BC-1-ATGC or ATGC => ATGC
+    spot_seq = pd.Series(expr.cells, dtype=object).str.replace(
+        '.', '-', regex=False).str.split('-').str[-1]
+    spot_xy = spatial.reindex(spot_seq.values)
+    cells_mask = cells_mask & spot_xy.X.notna().values
+    expr_valid = expr.select(genes_mask, cells_mask)
+    spot_xy = spot_xy[cells_mask]
+
+    genes = [x.replace(' ', '_') for x in expr_valid.genes]
+    # counts -> str looked up at once instead of formatted one by one
+    max_count = int(expr_valid.data.max()) if len(expr_valid.data) else 0
+    count_str = np.array([str(x) for x in range(max_count + 1)],
+                         dtype=object) if max_count < 2 ** 16 else None
+    with open(out, 'w') as fhout:
+        fhout.write('{}\t{}\t{}\n'.format('X', 'Y', '\t'.join(genes)))
+        for lo in range(0, len(expr_valid.cells), chunksize):
+            chunk = expr_valid.column_range(lo, lo + chunksize)
+            spots = np.zeros((len(chunk.cells), len(genes)), dtype=np.int64)
+            spots[chunk._columns(), chunk.indices] = chunk.data
+            if count_str is not None:
+                rows = count_str[spots]
+            else:
+                rows = (map(str, row) for row in spots.tolist())
+            fhout.writelines(
+                '{}\t{}\t{}\n'.format(x, y, '\t'.join(row))
+                for x, y, row in zip(spot_xy.X.values[lo:lo + chunksize],
+                                     spot_xy.Y.values[lo:lo + chunksize],
+                                     rows))
+
+    if sparse_out:
+        st = SparseCounts(expr_valid.data, expr_valid.indices,
+                          expr_valid.indptr, genes,
+                          ['{}x{}'.format(x, y) for x, y in
+                           zip(spot_xy.X, spot_xy.Y)])
+        if sparse_out.endswith('.mtx'):
+            st.save_mtx(sparse_out)
+        else:
+            st.save_h5(sparse_out)
 
     print(out)
 
@@ -64,7 +92,9 @@ def celseq2stpipeline(celseq2_fpath, spatial_map, out,
 def main():
     parser = argparse.ArgumentParser(add_help=True)
     parser.add_argument('celseq2', metavar='FILENAME', type=str,
-                        help=('File path to expr.hdf5 (expr.h5 or expr.csv) generated by celseq2.'))
+                        help=('File path to the UMI-count matrix generated by celseq2 '
+                              '(expr.sparse.h5, expr.mtx, expr.h5 or '
+                              'expr.csv).'))
     parser.add_argument('spatial_map', metavar='FILENAME', type=str,
                         help='File path to spatial position dictionary.')
     parser.add_argument('out', metavar='FILENAME', type=str,
@@ -74,11 +104,20 @@ def main():
                         help=('Exclude spots without any signals.'))
     parser.add_argument('--exclude-nondetected-genes', action='store_true',
                         help='Exclude genes with no UMIs.')
+    parser.add_argument('--sparse', type=str, metavar='FILENAME',
+                        default=None,
+                        help=('Also save the counts of spots as a sparse '
+                              'matrix of genes x spots named XxY: Matrix '
+                              'Market (.mtx, with genes.tsv and barcodes.tsv '
+                              'next to it) or HDF5.'))
+    parser.add_argument('--chunksize', type=int, metavar='N', default=500,
+                        help='Number of spots written at a time (default: 500).')
 
     args = parser.parse_args()
 
     celseq2stpipeline(args.celseq2, args.spatial_map, args.out,
-                      args.exclude_empty_spots, args.exclude_nondetected_genes)
+                      args.exclude_empty_spots, args.exclude_nondetected_genes,
+                      args.sparse, args.chunksize)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Assembly of UMI-count matrices of items and experiments from per-cell
+results.
+
+Per-cell results are streamed into a MatrixBuilder, which keeps every cell as
+arrays of (row, count) with the rows looked up once per detected gene from a
+precomputed gene -> row table. Cells seen in several items of an experiment
+have their molecules merged, so a UMI of a gene is counted once per cell. The
+matrix is then assembled as a SparseCounts in one pass over the cells.
+
+The molecules of the cells of an item are its partial of the experiment
+matrix: a MoleculeStore, from which the experiment matrix is merged again
+whenever another item of the experiment changes, without reading the results
+of its cells again. An experiment matrix is only merged again if the
+partials of its own items changed.
+'''
+import os
+import pickle
+import hashlib
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from celseq2.molecules import Molecules, as_molecules, molecule_keys
+from celseq2.sparse_matrix import SparseCounts
+from celseq2.molecule_store import MoleculeStore
+from celseq2.cell_metrics import matrix_metrics, save_cell_metrics
+
+
+CELL_METRICS = 'cell_metrics.csv'
+
+
+def barcode_ids(bc_index_fpath, bc_seq_column=0):
+    '''
+    Dict of cell barcode sequence -> its 1-based rank in the barcode index
+    file, which orders and names the cells of the matrices.
+    '''
+    bc_index = pd.read_csv(bc_index_fpath, sep='\t', index_col=bc_seq_column)
+    return({seq: seq_id + 1 for seq_id, seq in enumerate(bc_index.index)})
+
+
+class MatrixBuilder(object):
+    '''
+    UMI-count matrix of genes x cells, assembled from per-cell results added
+    one at a time.
+
+    Parameters
+    ----------
+    genes : list
+        Genes (rows) in order. Counts of other genes are dropped.
+    bc_ids : dict
+        Cell barcode -> id as barcode_ids() gives. If given, cells are
+        ordered by id and named BC-<id>-<barcode> (id 0 for unknown
+        barcodes). Otherwise cells keep the order they were added in.
+    umi_collapse : str
+        UMI collapsing method of merged molecules, see
+        Molecules.collapse().
+    umi_distance : int
+        Distance of UMIs to collapse.
+    len_umi : int
+        Length of UMIs of dict(gene -> set(UMI)) added. Guessed from the UMIs
+        if not given.
+    '''
+
+    def __init__(self, genes, bc_ids=None, umi_collapse='unique',
+                 umi_distance=1, len_umi=None):
+        self.genes = list(genes)
+        self.bc_ids = bc_ids
+        self.len_umi = len_umi
+        self.umi_collapse = umi_collapse
+        self.umi_distance = umi_distance
+        self._row = {g: i for i, g in enumerate(self.genes)}
+        # cell -> list of (rows, counts) and list of Molecules
+        self._counts = {}
+        self._molecules = {}
+
+    def _rows(self, genes):
+        return(np.fromiter((self._row.get(g, -1) for g in genes),
+                           dtype=np.int64, count=len(genes)))
+
+    def _add_cell(self, cell):
+        if cell not in self._counts:
+            self._counts[cell] = []
+            self._molecules[cell] = []
+
+    def add_counts(self, cell, cnt):
+        '''
+        Add UMI counts dict(gene -> count) of <cell>. Counts of a cell added
+        more than once are summed.
+        '''
+        self._add_cell(cell)
+        rows = self._rows(list(cnt))
+        vals = np.fromiter(cnt.values(), dtype=np.int64, count=len(cnt))
+        self._counts[cell].append((rows, vals))
+
+    def add_molecules(self, cell, umi_set):
+        '''
+        Add molecules of <cell>, as Molecules or dict(gene -> set(UMI)).
+        Molecules of a cell added more than once are merged.
+        '''
+        self._add_cell(cell)
+        self._molecules[cell].append(as_molecules(umi_set, self.len_umi))
+
+    def __len__(self):
+        return(len(self._counts))
+
+    def _cell_counts(self, cell):
+        parts = list(self._counts[cell])
+        mols = self._molecules[cell]
+        if mols and self.umi_collapse != 'unique':
+            mol = mols[0] if len(mols) == 1 else Molecules.merge(mols)
+            mol = mol.collapse(self.umi_collapse, self.umi_distance)
+            parts.append((self._rows(mol.genes),
+                          np.bincount(mol.gene_ids,
+                                      minlength=len(mol.genes))))
+        elif mols:
+            # union of molecules keyed by rows instead of gene names
+            keys = []
+            for mol in mols:
+                if mol.len_umi != mols[0].len_umi:
+                    raise ValueError('Molecules of different UMI lengths.')
+                rows = self._rows(mol.genes)[mol.gene_ids]
+                keep = rows >= 0
+                keys.append(molecule_keys(rows[keep], mol.umi_codes[keep],
+                                          mol.len_umi))
+            rows, n = np.unique(np.unique(np.concatenate(keys)) >>
+                                mols[0]._bits, return_counts=True)
+            parts.append((rows, n))
+        if not parts:
+            return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        rows = np.concatenate([x[0] for x in parts])
+        vals = np.concatenate([x[1] for x in parts]).astype(np.int64)
+        keep = (rows >= 0) & (vals != 0)
+        rows, inverse = np.unique(rows[keep], return_inverse=True)
+        vals = np.bincount(inverse.ravel(), weights=vals[keep],
+                           minlength=len(rows)).astype(np.int64)
+        return(rows, vals)
+
+    def cells(self):
+        ''' Cells in the order of the columns. '''
+        cells = list(self._counts)
+        if self.bc_ids is not None:
+            cells.sort(key=lambda xx: self.bc_ids.get(xx, float('Inf')))
+        return(cells)
+
+    def build(self):
+        ''' SparseCounts of the cells added. '''
+        cells = self.cells()
+        data, indices = [], []
+        indptr = np.zeros(len(cells) + 1, dtype=np.int64)
+        for j, cell in enumerate(cells):
+            rows, vals = self._cell_counts(cell)
+            indices.append(rows)
+            data.append(vals)
+            indptr[j + 1] = indptr[j] + len(rows)
+        if self.bc_ids is not None:
+            cells = ['BC-{}-{}'.format(self.bc_ids.get(xx, 0), xx)
+                     for xx in cells]
+        empty = [np.zeros(0, dtype=np.int64)]
+        return(SparseCounts(np.concatenate(empty + data),
+                            np.concatenate(empty + indices),
+                            indptr, self.genes, cells))
+
+
+def build_matrices(records, genes, groups=(), bc_ids=None,
+                   umi_collapse='unique', umi_distance=1, len_umi=None):
+    '''
+    UMI-count matrices of groups of cells, e.g. experiments or items.
+
+    Parameters
+    ----------
+    records : iterable
+        (group, cell, result) of every cell, where result is the
+        Molecules or dict(gene -> set(UMI)) of the cell, or its Counter of
+        UMI counts. Results of a cell in one group are merged.
+    genes : list
+        Genes (rows) in order.
+    groups : iterable
+        Groups to have a matrix for even if they have no cells.
+    bc_ids, umi_collapse, umi_distance, len_umi :
+        See MatrixBuilder.
+
+    Returns
+    -------
+    dict
+        group -> SparseCounts
+    '''
+    genes = list(genes)
+    builders = {}
+
+    def builder(group):
+        if group not in builders:
+            builders[group] = MatrixBuilder(genes, bc_ids, umi_collapse,
+                                            umi_distance, len_umi)
+        return(builders[group])
+
+    for group in groups:
+        builder(group)
+    for group, cell, result in records:
+        if isinstance(result, Molecules) or \
+                any(isinstance(v, set) for v in result.values()):
+            builder(group).add_molecules(cell, result)
+        else:
+            builder(group).add_counts(cell, result)
+    return({group: x.build() for group, x in builders.items()})
+
+
+def store_records(fpaths, group_of_item):
+    '''
+    (group, cell, Molecules) of every cell of the MoleculeStore of items
+    <fpaths> named <item>.h5, for build_matrices(). The group of an item is
+    given by the function <group_of_item>.
+    '''
+    for fpath in fpaths:
+        item = os.path.splitext(os.path.basename(fpath))[0]
+        group = group_of_item(item)
+        for cell, mol in MoleculeStore(fpath).molecules().items():
+            yield (group, cell, mol)
+
+
+def _signature(fpaths):
+    # files, their sizes and modification times
+    sha1 = hashlib.sha1()
+    for fpath in sorted(fpaths):
+        st = os.stat(fpath)
+        sha1.update('{}\t{}\t{}\n'.format(fpath, st.st_size,
+                                           st.st_mtime_ns).encode('utf-8'))
+    return(sha1.hexdigest())
+
+
+def item_partial(fpath, umiset_fpaths, len_umi=None):
+    '''
+    Save the partial of an item: the MoleculeStore <fpath> of the molecules
+    of its cells, read from the per-cell pickles <umiset_fpaths> named
+    <cell>.pkl. It is kept as it is if these pickles have not changed since
+    it was saved.
+
+    Returns
+    -------
+    bool
+        True if the partial was saved again, False if it was up to date.
+    '''
+    signature = _signature(umiset_fpaths)
+    if MoleculeStore(fpath).signature() == signature:
+        return(False)
+    tmp = fpath + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    store = MoleculeStore(tmp, len_umi)
+    counts = {}
+    for f in umiset_fpaths:
+        with open(f, 'rb') as fh:
+            mol = as_molecules(pickle.load(fh), len_umi)
+        counts[os.path.splitext(os.path.basename(f))[0]] = \
+            (None, mol, Counter())
+    store.append(counts)
+    store.set_signature(signature)
+    os.replace(tmp, fpath)
+    os.remove(tmp + '.lock')
+    return(True)
+
+
+def experiment_matrix(outdir, stores, genes, bc_ids=None,
+                      umi_collapse='unique', umi_distance=1, len_umi=None,
+                      dense=True):
+    '''
+    Save the matrix of an experiment to <outdir> by save_matrix(), merged
+    from the partials of its items: their MoleculeStore <stores>. It is kept
+    as it is if it was saved from these partials as they are now, with the
+    same parameters.
+
+    Parameters
+    ----------
+    genes, bc_ids, umi_collapse, umi_distance, len_umi :
+        See MatrixBuilder.
+    dense : bool
+        Save the dense matrix as well.
+
+    Returns
+    -------
+    bool
+        True if the matrix was saved again, False if it was up to date.
+    '''
+    import tables
+
+    sha1 = hashlib.sha1(_signature(stores).encode('utf-8'))
+    sha1.update(repr((list(genes), sorted((bc_ids or {}).items()),
+                      umi_collapse, umi_distance, len_umi,
+                      dense)).encode('utf-8'))
+    signature = sha1.hexdigest()
+    fpath = os.path.join(outdir, 'expr.sparse.h5')
+    outputs = [fpath, os.path.join(outdir, CELL_METRICS)]
+    if dense:
+        outputs.append(os.path.join(outdir, 'expr.csv'))
+    if all(os.path.isfile(x) for x in outputs):
+        with tables.open_file(fpath, 'r') as h5:
+            if getattr(h5.root._v_attrs, 'partials', None) == signature:
+                return(False)
+    mat = build_matrices(store_records(stores, lambda item: None), genes,
+                         groups=[None], bc_ids=bc_ids,
+                         umi_collapse=umi_collapse, umi_distance=umi_distance,
+                         len_umi=len_umi)[None]
+    save_matrix(mat, outdir, sparse=True, dense=dense)
+    with tables.open_file(fpath, 'a') as h5:
+        h5.root._v_attrs.partials = signature
+    return(True)
+
+
+def save_matrix(mat, outdir, sparse=True, dense=True, metrics=True):
+    '''
+    Save SparseCounts <mat> to <outdir>: expr.sparse.h5, expr.mtx,
+    genes.tsv and barcodes.tsv if <sparse>, expr.csv and expr.h5 if <dense>,
+    and the table of the METRICS of its cells cell_metrics.csv if <metrics>.
+    '''
+    if metrics:
+        save_cell_metrics(matrix_metrics(mat),
+                          os.path.join(outdir, CELL_METRICS))
+    if sparse:
+        mat.save_h5(os.path.join(outdir, 'expr.sparse.h5'))
+        mat.save_mtx(os.path.join(outdir, 'expr.mtx'))
+    if dense:
+        expr_df = mat.to_dense()
+        expr_df.to_csv(os.path.join(outdir, 'expr.csv'))
+        expr_df.to_hdf(os.path.join(outdir, 'expr.h5'), key='table')
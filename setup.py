@@ -22,6 +22,8 @@ install_requires = [
     'numpy>=1.12.0',
     'tables>=3.4.2',
     'genometools',
+    # AlignmentHeader, AlignedSegment.to_string() and threads of AlignmentFile
+    'pysam>=0.15',
 ]
 
 # do not require installation if built by ReadTheDocs
@@ -122,6 +124,10 @@ setup(
             'pytest>=3, <4',
             'pytest-cov>=2.2.1, <3',
         ],
+        # faster inflater used by celseq2.decompress when installed
+        'fast-gzip': [
+            'isal',
+        ],
     },
 
     # data
@@ -42,6 +42,29 @@ def instance_celseq2_data(tmpdir_factory,
     return (r1_gz, r2_gz)
 
 
+@pytest.fixture(scope='session')
+def instance_edge_case_reads(tmpdir_factory):
+    # known/unknown barcodes, barcode with 1 mismatch to one or two known
+    # barcodes, low quality on barcode, long and short R2, trailing
+    # whitespace
+    fdir = tmpdir_factory.mktemp('edge_case_reads')
+    r1, r2 = fdir.join('r1.fq'), fdir.join('r2.fq')
+    reads = [('AAACCCAGACTC', 'I' * 12, 'A' * 50, ''),
+             ('AAACCCNNNNNN', 'I' * 12, 'C' * 50, ''),
+             ('AAACCCAGCTAG', 'I' * 6 + '#' + 'I' * 5, 'G' * 20, ''),
+             ('TTTGGGGTACTC', 'I' * 12, 'T' * 35, ' '),
+             ('TTTGGGGTACTC', 'I' * 12, 'ACGT' * 10, '\t'),
+             ('CCCAAAAGACTA', 'I' * 12, 'TG' * 20, ' \t'),
+             ('CCCAAAAGCTAC', 'I' * 12, 'CA' * 20, '')]
+    with open(str(r1), 'w') as f1, open(str(r2), 'w') as f2:
+        for i, (seq1, qual1, seq2, ws) in enumerate(reads):
+            f1.write('@r{} 1:N{ws}\n{}{ws}\n+\n{}{ws}\n'.format(
+                i, seq1, qual1, ws=ws))
+            f2.write('@r{} 2:N{ws}\n{}{ws}\n+\n{}{ws}\n'.format(
+                i, seq2, 'F' * len(seq2), ws=ws))
+    return (r1, r2)
+
+
 @pytest.fixture(scope='session')
 def instance_demultiplex_stats(tmpdir_factory, instance_celseq2_data):
     fdir = tmpdir_factory.mktemp('small_fq')
@@ -85,3 +108,21 @@ def instance_count_umi(instance_features):
                                           len_umi=6, stranded='yes',
                                           accept_aln_qual_min=0, dumpto=None)
     return (umi_cnt, umi_set)
+
+
+@pytest.fixture(scope='session')
+def instance_item_sam(tmpdir_factory):
+    # demo alignments spread over 3 cells, as in an item-level SAM
+    sam = resource_filename('celseq2',
+                            'demo/{}'.format('BC-22-GTACTC.sam'))
+    fpath = tmpdir_factory.mktemp('item_sam').join('bowtie2.bigsam')
+    barcodes = ('GTACTC', 'AGACTC', 'CATGCA')
+    with open(sam) as fin, open(str(fpath), 'w') as fout:
+        i = 0
+        for line in fin:
+            if not line.startswith('@'):
+                line = line.replace('BC-GTACTC_',
+                                    'BC-{}_'.format(barcodes[i % 3]), 1)
+                i += 1
+            fout.write(line)
+    return fpath
@@ -0,0 +1,22 @@
+import pytest
+from celseq2.demultiplex import bc_correction_index
+from celseq2.dummy_CELSeq2_reads import dummy_cell_barcodes
+
+
+def _hamming(x, y):
+    return sum(a != b for a, b in zip(x, y))
+
+
+@pytest.mark.parametrize('max_mismatch', [1, 2])
+def test_bc_correction_index(max_mismatch):
+    barcodes = list(dummy_cell_barcodes().values())
+    index, ambiguous = bc_correction_index(barcodes, max_mismatch)
+    assert not set(index) & ambiguous
+    for seq, bc in index.items():
+        dists = sorted(_hamming(seq, x) for x in barcodes)
+        # the only closest barcode
+        assert _hamming(seq, bc) == dists[0] <= max_mismatch
+        assert len(barcodes) == 1 or dists[1] > dists[0]
+    for seq in ambiguous:
+        dists = sorted(_hamming(seq, x) for x in barcodes)
+        assert dists[0] == dists[1] <= max_mismatch
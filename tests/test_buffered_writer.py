@@ -0,0 +1,150 @@
+import os
+import gzip
+import pysam
+import pytest
+from pkg_resources import resource_filename
+from celseq2.helper import md5sum
+from celseq2.buffered_writer import BufferedWriterPool, BGZF_EOF
+from celseq2.decompress import is_bgzf
+from celseq2.demultiplex_sam import demultiplex_sam, demultiplex_sam_with_claim
+from celseq2.demultiplex_sam import _cell_seq, SamWriterPool
+from celseq2.count_umi import count_umi
+
+
+def test_pool_bounded(tmpdir):
+    # more files than handles and a tiny budget
+    fpaths = [str(tmpdir.join('{}.txt'.format(i))) for i in range(20)]
+    expected = {f: b'' for f in fpaths}
+    pool = BufferedWriterPool(fpaths, memory_budget=64, chunk_size=16,
+                              max_open=3)
+    for i in range(500):
+        f = fpaths[(i * 7) % len(fpaths)]
+        data = 'line-{}\n'.format(i).encode()
+        pool.write(f, data)
+        expected[f] += data
+        assert len(pool._open) <= 3
+        assert pool._buffered <= 64
+    pool.close()
+    for f in fpaths:
+        assert open(f, 'rb').read() == expected[f]
+
+
+@pytest.mark.parametrize('compress', ['gzip', 'bgzf'])
+def test_pool_compressed(tmpdir, compress):
+    fpaths = [str(tmpdir.join('{}.gz'.format(i))) for i in range(5)]
+    expected = {f: b'@header\n' for f in fpaths}
+    pool = BufferedWriterPool(fpaths, memory_budget=256, chunk_size=64,
+                              max_open=2, header=dict(expected),
+                              compress=compress, threads=3)
+    for i in range(2000):
+        f = fpaths[(i * 3) % len(fpaths)]
+        data = 'line-{}\n'.format(i).encode()
+        pool.write(f, data)
+        expected[f] += data
+    pool.close()
+    for f in fpaths:
+        assert gzip.open(f).read() == expected[f]
+        assert is_bgzf(f) == (compress == 'bgzf')
+        if compress == 'bgzf':
+            assert open(f, 'rb').read().endswith(BGZF_EOF)
+
+
+@pytest.mark.parametrize('claim', [False, True])
+def test_demultiplex_sam(tmpdir, claim):
+    sam = resource_filename('celseq2', 'demo/{}'.format('BC-22-GTACTC.sam'))
+    # reference: one pysam writer per barcode
+    samobj = pysam.AlignmentFile(sam, 'rb')
+    ref = {}
+    for aln in samobj:
+        bc = _cell_seq(aln.query_name, length=6)
+        if bc not in ref:
+            ref[bc] = pysam.AlignmentFile(str(tmpdir.join(bc + '.ref')), 'w',
+                                          template=samobj)
+        ref[bc].write(aln)
+    for _, fh in ref.items():
+        fh.close()
+
+    outdir = tmpdir.mkdir('out')
+    if claim:
+        demultiplex_sam_with_claim(sam, str(outdir), 6, list(ref),
+                                   max_open_files=1)
+    else:
+        demultiplex_sam(sam, str(outdir), 6, max_open_files=1)
+    for bc in ref:
+        assert md5sum(str(outdir.join(bc + '.sam'))) == \
+            md5sum(str(tmpdir.join(bc + '.ref')))
+
+
+@pytest.mark.parametrize('claim', [False, True])
+@pytest.mark.parametrize('max_open_files', [None, 2])
+def test_demultiplex_sam_bam_cells(tmpdir, instance_item_sam, claim,
+                                   max_open_files):
+    # cells beyond the open files are spilled and written to BAM at the end
+    sam = str(instance_item_sam)
+    samobj = pysam.AlignmentFile(sam, 'rb')
+    ref = {}
+    for aln in samobj:
+        bc = _cell_seq(aln.query_name, length=6)
+        if bc not in ref:
+            ref[bc] = pysam.AlignmentFile(str(tmpdir.join(bc + '.ref')),
+                                          'wb', template=samobj)
+        ref[bc].write(aln)
+    for _, fh in ref.items():
+        fh.close()
+
+    outdir = tmpdir.mkdir('out')
+    if claim:
+        demultiplex_sam_with_claim(sam, str(outdir), 6,
+                                   list(ref) + ['TTTTTT'],
+                                   max_open_files=max_open_files,
+                                   output_format='bam', threads=2)
+        assert pysam.AlignmentFile(str(outdir.join('TTTTTT.bam')),
+                                   'rb').count(until_eof=True) == 0
+    else:
+        demultiplex_sam(sam, str(outdir), 6, max_open_files=max_open_files,
+                        output_format='bam', threads=2)
+    assert len(ref) == 3
+    assert sorted(os.listdir(str(outdir))) == \
+        sorted(bc + '.bam' for bc in list(ref) + ['TTTTTT'] * claim)
+    for bc in ref:
+        assert gzip.open(str(outdir.join(bc + '.bam'))).read() == \
+            gzip.open(str(tmpdir.join(bc + '.ref'))).read()
+
+
+def test_demultiplex_sam_bam(tmpdir, instance_features):
+    sam = resource_filename('celseq2', 'demo/{}'.format('BC-22-GTACTC.sam'))
+    samobj = pysam.AlignmentFile(sam, 'rb')
+    ref = pysam.AlignmentFile(str(tmpdir.join('ref.bam')), 'wb',
+                              template=samobj)
+    for aln in samobj:
+        ref.write(aln)
+    ref.close()
+
+    outdir = tmpdir.mkdir('out')
+    demultiplex_sam(sam, str(outdir), 6, output_format='bam', threads=2)
+    out = str(outdir.join('GTACTC.bam'))
+    assert gzip.open(out).read() == gzip.open(str(tmpdir.join('ref.bam'))).read()
+
+    count_sam = count_umi(sam, instance_features, accept_aln_qual_min=0)
+    count_bam = count_umi(out, instance_features, accept_aln_qual_min=0)
+    assert count_sam == count_bam
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/task'),
+                    reason='counts threads of /proc')
+def test_sam_writer_pool_threads(tmpdir, monkeypatch, instance_item_sam):
+    # BAM writers share <threads> threads instead of a pool each
+    monkeypatch.setattr(SamWriterPool, 'batch_size', 2)
+    samobj = pysam.AlignmentFile(str(instance_item_sam), 'rb')
+    alns = list(samobj)
+    fpaths = [str(tmpdir.join('{}.bam'.format(i))) for i in range(20)]
+    before = len(os.listdir('/proc/self/task'))
+    pool = SamWriterPool(samobj, fpaths, output_format='bam', threads=4)
+    for i, aln in enumerate(alns * 5):
+        pool.write(fpaths[i % 20], aln)
+    assert len(os.listdir('/proc/self/task')) <= before + 4
+    pool.close()
+    for i, fpath in enumerate(fpaths):
+        with pysam.AlignmentFile(fpath, 'rb') as fh:
+            assert [x.to_string() for x in fh] == \
+                [x.to_string() for x in (alns * 5)[i::20]]
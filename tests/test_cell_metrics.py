@@ -0,0 +1,79 @@
+import random
+from collections import Counter
+from celseq2.cell_metrics import cell_metrics, matrix_metrics, metrics_table
+from celseq2.cell_metrics import save_cell_metrics, load_cell_metrics
+from celseq2.cell_metrics import METRICS, ALN_STATS
+from celseq2.sparse_matrix import SparseCounts
+from celseq2.umi_matrix import save_matrix
+from celseq2.molecule_store import MoleculeStore
+from celseq2.count_umi import count_umi_by_cell, count_umi_batch
+from celseq2.count_umi import plotly_alignment_stats
+from celseq2.qc import qc_metrics, qc_metrics_of_table
+
+'''
+Per-cell metrics taken at count time or with the matrix should equal the ones
+computed from the counts, and QC should look them up instead.
+'''
+
+
+def _counters(seed=4):
+    rng = random.Random(seed)
+    genes = ['g{}'.format(i) for i in range(20)] + ['mt-a', 'MT-b']
+    counters = {}
+    for i in range(10):
+        counters['BC-{}'.format(i)] = Counter(
+            {rng.choice(genes): rng.randint(0, 9)
+             for _ in range(rng.randint(0, 12))})
+    return genes, counters
+
+
+def test_metrics_of_matrix(tmpdir):
+    genes, counters = _counters()
+    mat = SparseCounts.from_counters(counters, genes)
+    expected = metrics_table({c: cell_metrics(x)
+                              for c, x in counters.items()})
+    assert matrix_metrics(mat).equals(expected[list(METRICS)])
+    dense = mat.to_dense()
+    assert expected.num_UMIs.tolist() == dense.sum(axis=0).tolist()
+    assert expected.num_mt_UMIs.tolist() == \
+        dense.loc[['mt-a', 'MT-b']].sum(axis=0).tolist()
+
+    save_matrix(mat, str(tmpdir), sparse=True, dense=False)
+    fpath = str(tmpdir.join('cell_metrics.csv'))
+    assert load_cell_metrics(fpath).equals(matrix_metrics(mat))
+    assert qc_metrics_of_table(fpath).equals(qc_metrics(mat))
+
+
+def test_save_load(tmpdir):
+    records = {'A': Counter(num_UMIs=3, _total=9, _unmapped=1),
+               'B': Counter()}
+    table = metrics_table(records)
+    assert list(table.columns) == list(METRICS + ALN_STATS)
+    assert table.loc['A', '_total'] == 9 and table.loc['B'].sum() == 0
+    fpath = str(tmpdir.join('cell_metrics.csv'))
+    save_cell_metrics(table, fpath)
+    assert load_cell_metrics(fpath).equals(table)
+
+    # former alignment stats of categories x cells
+    legacy = str(tmpdir.join('alignment.csv'))
+    table[['_multimapped', '_uniquemapped', '_total']].T.to_csv(legacy)
+    assert load_cell_metrics(legacy).equals(
+        table[['_multimapped', '_uniquemapped', '_total']])
+    assert plotly_alignment_stats([fpath, legacy],
+                                  str(tmpdir.join('aln.html')))
+
+
+def test_store_metrics(tmpdir, instance_item_sam, instance_features):
+    sam = str(instance_item_sam)
+    cells = ['GTACTC', 'AGACTC', 'CATGCA']
+    by_cell = count_umi_by_cell(sam, instance_features, claimed_bc=cells,
+                                accept_aln_qual_min=0, molecules=True)
+    item = str(tmpdir.join('item.h5'))
+    count_umi_batch([(sam, item, '', '', cells)], instance_features,
+                    by_cell=True, store=True, accept_aln_qual_min=0)
+    expected = metrics_table({
+        bc: Counter(cell_metrics(umi_vec)) + aln_cnt
+        for bc, (umi_vec, _, aln_cnt) in by_cell.items()})
+    table = MoleculeStore(item).cell_metrics()
+    assert table.sort_index().equals(expected.sort_index())
+    assert (table.num_UMIs > 0).any()
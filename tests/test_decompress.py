@@ -0,0 +1,39 @@
+import gzip
+import pytest
+import pysam
+from celseq2.decompress import available_backends, open_gz, is_bgzf
+
+'''
+Every decompression backend should give back the same content.
+'''
+
+
+@pytest.fixture(scope='module')
+def instance_bgzf(tmpdir_factory, instance_celseq2_data):
+    # several BGZF blocks
+    r1_gz, _ = instance_celseq2_data
+    content = gzip.open(str(r1_gz), 'rb').read() * 10
+    fpath = tmpdir_factory.mktemp('bgzf').join('r1.fq.gz')
+    fh = pysam.BGZFile(str(fpath), 'wb')
+    fh.write(content)
+    fh.close()
+    return (fpath, content)
+
+
+@pytest.mark.parametrize('backend', available_backends())
+def test_backends(instance_celseq2_data, instance_bgzf, backend):
+    r1_gz, _ = instance_celseq2_data
+    bgzf_fpath, bgzf_content = instance_bgzf
+    if backend != 'bgzf':
+        with open_gz(str(r1_gz), backend=backend) as fh:
+            assert fh.read() == gzip.open(str(r1_gz), 'rb').read()
+    with open_gz(str(bgzf_fpath), backend=backend, threads=3) as fh:
+        assert fh.read() == bgzf_content
+
+
+def test_bgzf_detection(instance_celseq2_data, instance_bgzf):
+    r1_gz, _ = instance_celseq2_data
+    assert not is_bgzf(str(r1_gz))
+    assert is_bgzf(str(instance_bgzf[0]))
+    with pytest.raises(ValueError):
+        open_gz(str(r1_gz), backend='bgzf')
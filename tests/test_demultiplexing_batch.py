@@ -0,0 +1,138 @@
+import os
+import sys
+import gzip
+import threading
+import multiprocessing
+import pytest
+from celseq2.helper import md5sum
+from celseq2.demultiplex import demultiplexing, main
+from celseq2.dummy_CELSeq2_reads import dummy_cell_barcodes
+
+'''
+The batched and sharded engines should give the same FASTQs and stats as
+the line-by-line engine.
+'''
+
+
+def _run(r1, r2, outdir, is_gzip, **kwargs):
+    return demultiplexing(
+        read1_fpath=str(r1), read2_fpath=str(r2),
+        dict_bc_id2seq=dummy_cell_barcodes(),
+        outdir=str(outdir),
+        start_umi=0, start_bc=6, len_umi=6, len_bc=6, len_tx=35,
+        bc_qual_min=10, is_gzip=is_gzip, **kwargs)
+
+
+def _md5_tree(d):
+    out = {}
+    for root, _, files in os.walk(str(d)):
+        for f in files:
+            fpath = os.path.join(root, f)
+            out[os.path.relpath(fpath, str(d))] = md5sum(fpath)
+    return out
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(save_unknown_bc_fastq=True),
+    dict(tagging_only=True),
+    dict(save_unknown_bc_fastq=True, bc_mismatch=1)])
+def test_batch_engine_edge_cases(tmpdir, instance_edge_case_reads, kwargs):
+    r1, r2 = instance_edge_case_reads
+    line = _run(r1, r2, tmpdir.mkdir('line'), False, **kwargs)
+    batch = _run(r1, r2, tmpdir.mkdir('batch'), False,
+                 engine='batch', batch_size=2, **kwargs)
+    sharded = _run(r1, r2, tmpdir.mkdir('sharded'), False,
+                   batch_size=1, processes=3, writers=2, **kwargs)
+    assert line == batch == sharded
+    if kwargs.get('bc_mismatch', 0):
+        assert (line['corrected'], line['ambiguous']) == (1, 1)
+        assert (line['unknown'], line['saved']) == (2, 4)
+    else:
+        assert (line['unknown'], line['unqualified'], line['saved']) == (3, 1, 3)
+    assert _md5_tree(tmpdir.join('line')) == _md5_tree(tmpdir.join('batch'))
+    assert _md5_tree(tmpdir.join('line')) == _md5_tree(tmpdir.join('sharded'))
+
+
+def test_batch_engine_simulated(tmpdir, instance_celseq2_data):
+    r1_gz, r2_gz = instance_celseq2_data
+    line = _run(r1_gz, r2_gz, tmpdir.mkdir('line'), True)
+    batch = _run(r1_gz, r2_gz, tmpdir.mkdir('batch'), True,
+                 engine='batch', batch_size=97,
+                 write_buffer=4096, max_open_files=4)
+    sharded = _run(r1_gz, r2_gz, tmpdir.mkdir('sharded'), True,
+                   batch_size=50, processes=4)
+    assert line == batch == sharded
+    assert _md5_tree(tmpdir.join('line')) == _md5_tree(tmpdir.join('batch'))
+    assert _md5_tree(tmpdir.join('line')) == _md5_tree(tmpdir.join('sharded'))
+
+
+@pytest.mark.parametrize('compress', ['gzip', 'bgzf'])
+@pytest.mark.parametrize('kwargs', [
+    dict(save_unknown_bc_fastq=True),
+    dict(tagging_only=True),
+    dict(save_unknown_bc_fastq=True, batch_size=1, processes=2),
+    dict(engine='batch', batch_size=2, compress_threads=2)])
+def test_compressed_output(tmpdir, instance_edge_case_reads, compress, kwargs):
+    r1, r2 = instance_edge_case_reads
+    plain_kwargs = {k: v for k, v in kwargs.items() if k != 'compress_threads'}
+    plain = _run(r1, r2, tmpdir.mkdir('plain'), False, **plain_kwargs)
+    packed = _run(r1, r2, tmpdir.mkdir('packed'), False,
+                  compress=compress, **kwargs)
+    assert plain == packed
+    plain_tree = _md5_tree(tmpdir.join('plain'))
+    packed_tree = _md5_tree(tmpdir.join('packed'))
+    assert sorted(f + '.gz' for f in plain_tree) == sorted(packed_tree)
+    for f in plain_tree:
+        data = gzip.open(str(tmpdir.join('packed', f + '.gz'))).read()
+        assert data == open(str(tmpdir.join('plain', f)), 'rb').read()
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(), dict(engine='batch', batch_size=2),
+    dict(batch_size=1, processes=2)])
+def test_tag_to_fifo(tmpdir, instance_edge_case_reads, kwargs):
+    r1, r2 = instance_edge_case_reads
+    saved = _run(r1, r2, tmpdir.mkdir('file'), False,
+                 tagging_only=True, **kwargs)
+
+    fifo = str(tmpdir.join('tagged.fifo'))
+    os.mkfifo(fifo)
+    out = {}
+    t = threading.Thread(target=lambda: out.update(_run(
+        r1, r2, tmpdir.mkdir('fifo'), False,
+        tagging_only=True, tag_to=fifo, **kwargs)))
+    t.start()
+    with open(fifo, 'rb') as fh:
+        streamed = fh.read()
+    t.join()
+    assert out == saved
+    assert streamed == open(str(tmpdir.join('file', 'tagged.fastq')),
+                            'rb').read()
+
+
+def test_tag_to_fifo_failure(tmpdir, monkeypatch):
+    ''' A reader of the FIFO gets EOF when demultiplexing fails early. '''
+    fifo = str(tmpdir.join('tagged.fifo'))
+    os.mkfifo(fifo)
+    monkeypatch.setattr(sys, 'argv', [
+        'bc-demultiplex', str(tmpdir.join('missing_R1.fastq')),
+        str(tmpdir.join('missing_R2.fastq')),
+        '--bc-index', str(tmpdir.join('missing_bc.tab')),
+        '--out-dir', str(tmpdir), '--tagging-only', '--tag-to', fifo])
+    out = {}
+    t = threading.Thread(target=lambda: out.update(
+        streamed=open(fifo, 'rb').read()), daemon=True)
+    t.start()
+    with pytest.raises(OSError):
+        main()
+    t.join(timeout=10)
+    assert not t.is_alive()
+    assert out['streamed'] == b''
+
+
+def test_sharded_missing_input(tmpdir, instance_edge_case_reads):
+    r1, r2 = instance_edge_case_reads
+    with pytest.raises(OSError):
+        _run(tmpdir.join('missing_R1.fastq'), r2, tmpdir, False,
+             processes=2)
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,145 @@
+import os
+import pickle
+import random
+import HTSeq
+import pytest
+from pkg_resources import resource_filename
+from celseq2 import prepare_annotation_model
+from celseq2.feature_index import FeatureIndex, NO_FEATURE, AMBIGUOUS
+from celseq2.prepare_annotation_model import cook_anno_model
+from celseq2.prepare_annotation_model import cook_anno_model_cached
+from celseq2.count_umi import count_umi
+
+'''
+The feature index should assign alignments to genes exactly as the union
+model over HTSeq.GenomicArrayOfSets.
+'''
+
+
+def _random_intervals(rng, n=300):
+    out = []
+    for _ in range(n):
+        start = rng.randrange(0, 5000)
+        out.append((rng.choice(['chr1', 'chr2']), start,
+                    start + rng.randrange(1, 400), rng.choice('+-'),
+                    'g{}'.format(rng.randrange(60))))
+    return out
+
+
+def _htseq_union(features, blocks):
+    genes = set()
+    for chrom, strand, start, end in blocks:
+        iv = HTSeq.GenomicInterval(chrom, start, end, strand)
+        for _, x in features[iv].steps():
+            genes |= x
+    return genes
+
+
+@pytest.mark.parametrize('stranded', [True, False])
+def test_assign_as_htseq(stranded):
+    rng = random.Random(42)
+    intervals = _random_intervals(rng)
+    features = HTSeq.GenomicArrayOfSets('auto', stranded=stranded)
+    for chrom, start, end, strand, gene in intervals:
+        features[HTSeq.GenomicInterval(chrom, start, end, strand)] += gene
+    index = FeatureIndex(intervals, stranded=stranded)
+
+    alns = []
+    for _ in range(2000):
+        chrom, strand = rng.choice(['chr1', 'chr2']), rng.choice('+-')
+        start = rng.randrange(0, 6000)
+        blocks = []
+        for _ in range(rng.randrange(1, 4)):
+            end = start + rng.randrange(1, 60)
+            blocks.append((chrom, strand, start, end))
+            start = end + rng.randrange(0, 500)
+        alns.append(blocks)
+
+    flat = [(k,) + b for k, blocks in enumerate(alns) for b in blocks]
+    genes = index.assign([x[1] for x in flat], [x[2] for x in flat],
+                         [x[3] for x in flat], [x[4] for x in flat],
+                         [x[0] for x in flat], len(alns))
+    for blocks, gene in zip(alns, genes):
+        expected = _htseq_union(features, blocks)
+        if len(expected) == 0:
+            assert gene == NO_FEATURE
+        elif len(expected) > 1:
+            assert gene == AMBIGUOUS
+        else:
+            assert index.genes[gene] == expected.pop()
+
+    chrom, strand, start, end = alns[0][0]
+    iv = HTSeq.GenomicInterval(chrom, start, end, strand)
+    steps = [(s.start, s.end, g) for s, g in features[iv].steps()]
+    assert index.steps(chrom, strand, start, end) == steps
+
+
+def test_count_umi_as_htseq(instance_dummy_gtf):
+    sam = resource_filename('celseq2', 'demo/{}'.format('BC-22-GTACTC.sam'))
+    out = []
+    for model in ('index', 'htseq'):
+        features, genes = cook_anno_model(str(instance_dummy_gtf),
+                                          feature_atrr='gene_id',
+                                          model=model)
+        out.append((count_umi(sam, features, accept_aln_qual_min=0), genes))
+    assert out[0] == out[1]
+
+
+def test_saved_index(tmpdir):
+    rng = random.Random(3)
+    index = FeatureIndex(_random_intervals(rng), stranded=True)
+    index.save(str(tmpdir.join('index')))
+    loaded = FeatureIndex.load(str(tmpdir.join('index')))
+    assert loaded.genes == index.genes
+    assert loaded.gene_sets == index.gene_sets
+    args = (['chr1', 'chr2', 'chr1', 'chr3'], ['+', '-', '-', '+'],
+            [10, 200, 3000, 5], [50, 260, 3100, 8], [0, 1, 1, 2], 3)
+    assert list(loaded.assign(*args)) == list(index.assign(*args))
+    assert loaded.steps('chr1', '+', 0, 800) == index.steps('chr1', '+', 0, 800)
+
+    # a loaded index pickles as a reference to its directory
+    data = pickle.dumps(loaded)
+    assert len(data) < len(pickle.dumps(index)) // 10
+    assert pickle.loads(data).genes == index.genes
+    assert pickle.loads(pickle.dumps(index)).gene_sets == index.gene_sets
+
+
+def test_cook_anno_model_cached(tmpdir, instance_dummy_gtf, monkeypatch):
+    cache = str(tmpdir.join('cache'))
+    expected = cook_anno_model(str(instance_dummy_gtf),
+                               feature_atrr='gene_id')
+    first = cook_anno_model_cached(str(instance_dummy_gtf), cache,
+                                   feature_atrr='gene_id')
+    assert len(os.listdir(cache)) == 1
+    assert first[0].genes == expected[0].genes
+    assert first[1] == expected[1]
+
+    def fail(*args, **kwargs):
+        raise AssertionError('annotation compiled again')
+    monkeypatch.setattr(prepare_annotation_model, 'cook_anno_model', fail)
+    second = cook_anno_model_cached(str(instance_dummy_gtf), cache,
+                                    feature_atrr='gene_id',
+                                    dumpto=str(tmpdir.join('anno.pkl')))
+    assert second[0].path == first[0].path
+
+    sam = resource_filename('celseq2', 'demo/{}'.format('BC-22-GTACTC.sam'))
+    assert count_umi(sam, str(tmpdir.join('anno.pkl'))) == \
+        count_umi(sam, expected[0])
+
+    with pytest.raises(AssertionError):
+        cook_anno_model_cached(str(instance_dummy_gtf), cache,
+                               feature_atrr='gene_id', stranded=False)
+
+
+def test_parallel_build():
+    rng = random.Random(11)
+    intervals = _random_intervals(rng, n=600)
+    intervals += [('chr{}'.format(k), 10, 20, '+', 'g1') for k in range(3, 9)]
+    serial = FeatureIndex(intervals, stranded=True)
+    parallel = FeatureIndex(intervals, stranded=True, processes=3)
+    assert parallel.genes == serial.genes
+    assert parallel.gene_sets == serial.gene_sets
+    assert sorted(parallel._steps) == sorted(serial._steps)
+    for key, (breakpoints, ids) in serial._steps.items():
+        assert (parallel._steps[key][0] == breakpoints).all()
+        assert (parallel._steps[key][1] == ids).all()
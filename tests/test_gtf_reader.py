@@ -0,0 +1,63 @@
+import gzip
+import shutil
+import HTSeq
+import pytest
+from celseq2.gtf_reader import read_gtf, gene_table
+from celseq2.prepare_annotation_model import cook_anno_model
+
+'''
+The vectorised GTF reader should read the same records as HTSeq.GFF_Reader.
+'''
+
+
+def _htseq_records(fpath, feature_type):
+    out = []
+    for gff in HTSeq.GFF_Reader(fpath):
+        if gff.type != feature_type:
+            continue
+        out.append((gff.iv.chrom, gff.iv.start, gff.iv.end, gff.iv.strand,
+                    gff.attr['gene_id'], gff.attr['gene_name']))
+    return out
+
+
+@pytest.mark.parametrize('feature_type', ['exon', 'gene'])
+def test_read_gtf(tmpdir, instance_dummy_gtf, feature_type):
+    gtf = str(instance_dummy_gtf)
+    gtf_gz = str(tmpdir.join('dummy.gtf.gz'))
+    with open(gtf, 'rb') as fin, gzip.open(gtf_gz, 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+    expected = _htseq_records(gtf, feature_type)
+    for fpath in (gtf, gtf_gz):
+        records = read_gtf(fpath, feature_type=feature_type, chunksize=7)
+        found = list(zip(records['chrom'], records['start'], records['end'],
+                         records['strand'], records['gene_id'],
+                         records['gene_name']))
+        assert found == expected
+
+
+def test_read_gff3(tmpdir):
+    gff = tmpdir.join('mini.gff3')
+    gff.write('##gff-version 3\n'
+              'chr1\tx\texon\t11\t20\t.\t-\t.\tID=e1;gene_id=g1;'
+              'gene_type=lincRNA\n'
+              'chr1\tx\tCDS\t11\t20\t.\t-\t.\tID=c1;gene_id=g1\n'
+              'chr2\tx\texon\t5\t9\t.\t+\t.\tgene_id=g2\n')
+    records = read_gtf(str(gff), attributes=('gene_id', 'gene_type'))
+    assert records['gene_id'].tolist() == ['g1', 'g2']
+    assert records['start'].tolist() == [10, 4]
+    genes = gene_table(records, 'gene_id')
+    assert genes.loc['g1', 'biotype'] == 'lincRNA'
+    assert genes.loc['g2', 'chromosome'] == 'chr2'
+
+
+@pytest.mark.parametrize('gene_types', [(), ('lincRNA',)])
+def test_cook_anno_model_genes(tmpdir, instance_dummy_gtf, gene_types):
+    gtf = str(instance_dummy_gtf)
+    csv = str(tmpdir.join('genes.csv'))
+    index, genes = cook_anno_model(gtf, feature_atrr='gene_name',
+                                   gene_types=gene_types, gene_csv=csv)
+    htseq, htseq_genes = cook_anno_model(gtf, feature_atrr='gene_name',
+                                         gene_types=gene_types,
+                                         model='htseq')
+    assert genes == htseq_genes
+    assert len(tmpdir.join('genes.csv').readlines()) == len(genes) + 1
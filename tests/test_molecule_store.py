@@ -0,0 +1,76 @@
+import random
+import pytest
+from collections import Counter, defaultdict
+from celseq2.molecules import Molecules
+from celseq2.molecule_store import MoleculeStore
+from celseq2.count_umi import count_umi_by_cell, count_umi_batch
+from celseq2.demultiplex_sam import demultiplex_sam
+
+'''
+Cells appended to a molecule store should read back as the molecules and
+alignment stats they were counted with.
+'''
+
+
+def _random_cell(rng, genes, length=6):
+    umi_set = defaultdict(set)
+    for _ in range(rng.randint(0, 30)):
+        umi_set[rng.choice(genes)].add(''.join(rng.choice('ACGTN')
+                                               for _ in range(length)))
+    mol = Molecules.from_umi_set(umi_set, length)
+    aln_cnt = Counter(_total=rng.randint(1, 99), _unmapped=rng.randint(0, 9))
+    return (mol.counts(), mol, aln_cnt)
+
+
+def test_store_roundtrip(tmpdir):
+    rng = random.Random(5)
+    genes = ['g{}'.format(i) for i in range(40)]
+    batches = [{'C{}'.format(i): _random_cell(rng, genes)
+                for i in range(k, k + 4)} for k in (0, 4, 8)]
+    store = MoleculeStore(str(tmpdir.join('item-1.h5')), 6)
+    for batch in batches:
+        store.append(batch)
+    expected = {c: x for batch in batches for c, x in batch.items()}
+    assert store.cells() == list(expected)
+    mols = store.molecules()
+    stats = store.aln_stats()
+    for cell, (_, mol, aln_cnt) in expected.items():
+        assert mols[cell] == mol
+        assert stats[cell] == aln_cnt
+
+    # a cell appended again is merged
+    store.append({'C0': expected['C0']})
+    assert store.molecules()['C0'].keys.tolist() == \
+        expected['C0'][1].keys.tolist()
+    assert store.aln_stats()['C0']['_total'] == \
+        2 * expected['C0'][2]['_total']
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_count_umi_batch_store(tmpdir, instance_item_sam, instance_features,
+                               processes):
+    sam = str(instance_item_sam)
+    demultiplex_sam(sam, str(tmpdir), 6)
+    cells = ['GTACTC', 'AGACTC', 'CATGCA']
+    by_cell = count_umi_by_cell(sam, instance_features, claimed_bc=cells,
+                                accept_aln_qual_min=0, molecules=True)
+
+    # one writer per cell, appending to one store
+    fpath = str(tmpdir.join('cells.h5'))
+    jobs = [(str(tmpdir.join(bc + '.sam')), fpath, '', '', None)
+            for bc in cells]
+    count_umi_batch(jobs, instance_features, processes=processes,
+                    store=True, accept_aln_qual_min=0)
+    # one writer for all cells of the item
+    item = str(tmpdir.join('item.h5'))
+    count_umi_batch([(sam, item, '', '', cells)], instance_features,
+                    by_cell=True, store=True, accept_aln_qual_min=0)
+
+    for store in (MoleculeStore(fpath), MoleculeStore(item)):
+        assert sorted(store.cells()) == sorted(cells)
+        mols = store.molecules()
+        stats = store.aln_stats()
+        for bc, (umi_vec, mol, aln_cnt) in by_cell.items():
+            assert mols[bc] == mol
+            assert mols[bc].counts() == umi_vec
+            assert stats[bc] == aln_cnt
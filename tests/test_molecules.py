@@ -0,0 +1,168 @@
+import pickle
+import random
+import numpy as np
+import pytest
+from pkg_resources import resource_filename
+from collections import defaultdict
+from celseq2.molecules import Molecules, encode_umis, decode_umis
+from celseq2.molecules import valid_umis, molecule_keys
+from celseq2.molecules import as_molecules, umi_pairs, collapse_umis
+from celseq2.count_umi import count_umi, count_umi_by_cell
+
+'''
+Integer-encoded molecules should give the same UMI counts and sets as sets of
+UMI strings.
+'''
+
+
+def _random_umi_sets(rng, n_genes=50, n_umis=200, length=6):
+    out = defaultdict(set)
+    for _ in range(n_umis):
+        gene = 'g{}'.format(rng.randrange(n_genes))
+        out[gene].add(''.join(rng.choice('ACGTN') for _ in range(length)))
+    return out
+
+
+def test_encode_umis():
+    umis = ['AAAAAA', 'TTTTTT', 'ACGTNA', 'NAAAAA', 'AAAAAN', 'NNNNNN']
+    codes = encode_umis(umis, 6)
+    assert codes[0] == 0 and codes[1] == 4 ** 6 - 1
+    assert len(set(codes.tolist())) == len(umis)
+    assert decode_umis(codes, 6) == umis
+    with pytest.raises(ValueError):
+        encode_umis(['ACGTAC', 'ACG'], 6)
+    with pytest.raises(ValueError):
+        encode_umis(['ACGTAX'], 6)
+
+
+def test_valid_umis():
+    umis = ['ACGTNA', 'ACG', 'ACGTAX', 'ACGTAÄ', 'ACGTACG', 'TTTTTT']
+    assert valid_umis(umis, 6).tolist() == [True, False, False, False, False,
+                                            True]
+    assert valid_umis([], 6).tolist() == []
+
+
+def test_molecule_keys_overflow():
+    keys = molecule_keys([0, 2 ** 15 - 1], [1, 2], 16)
+    assert (keys >> 48).tolist() == [0, 2 ** 15 - 1]
+    with pytest.raises(ValueError):
+        molecule_keys([2 ** 15], [0], 16)
+    with pytest.raises(ValueError):
+        Molecules.from_codes(np.arange(3), np.zeros(3, dtype=np.int64),
+                             ['a', 'b', 'c'], 21)
+
+
+def test_count_umi_invalid_umis(tmpdir, instance_features):
+    sam = resource_filename('celseq2', 'demo/BC-22-GTACTC.sam')
+    bad, dropped = tmpdir.join('bad.sam'), tmpdir.join('dropped.sam')
+    with open(sam) as fin, open(str(bad), 'w') as f_bad, \
+            open(str(dropped), 'w') as f_dropped:
+        for i, line in enumerate(fin):
+            if line.startswith('@') or i % 3:
+                f_bad.write(line)
+                f_dropped.write(line)
+            else:
+                # UMI too short or with a base other than ACGTN
+                name, rest = line.split('\t', 1)
+                name = name[:-3] if i % 2 else name[:-1] + 'X'
+                f_bad.write(name + '\t' + rest)
+    kwargs = dict(accept_aln_qual_min=0)
+    umi_vec, umi_set, aln_cnt = count_umi(sam, instance_features, **kwargs)
+    bad_vec, bad_set, bad_cnt = count_umi(str(bad), instance_features,
+                                          **kwargs)
+    kept_vec, kept_set, kept_cnt = count_umi(str(dropped), instance_features,
+                                             **kwargs)
+    assert (bad_vec, bad_set) == (kept_vec, kept_set)
+    assert bad_cnt['_invalid_umi'] == \
+        aln_cnt['_uniquemapped'] - kept_cnt['_uniquemapped'] > 0
+    assert bad_cnt['_total'] == aln_cnt['_total']
+
+
+def test_molecules_as_sets():
+    rng = random.Random(7)
+    umi_sets = [_random_umi_sets(rng) for _ in range(3)]
+    mols = [Molecules.from_umi_set(x, 6) for x in umi_sets]
+    for x, mol in zip(umi_sets, mols):
+        assert mol.umi_sets() == x
+        assert mol.counts() == {g: len(v) for g, v in x.items()}
+        assert as_molecules(x) == mol
+
+    union = defaultdict(set)
+    for x in umi_sets:
+        for g, v in x.items():
+            union[g] |= v
+    merged = Molecules.merge(mols)
+    assert merged.umi_sets() == union
+    assert np.array_equal(merged.keys, Molecules.from_umi_set(union, 6).keys)
+    assert merged.reads.sum() == sum(len(v) for x in umi_sets
+                                     for v in x.values())
+    assert pickle.loads(pickle.dumps(merged)) == merged
+
+
+def test_count_umi_molecules(instance_item_sam, instance_features):
+    sam = str(instance_item_sam)
+    umi_vec, umi_set, aln_cnt = count_umi(sam, instance_features,
+                                          accept_aln_qual_min=0)
+    mol_vec, mol, mol_aln_cnt = count_umi(sam, instance_features,
+                                          accept_aln_qual_min=0,
+                                          molecules=True)
+    assert (mol_vec, mol.umi_sets(), mol_aln_cnt) == \
+        (umi_vec, umi_set, aln_cnt)
+    assert len(mol) == sum(umi_vec.values())
+
+    cells = count_umi_by_cell(sam, instance_features, accept_aln_qual_min=0,
+                              molecules=True)
+    merged = Molecules.merge([x[1] for x in cells.values()])
+    assert merged.counts() == umi_vec
+    # a molecule takes one int64 instead of a string in a set
+    assert mol.keys.nbytes < len(pickle.dumps(umi_set))
+    assert mol.keys.dtype == np.int64
+
+
+@pytest.mark.parametrize('distance', [1, 2])
+def test_umi_pairs_bucketed(distance):
+    rng = random.Random(distance)
+    umis = sorted(set(''.join(rng.choice('ACGTN') for _ in range(6))
+                      for _ in range(400)))
+    codes = encode_umis(umis, 6)
+    i, j = umi_pairs(codes, 6, distance)
+    found = set(zip(i.tolist(), j.tolist()))
+    expected = set((a, b) for a in range(len(umis))
+                   for b in range(a + 1, len(umis))
+                   if sum(x != y for x, y in zip(umis[a], umis[b])) <=
+                   distance)
+    assert found == expected
+
+
+def test_collapse_umis():
+    umis = ['ACGTAC', 'ACGTAA', 'ACGTTT', 'AAGTAA']
+    codes = encode_umis(umis, 6)
+    reads = np.array([100, 10, 50, 5])
+    assert collapse_umis(codes, reads, 6, 'unique').tolist() == [0, 1, 2, 3]
+    assert collapse_umis(codes, reads, 6, 'directional').tolist() == \
+        [0, 0, 2, 0]
+    assert collapse_umis(codes, reads, 6, 'adjacency').tolist() == \
+        [0, 1, 2, 1]
+    assert collapse_umis(codes, reads, 6, 'directional',
+                         distance=2).tolist() == [0, 0, 0, 0]
+    with pytest.raises(ValueError):
+        collapse_umis(codes, reads, 6, 'cluster')
+
+    mol = Molecules.from_codes(np.zeros(165, dtype=np.int64),
+                               np.repeat(codes, reads), ['g'], 6)
+    collapsed = mol.collapse('directional')
+    assert collapsed.umi_sets() == {'g': {'ACGTAC', 'ACGTTT'}}
+    assert collapsed.reads.tolist() == [115, 50]
+
+
+@pytest.mark.parametrize('method', ['adjacency', 'directional'])
+def test_count_umi_collapsed(instance_item_sam, instance_features, method):
+    sam = str(instance_item_sam)
+    umi_vec, _, _ = count_umi(sam, instance_features, accept_aln_qual_min=0)
+    mol_vec, mol, aln_cnt = count_umi(sam, instance_features,
+                                      accept_aln_qual_min=0, molecules=True,
+                                      umi_collapse=method)
+    assert all(mol_vec[g] <= umi_vec[g] for g in umi_vec)
+    assert aln_cnt['_umi_collapsed'] == \
+        sum(umi_vec.values()) - sum(mol_vec.values())
+    assert mol.reads.sum() == aln_cnt['_uniquemapped']
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from celseq2.plotly_utils import thin_points, box_traces, save_html
+from celseq2.sparse_matrix import SparseCounts
+from celseq2.qc import plotly_qc
+
+'''
+Thinned plots should keep the outliers and the shape of the distribution, and
+html files should share one plotly.js.
+'''
+
+
+def test_thin_points():
+    rng = np.random.RandomState(0)
+    x = rng.lognormal(size=50000)
+    y = rng.normal(size=50000)
+    assert np.array_equal(thin_points(x, y), np.arange(50000))
+    kept = thin_points(x, y, max_points=3000)
+    assert len(kept) <= 3000
+    assert np.array_equal(kept, np.unique(kept))
+    # points of the sparse tails are all kept
+    assert np.array_equal(np.flatnonzero(x > 20), kept[x[kept] > 20])
+    assert y[kept].max() == y.max() and y[kept].min() == y.min()
+    # the same points are kept every time
+    assert np.array_equal(kept, thin_points(x, y, max_points=3000))
+
+
+def test_box_traces():
+    rng = np.random.RandomState(1)
+    vals = rng.normal(size=100000)
+    assert len(box_traces(vals, 'a')) == 1
+    box, outliers = box_traces(vals, 'a', max_points=1000, color='red')
+    assert len(box.y) <= 1000
+    assert np.allclose(np.percentile(box.y, [25, 50, 75]),
+                       np.percentile(vals, [25, 50, 75]), atol=0.01)
+    q1, q3 = np.percentile(vals, [25, 75])
+    n_outliers = ((vals < q1 - 1.5 * (q3 - q1)) |
+                  (vals > q3 + 1.5 * (q3 - q1))).sum()
+    assert len(outliers.y) == n_outliers
+    assert set(outliers.x) == {'a'}
+    assert outliers.marker.color == box.marker.color == 'red'
+
+
+def test_shared_plotlyjs(tmpdir):
+    rng = np.random.RandomState(2)
+    n_cells, n_genes = 3000, 50
+    nnz = rng.randint(1, 20, n_cells)
+    indices = np.concatenate([rng.choice(n_genes, k, replace=False)
+                              for k in nnz])
+    mat = SparseCounts(rng.randint(1, 9, nnz.sum()),
+                       indices, np.concatenate([[0], np.cumsum(nnz)]),
+                       ['g{}'.format(i) for i in range(n_genes - 2)] +
+                       ['mt-1', 'mt-2'],
+                       ['c{}'.format(i) for i in range(n_cells)])
+    fpath = str(tmpdir.join('expr.sparse.h5'))
+    mat.save_h5(fpath)
+    bundle = str(tmpdir.join('report', 'plotly.min.js'))
+    inlined = str(tmpdir.join('QC.html'))
+    shared = str(tmpdir.join('qc', 'QC.html'))
+    tmpdir.mkdir('qc')
+    assert plotly_qc(fpath, inlined)
+    assert plotly_qc(fpath, shared, webgl=True, max_points=500,
+                     plotlyjs=bundle)
+    assert tmpdir.join('report', 'plotly.min.js').check()
+    html = open(shared).read()
+    assert 'src="../report/plotly.min.js"' in html
+    assert 'scattergl' in html
+    assert len(html) * 5 < len(open(inlined).read())
+
+    with pytest.raises(ValueError):
+        save_html(None, shared, plotlyjs='plotly.txt')
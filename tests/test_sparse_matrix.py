@@ -0,0 +1,158 @@
+import random
+import numpy as np
+import pandas as pd
+import pytest
+from collections import Counter
+from celseq2.sparse_matrix import SparseCounts, read_matrix
+from celseq2.support.st_pipeline import celseq2stpipeline
+from celseq2.qc import qc_metrics, qc_metrics_of_file
+
+'''
+Sparse UMI-count matrices should hold the same counts as the dense ones, in
+every format saved.
+'''
+
+
+@pytest.fixture
+def instance_counters():
+    rng = random.Random(11)
+    genes = ['g{}'.format(i) for i in range(30)] + ['mt-a', 'mt-b']
+    counters = {}
+    for i in range(12):
+        cnt = Counter({rng.choice(genes): rng.randint(1, 9)
+                       for _ in range(rng.randint(0, 10))})
+        cnt['not_exported'] = 3
+        counters['BC-{}'.format(i)] = cnt
+    return genes, counters
+
+
+def _dense(genes, counters, cells):
+    return pd.DataFrame({c: [counters[c][g] for g in genes] for c in cells},
+                        index=genes, columns=cells)
+
+
+def test_from_counters(instance_counters):
+    genes, counters = instance_counters
+    cells = sorted(counters, reverse=True)
+    mat = SparseCounts.from_counters(counters, genes, cells=cells)
+    expected = _dense(genes, counters, cells)
+    assert mat.shape == (len(genes), len(cells))
+    assert mat.to_dense().equals(expected)
+    assert SparseCounts.from_dense(expected) == mat
+    assert mat.total_per_cell().tolist() == expected.sum(axis=0).tolist()
+    assert mat.detected_per_cell().tolist() == \
+        (expected > 0).sum(axis=0).tolist()
+    assert mat.total_per_gene().tolist() == expected.sum(axis=1).tolist()
+    mt = np.array([g.startswith('mt-') for g in genes])
+    assert mat.total_per_cell(mt).tolist() == \
+        expected.loc[mt].sum(axis=0).tolist()
+    assert np.array_equal(mat.to_scipy().toarray(), expected.values)
+
+    genes_mask = mat.total_per_gene() != 0
+    cells_mask = mat.total_per_cell() != 0
+    sub = mat.select(genes_mask, cells_mask)
+    assert sub.to_dense().equals(expected.loc[genes_mask, cells_mask])
+
+
+@pytest.mark.parametrize('fname', ['expr.sparse.h5', 'expr.mtx'])
+def test_save_load(tmpdir, instance_counters, fname):
+    genes, counters = instance_counters
+    mat = SparseCounts.from_counters(counters, genes)
+    fpath = str(tmpdir.join(fname))
+    if fname.endswith('.mtx'):
+        mat.save_mtx(fpath)
+        assert tmpdir.join('genes.tsv').check()
+    else:
+        mat.save_h5(fpath)
+    assert read_matrix(fpath) == mat
+
+    empty = SparseCounts.from_counters({}, genes)
+    empty.save_h5(str(tmpdir.join('empty.h5')))
+    assert read_matrix(str(tmpdir.join('empty.h5'))) == empty
+
+
+def test_readers_sparse_vs_dense(tmpdir, instance_counters):
+    genes, counters = instance_counters
+    mat = SparseCounts.from_counters(counters, genes)
+    mat.cells = ['BC-{}-{}'.format(i + 1, s) for i, s in
+                 enumerate(['AAC', 'ACA', 'AGG', 'ATT', 'CAT', 'CCA',
+                            'CGT', 'CTC', 'GAG', 'GCT', 'GGA', 'GTC'])]
+    mat.save_h5(str(tmpdir.join('expr.sparse.h5')))
+    mat.to_dense().to_csv(str(tmpdir.join('expr.csv')))
+
+    spatial = tmpdir.join('spatial.tsv')
+    spatial.write(''.join('{}\t{}\t{}\n'.format(c.split('-')[-1], i, i % 3)
+                          for i, c in enumerate(mat.cells)))
+    out = []
+    for fname in ('expr.sparse.h5', 'expr.csv'):
+        st = str(tmpdir.join(fname + '.st.tsv'))
+        celseq2stpipeline(str(tmpdir.join(fname)), str(spatial), st,
+                          True, True)
+        out.append(open(st).read())
+    assert out[0] == out[1]
+
+    dense = mat.to_dense()
+    qc = qc_metrics(read_matrix(str(tmpdir.join('expr.csv'))))
+    assert qc.equals(qc_metrics(read_matrix(
+        str(tmpdir.join('expr.sparse.h5')))))
+    assert qc.total_num_UMIs.tolist() == dense.sum(axis=0).tolist()
+    mt = dense.loc[['mt-a', 'mt-b']].sum(axis=0) / dense.sum(axis=0)
+    assert np.allclose(qc.percent_mt.fillna(-1), mt.fillna(-1))
+
+
+@pytest.mark.parametrize('chunksize', [1, 5, 1000])
+def test_qc_metrics_of_file(tmpdir, instance_counters, chunksize):
+    genes, counters = instance_counters
+    mat = SparseCounts.from_counters(counters, genes)
+    mat.save_h5(str(tmpdir.join('expr.sparse.h5')))
+    mat.save_mtx(str(tmpdir.join('expr.mtx')))
+    mat.to_dense().to_csv(str(tmpdir.join('expr.csv')))
+    mat.to_dense().to_hdf(str(tmpdir.join('expr.h5')), key='table')
+    expected = qc_metrics(mat)
+    for fname in ('expr.sparse.h5', 'expr.mtx', 'expr.csv', 'expr.h5'):
+        qc = qc_metrics_of_file(str(tmpdir.join(fname)),
+                                chunksize=chunksize)
+        assert qc.equals(expected)
+
+    no_mt = SparseCounts.from_counters(counters, genes[:30])
+    no_mt.to_dense().to_csv(str(tmpdir.join('no_mt.csv')))
+    qc = qc_metrics_of_file(str(tmpdir.join('no_mt.csv')),
+                            chunksize=chunksize)
+    assert (qc.percent_mt == 0).all()
+    assert qc.equals(qc_metrics(no_mt))
+
+
+@pytest.mark.parametrize('chunksize', [1, 5, 1000])
+def test_st_pipeline(tmpdir, instance_counters, chunksize):
+    genes, counters = instance_counters
+    mat = SparseCounts.from_counters(counters, genes)
+    seqs = ['AAC', 'ACA', 'AGG', 'ATT', 'CAT', 'CCA',
+            'CGT', 'CTC', 'GAG', 'GCT', 'GGA', 'GTC']
+    mat.cells = ['BC-{}-{}'.format(i + 1, s) for i, s in enumerate(seqs)]
+    mat.save_h5(str(tmpdir.join('expr.sparse.h5')))
+
+    # first 10 cells are spots, the last one given twice
+    spatial = tmpdir.join('spatial.tsv')
+    spatial.write('# seq X Y\n' +
+                  ''.join('{} {}\t{}\n'.format(s, i, i % 3)
+                          for i, s in enumerate(seqs[:10])) +
+                  'GCT 9 9\n')
+    xy = {s: (str(i), str(i % 3)) for i, s in enumerate(seqs[:10])}
+    xy['GCT'] = ('9', '9')
+    dense = mat.to_dense()
+    dense = dense.loc[dense.sum(axis=1) != 0,
+                      [c for c in mat.cells if c.split('-')[-1] in xy]]
+    expected = ['X\tY\t' + '\t'.join(dense.index)] + [
+        '\t'.join(xy[c.split('-')[-1]] + tuple(map(str, dense[c])))
+        for c in dense.columns]
+
+    st = str(tmpdir.join('st.tsv'))
+    sparse_st = str(tmpdir.join('st.mtx'))
+    celseq2stpipeline(str(tmpdir.join('expr.sparse.h5')), str(spatial), st,
+                      False, True, sparse_out=sparse_st,
+                      chunksize=chunksize)
+    assert open(st).read().splitlines() == expected
+    st_mat = read_matrix(sparse_st)
+    assert st_mat.cells == ['{}x{}'.format(*xy[c.split('-')[-1]])
+                            for c in dense.columns]
+    assert np.array_equal(st_mat.to_dense().values, dense.values)
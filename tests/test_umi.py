@@ -1,6 +1,15 @@
+import os
 import pytest
 import pickle
+import random
+import HTSeq
+import pysam
+from collections import Counter, defaultdict
 from pkg_resources import resource_filename
+from celseq2.count_umi import count_umi, count_umi_by_cell, dump_umi_by_cell
+from celseq2.count_umi import invert_strand, count_umi_batch, AssignmentCache
+from celseq2.prepare_annotation_model import cook_anno_model
+from celseq2.demultiplex_sam import demultiplex_sam
 
 
 def test_umi(instance_count_umi):
@@ -19,3 +28,165 @@ def test_umi(instance_count_umi):
     # for calc, ans in zip(umi_set, ans_umi_set):
     #     assert c
     assert umi_set == ans_umi_set
+
+
+def test_count_umi_by_cell(tmpdir, instance_item_sam, instance_features):
+    sam = str(instance_item_sam)
+    demultiplex_sam(sam, str(tmpdir), 6)
+    claimed = ['GTACTC', 'AGACTC', 'CATGCA', 'AAAAAA']
+    counts = count_umi_by_cell(sam, instance_features, len_umi=6,
+                               bc_length=6, accept_aln_qual_min=0,
+                               claimed_bc=claimed)
+    assert sorted(counts) == sorted(claimed)
+    for bc in claimed[:3]:
+        assert counts[bc] == count_umi(str(tmpdir.join(bc + '.sam')),
+                                       instance_features, len_umi=6,
+                                       accept_aln_qual_min=0)
+    assert counts['AAAAAA'] == (Counter(), {}, Counter())
+
+    everything = count_umi_by_cell(sam, instance_features,
+                                   accept_aln_qual_min=0)
+    assert everything == {bc: counts[bc] for bc in claimed[:3]}
+
+    dump_umi_by_cell(everything, str(tmpdir.join('cnt')),
+                     str(tmpdir.join('set')), str(tmpdir.join('aln')))
+    umi_vec = pickle.load(open(str(tmpdir.join('cnt', 'GTACTC.pkl')), 'rb'))
+    assert umi_vec == counts['GTACTC'][0]
+
+
+def _htseq_count_umi(sam_fpath, features, stranded, accept_aln_qual_min):
+    # reference: alignments parsed by HTSeq, one at a time
+    umi_cnt = defaultdict(set)
+    aln_cnt = Counter()
+    for aln in HTSeq.BAM_Reader(sam_fpath):
+        aln_cnt['_total'] += 1
+        if not aln.aligned:
+            aln_cnt['_unmapped'] += 1
+            continue
+        try:
+            if aln.optional_field('NH') > 1:
+                aln_cnt['_multimapped'] += 1
+                continue
+        except KeyError:
+            pass
+        if aln.aQual < accept_aln_qual_min:
+            aln_cnt['_low_map_qual'] += 1
+            continue
+        if aln.iv.chrom not in features.chrom_vectors:
+            aln_cnt['_no_feature'] += 1
+            continue
+        gene_ids = set()
+        for part in aln.cigar:
+            if part.type != 'M':
+                continue
+            iv = invert_strand(part.ref_iv) if stranded == 'reverse' \
+                else part.ref_iv
+            for _, x in features[iv].steps():
+                gene_ids |= x
+        if len(gene_ids) == 1:
+            aln_cnt['_uniquemapped'] += 1
+            umi_cnt[gene_ids.pop()].add(aln.read.name.split('_')[1][4:10])
+        elif len(gene_ids) == 0:
+            aln_cnt['_no_feature'] += 1
+        else:
+            aln_cnt['_ambiguous'] += 1
+    return umi_cnt, aln_cnt
+
+
+@pytest.mark.parametrize('fmt', ['sam', 'bam'])
+@pytest.mark.parametrize('stranded', ['yes', 'reverse'])
+def test_count_umi_reader(tmpdir, instance_dummy_gtf, fmt, stranded):
+    rng = random.Random(7)
+    header = {'HD': {'VN': '1.0'},
+              'SQ': [{'SN': 'chr1', 'LN': 5000}, {'SN': 'chrX', 'LN': 5000}]}
+    fpath = str(tmpdir.join('aln.' + fmt))
+    with pysam.AlignmentFile(fpath, 'wb' if fmt == 'bam' else 'w',
+                             header=header) as fh:
+        for i in range(3000):
+            aln = pysam.AlignedSegment()
+            aln.query_name = 'BC-GTACTC_UMI-{}'.format(
+                ''.join(rng.choice('ACGT') for _ in range(6)))
+            aln.query_sequence = 'A' * 30
+            if rng.random() < 0.05:
+                aln.flag = 4
+                aln.reference_id = -1
+                aln.reference_start = -1
+            else:
+                aln.flag = rng.choice([0, 16])
+                aln.reference_id = rng.choice([0, 0, 0, 1])
+                aln.reference_start = rng.randrange(0, 4200)
+                aln.mapping_quality = rng.choice([0, 1, 30, 42])
+                aln.cigarstring = rng.choice(
+                    ['30M', '2S28M', '10M200N20M', '12M3I15M',
+                     '8M2D22M', '15M1000N10M5S'])
+                if rng.random() < 0.3:
+                    aln.set_tag('NH', rng.choice([1, 2, 3]))
+            fh.write(aln)
+
+    features, _ = cook_anno_model(str(instance_dummy_gtf),
+                                  feature_atrr='gene_id', model='htseq')
+    expected = _htseq_count_umi(fpath, features, stranded, 10)
+    for model in ('htseq', 'index'):
+        features, _ = cook_anno_model(str(instance_dummy_gtf),
+                                      feature_atrr='gene_id', model=model)
+        _, umi_cnt, aln_cnt = count_umi(fpath, features, stranded=stranded,
+                                        accept_aln_qual_min=10, threads=2)
+        assert (umi_cnt, aln_cnt) == expected
+    assert expected[1]['_uniquemapped'] > 100
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_count_umi_batch(tmpdir, instance_item_sam, instance_features,
+                         processes):
+    sam = str(instance_item_sam)
+    demultiplex_sam(sam, str(tmpdir), 6)
+    cells = ['GTACTC', 'AGACTC', 'CATGCA']
+    jobs = [(str(tmpdir.join(bc + '.sam')), str(tmpdir.join(bc + '.cnt')),
+             str(tmpdir.join(bc + '.set')), str(tmpdir.join(bc + '.aln')),
+             None) for bc in cells]
+    jobs.append((sam, str(tmpdir.join('cnt')), str(tmpdir.join('set')),
+                 str(tmpdir.join('aln')), cells[:2]))
+    done = count_umi_batch(jobs[:3], instance_features, processes=processes,
+                           accept_aln_qual_min=0)
+    assert sorted(done) == sorted(x[0] for x in jobs[:3])
+    done = count_umi_batch(jobs[3:], instance_features, processes=processes,
+                           by_cell=True, accept_aln_qual_min=0)
+    assert done == [sam]
+    assert sorted(os.listdir(str(tmpdir.join('cnt')))) == \
+        sorted(bc + '.pkl' for bc in cells[:2])
+
+    for bc in cells:
+        umi_vec, umi_set, aln_cnt = count_umi(jobs[cells.index(bc)][0],
+                                              instance_features,
+                                              accept_aln_qual_min=0)
+        assert pickle.load(open(str(tmpdir.join(bc + '.cnt')), 'rb')) == \
+            umi_vec
+        assert pickle.load(open(str(tmpdir.join(bc + '.set')),
+                                'rb')).umi_sets() == umi_set
+        assert pickle.load(open(str(tmpdir.join(bc + '.aln')), 'rb')) == \
+            aln_cnt
+        if bc in cells[:2]:
+            assert pickle.load(open(str(tmpdir.join('cnt', bc + '.pkl')),
+                                    'rb')) == umi_vec
+
+
+def test_assignment_cache(instance_item_sam, instance_features):
+    sam = str(instance_item_sam)
+    uncached = count_umi_by_cell(sam, instance_features,
+                                 accept_aln_qual_min=0,
+                                 cache=AssignmentCache(0))
+    cache = AssignmentCache()
+    counts = count_umi_by_cell(sam, instance_features, accept_aln_qual_min=0,
+                               cache=cache)
+    assert counts == uncached
+    misses = cache.misses
+    assert cache.hits > 0 and misses == len(cache)
+    assert count_umi_by_cell(sam, instance_features, accept_aln_qual_min=0,
+                             cache=cache) == uncached
+    assert cache.misses == misses
+    assert cache.hit_rate > 0.5
+
+    small = AssignmentCache(2)
+    assert count_umi_by_cell(sam, instance_features, accept_aln_qual_min=0,
+                             cache=small) == uncached
+    assert len(small) == 2
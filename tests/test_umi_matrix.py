@@ -0,0 +1,186 @@
+import os
+import random
+import pickle
+import pandas as pd
+from collections import Counter, defaultdict
+from celseq2.molecules import Molecules
+from celseq2.umi_matrix import MatrixBuilder, build_matrices, barcode_ids
+from celseq2.umi_matrix import save_matrix, item_partial, store_records
+from celseq2.umi_matrix import experiment_matrix
+from celseq2.sparse_matrix import read_matrix
+
+'''
+Matrices assembled from streamed per-cell results should equal the dense
+frames of the former per-gene loops over cells.
+'''
+
+
+def _random_umi_set(rng, genes, n_umis=40):
+    out = defaultdict(set)
+    for _ in range(n_umis):
+        out[rng.choice(genes)].add(''.join(rng.choice('ACGT')
+                                           for _ in range(6)))
+    return out
+
+
+def _dense_of_sets(umi_sets, genes, cells):
+    # former assembly: union of UMI sets per gene, then one Series per cell
+    expr = {}
+    for cell in cells:
+        union = defaultdict(set)
+        for x in umi_sets[cell]:
+            for g, v in x.items():
+                union[g] |= v
+        expr[cell] = pd.Series([len(union[g]) for g in genes], index=genes)
+    return pd.DataFrame(expr, index=genes, columns=cells)
+
+
+def test_build_matrices():
+    rng = random.Random(3)
+    genes = ['g{}'.format(i) for i in range(25)]
+    cells = ['AAC', 'CAG', 'GTA', 'TTT']
+    bc_ids = {'AAC': 2, 'CAG': 1, 'GTA': 3}
+    umi_sets = {c: [_random_umi_set(rng, genes + ['other'])
+                    for _ in range(rng.randint(1, 3))] for c in cells}
+    records = [('E1', c, x) for c in cells for x in umi_sets[c]]
+    records[0] = ('E1', records[0][1], Molecules.from_umi_set(records[0][2],
+                                                              6))
+    mats = build_matrices(records, genes, groups=['E1', 'E2'], bc_ids=bc_ids,
+                          len_umi=6)
+    assert set(mats) == {'E1', 'E2'}
+    assert mats['E2'].shape == (len(genes), 0)
+
+    ordered = ['CAG', 'AAC', 'GTA', 'TTT']
+    expected = _dense_of_sets(umi_sets, genes, ordered)
+    expected.columns = ['BC-1-CAG', 'BC-2-AAC', 'BC-3-GTA', 'BC-0-TTT']
+    assert mats['E1'].to_dense().equals(expected)
+
+    collapsed = build_matrices(records, genes, bc_ids=bc_ids, len_umi=6,
+                               umi_collapse='directional')['E1']
+    for j, cell in enumerate(ordered):
+        cnt = Molecules.merge([Molecules.from_umi_set(x, 6) for x in
+                               umi_sets[cell]]).collapse('directional')
+        cnt = cnt.counts()
+        assert collapsed.column(j).tolist() == [cnt[g] for g in genes]
+
+
+def test_matrix_builder_counts(tmpdir):
+    genes = ['a', 'b', 'c']
+    builder = MatrixBuilder(genes)
+    builder.add_counts('x', Counter(a=1, c=2, z=5))
+    builder.add_counts('y', Counter())
+    builder.add_counts('x', Counter(c=1))
+    assert len(builder) == 2
+    mat = builder.build()
+    assert mat.to_dense().values.tolist() == [[1, 0], [0, 0], [3, 0]]
+
+    save_matrix(mat, str(tmpdir), sparse=True, dense=True)
+    for fname in ('expr.sparse.h5', 'expr.mtx', 'expr.csv', 'expr.h5'):
+        assert read_matrix(str(tmpdir.join(fname))) == mat
+
+
+def test_barcode_ids(tmpdir):
+    fpath = tmpdir.join('bc.tab')
+    fpath.write('#barcode_id\tsequence\n1\tAAC\n2\tCAG\n3\tGTA\n')
+    assert barcode_ids(str(fpath), 1) == {'AAC': 1, 'CAG': 2, 'GTA': 3}
+
+
+def test_item_partial(tmpdir):
+    rng = random.Random(7)
+    genes = ['g{}'.format(i) for i in range(30)]
+    items = {'item-1': ['AAC', 'CAG'], 'item-2': ['CAG', 'GTA']}
+    umi_sets, pickles = {}, {}
+    for item, cells in items.items():
+        tmpdir.mkdir(item)
+        pickles[item] = []
+        for cell in cells:
+            umi_sets[(item, cell)] = _random_umi_set(rng, genes)
+            fpath = str(tmpdir.join(item, cell + '.pkl'))
+            with open(fpath, 'wb') as fh:
+                pickle.dump(umi_sets[(item, cell)], fh)
+            pickles[item].append(fpath)
+    stores = [str(tmpdir.join(item + '.h5')) for item in items]
+    for item, store in zip(items, stores):
+        assert item_partial(store, pickles[item], 6)
+        assert not item_partial(store, pickles[item], 6)
+    records = [('E1', cell, x) for (_, cell), x in umi_sets.items()]
+    expected = build_matrices(records, genes, len_umi=6)['E1']
+    merged = build_matrices(store_records(stores, lambda item: 'E1'), genes)
+    assert merged['E1'] == expected
+
+    # a changed cell of an item saves its partial again
+    umi_sets[('item-2', 'GTA')] = _random_umi_set(rng, genes)
+    with open(pickles['item-2'][1], 'wb') as fh:
+        pickle.dump(umi_sets[('item-2', 'GTA')], fh)
+    st = os.stat(pickles['item-2'][1])
+    os.utime(pickles['item-2'][1], ns=(st.st_atime_ns,
+                                       st.st_mtime_ns + 10**9))
+    assert not item_partial(stores[0], pickles['item-1'], 6)
+    assert item_partial(stores[1], pickles['item-2'], 6)
+    records = [('E1', cell, x) for (_, cell), x in umi_sets.items()]
+    expected = build_matrices(records, genes, len_umi=6)['E1']
+    merged = build_matrices(store_records(stores, lambda item: 'E1'), genes)
+    assert merged['E1'] == expected
+    assert not os.path.exists(stores[1] + '.tmp')
+
+
+def test_experiment_matrix(tmpdir):
+    rng = random.Random(9)
+    genes = ['g{}'.format(i) for i in range(30)]
+    exps = {'item-1': 'E1', 'item-2': 'E1', 'item-3': 'E2'}
+    cells = ['AAC', 'CAG', 'GTA']
+    bc_ids = {'AAC': 1, 'CAG': 2, 'GTA': 3}
+    pickles = {}
+    for item in exps:
+        tmpdir.mkdir(item)
+        pickles[item] = []
+        for cell in cells[:rng.randint(2, 3)]:
+            fpath = str(tmpdir.join(item, cell + '.pkl'))
+            with open(fpath, 'wb') as fh:
+                pickle.dump(_random_umi_set(rng, genes), fh)
+            pickles[item].append(fpath)
+
+    def stores_of(exp_id):
+        return [str(tmpdir.join(x + '.h5')) for x in sorted(exps)
+                if exps[x] == exp_id]
+
+    def update():
+        # jobs of the workflow: a partial per item, a matrix per experiment
+        saved = [x for x in sorted(exps)
+                 if item_partial(str(tmpdir.join(x + '.h5')), pickles[x], 6)]
+        merged = [x for x in ('E1', 'E2')
+                  if experiment_matrix(str(tmpdir.join(x)), stores_of(x),
+                                       genes, bc_ids=bc_ids, len_umi=6)]
+        return saved, merged
+
+    def rebuilt(exp_id):
+        # matrix of all cells of an experiment built at once
+        records = []
+        for item in sorted(exps):
+            for f in pickles[item]:
+                with open(f, 'rb') as fh:
+                    records.append((exps[item], os.path.basename(f)[:-4],
+                                    pickle.load(fh)))
+        return build_matrices(records, genes, groups=['E1', 'E2'],
+                              bc_ids=bc_ids, len_umi=6)[exp_id]
+
+    tmpdir.mkdir('E1')
+    tmpdir.mkdir('E2')
+    assert update() == (['item-1', 'item-2', 'item-3'], ['E1', 'E2'])
+    assert update() == ([], [])
+    mtimes = {f: os.stat(str(tmpdir.join('E2', f))).st_mtime_ns
+              for f in os.listdir(str(tmpdir.join('E2')))}
+    assert 'expr.sparse.h5' in mtimes and 'expr.csv' in mtimes
+
+    # a changed cell of item-1 merges E1 again, but not E2
+    with open(pickles['item-1'][0], 'wb') as fh:
+        pickle.dump(_random_umi_set(rng, genes), fh)
+    st = os.stat(pickles['item-1'][0])
+    os.utime(pickles['item-1'][0], ns=(st.st_atime_ns,
+                                       st.st_mtime_ns + 10**9))
+    assert update() == (['item-1'], ['E1'])
+    assert mtimes == {f: os.stat(str(tmpdir.join('E2', f))).st_mtime_ns
+                      for f in os.listdir(str(tmpdir.join('E2')))}
+    for exp_id in ('E1', 'E2'):
+        assert read_matrix(str(tmpdir.join(exp_id, 'expr.sparse.h5'))) == \
+            rebuilt(exp_id)